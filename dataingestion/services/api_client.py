@@ -9,13 +9,17 @@ This module encapulates the communication with iDigBio's storage service API.
 """
 import cherrypy
 import socket
-import argparse, json, urllib2, logging, time, sys
+import argparse, json, urllib, urllib2, logging, time, sys, os, hashlib
 import uuid
 import base64
 from poster.encode import multipart_encode
 from poster.streaminghttp import register_openers
 from time import sleep
 from httplib import HTTPException
+from dataingestion.services.http_pool import (HTTPConnectionPool,
+                                              RequestTimeout)
+from dataingestion.services.rate_limiter import RateLimiter
+from dataingestion.services.timeouts import AdaptiveTimeout
 
 logger = logging.getLogger("iDigBioSvc.api_client")
 register_openers()
@@ -26,8 +30,59 @@ def init(api_ep):
   global api_endpoint
   api_endpoint = api_ep
 
+"""The timeout of the authentication request."""
 TIMEOUT = 3
 
+"""Files this large are uploaded in chunks, see _post_image_chunked."""
+CHUNKED_THRESHOLD = 64 * 2 ** 20
+CHUNK_SIZE = 8 * 2 ** 20
+"""Chunks refused in a row before the upload attempt fails."""
+CHUNK_CONFLICTS = 3
+
+"""Caps the aggregate upload bandwidth of all the upload threads."""
+limiter = RateLimiter()
+"""The keep-alive connections of the image and CSV uploads."""
+pool = HTTPConnectionPool(throttle=limiter.consume,
+                          allowance=limiter.allowance)
+"""The timeouts of the requests sent through the pool."""
+timeouts = AdaptiveTimeout()
+
+def set_pool_size(size):
+  """Sets the number of idle connections kept per host."""
+  pool.maxsize = max(int(size), 1)
+
+def get_pool_stats():
+  return pool.stats()
+
+def set_rate_schedule(schedule):
+  """
+  Sets the upload bandwidth schedule, e.g. "08:00-18:00=2M". An empty
+  schedule is unlimited. See rate_limiter.parse_schedule.
+  Raises ValueError if the schedule is invalid.
+  """
+  limiter.set_schedule(schedule)
+
+def get_rate_stats():
+  """Returns the current upload rate and the throttle delay added."""
+  return limiter.stats()
+
+def set_stall_timeout(seconds):
+  """
+  Sets the seconds a request may send nothing before it fails.
+  Raises ValueError if seconds is not a positive number.
+  """
+  timeouts.set_stall_timeout(seconds)
+
+def get_timeout_stats():
+  """
+  Returns the throughput estimate the timeouts are derived from, and the
+  stalled and timed out requests.
+  """
+  stats = timeouts.stats()
+  pool_stats = pool.stats()
+  stats.update(stalls=pool_stats["stalls"], timeouts=pool_stats["timeouts"])
+  return stats
+
 def _build_url(collection):
   assert api_endpoint
   if collection == "check":
@@ -36,45 +91,131 @@ def _build_url(collection):
     ret = "%s/upload/%s" % (api_endpoint, collection)
   return ret
 
-def _post_image(path, reference):
-  url = _build_url("images")
+def _send(method, url, body, headers, what, path=""):
+  """
+  Sends a request over a pooled keep-alive connection.
+  Params:
+    what: What is sent, e.g. "media" or "CSV file", for the messages.
+    path: The local path of the file sent.
+  Returns: The response body.
+  Raises ServerException on HTTP 500 and ClientException on the other HTTP
+  errors and the network errors.
+  """
+  headers["Authorization"] = "Basic %s" % auth_string
+  # The timeout grows with the body, the stall timeout does not.
+  size = int(headers.get("Content-Length") or 0)
+  starttime = time.time()
+  startdelay = limiter.thread_delay()
   try:
-    params = {"file": open(path, "rb"), "filereference": reference}
-  except IOError as e:
-    logger.error("File IO error: {0}".format(e))
-    raise
-  size = sys.getsizeof(params)
+    status, reason, resp = pool.request(
+        method, url, body, headers, timeouts.stall_timeout, timeouts.get(size))
+  except (socket.error, socket.timeout, HTTPException) as e:
+    if isinstance(e, RequestTimeout):
+      timeouts.timed_out()
+    # Server down, network down.
+    logger.error("{0} caught while POSTing the {1}. reason={2}, url={3}."
+        .format(type(e), what, str(e), url))
+    raise ClientException(
+        "{0} caught while POSTing the {1}.".format(type(e), what),
+        reason=str(e), url=url, timeout=_is_timeout(e))
+  if status < 400:
+    timeouts.record(size, time.time() - starttime -
+                    (limiter.thread_delay() - startdelay))
+  if status >= 400:
+    logger.error("HTTP error caught: {0}".format(status))
+    if status == 500:
+      logger.error("Fatal Server Exception Detected. HTTP Error code:{0}"
+          .format(status))
+      raise ServerException(
+          "Fatal Server Exception Detected. HTTP Error code:{0}".format(status))
+    logger.error("Failed to POST the {0} to server. url={1}, http_status={2},\
+        http_response_content={3}, local_path={4}"
+        .format(what, url, status, resp, path))
+    raise ClientException(
+        "Failed to POST the {0} to server".format(what), url=url,
+        http_status=status, http_response_content=resp, local_path=path)
+  return resp
+
+def _post_file(url, params, what, path):
+  """
+  POSTs the multipart params, see _send.
+  """
   datagen, headers = multipart_encode(params)
+  # The multipart body: the file and the form fields.
+  size = int(headers.get("Content-Length") or 0)
   try:
-    request = urllib2.Request(url, datagen, headers)
-    request.add_header("Authorization", "Basic %s" % auth_string)
     starttime = time.time()
     startptime = time.clock()
-    resp = urllib2.urlopen(request, timeout=TIMEOUT).read()
-    duration = time.time() - starttime
-    ptime = time.clock() - startptime
-    logger.debug("POSTing image done. Size: {0} Duration: {1} sec. Processing time: {2} sec."
-        .format(size, duration, ptime))
-    return resp
-  except urllib2.HTTPError as e:
-    logger.error("urllib2.HTTPError caught: {0}".format(e.code))
-    if e.code == 500:
-      logger.error("Fatal Server Exception Detected. HTTP Error code:{0}"
-          .format(e.code))
-      raise ServerException(
-          "Fatal Server Exception Detected. HTTP Error code:{0}".format(e.code))
-    logger.error("Failed to POST the media to server. url={0}, http_status={1},\
-        http_response_content={2}, local_path={3}"
-        .format(request.get_full_url(), e.code, e.read(), path))
-    raise ClientException(
-        "Failed to POST the media to server", url=request.get_full_url(),
-        http_status=e.code, http_response_content=e.read(), local_path=path)
-  except (urllib2.URLError, socket.error, socket.timeout, HTTPException) as e:
-    # URLError: server down, network down.
-    logger.error("{0} caught while POSTing the media. reason={1}, url={2}."
-        .format(type(e), str(e), url))
-    raise ClientException("{0} caught while POSTing the media.".format(type(e)),
-                          reason=str(e), url=url)
+    startdelay = limiter.thread_delay()
+    resp = _send("POST", url, datagen, headers, what, path)
+  finally:
+    for param in params.itervalues():
+      if hasattr(param, "close"):
+        param.close()
+  duration = time.time() - starttime
+  ptime = time.clock() - startptime
+  throttled = limiter.thread_delay() - startdelay
+  logger.debug("POSTing {0} done. Size: {1} bytes. Duration: {2} sec. Processing time: {3} sec. Throttled: {4} sec."
+      .format(what, size, duration, ptime, throttled))
+  return resp
+
+class _HashingReader(object):
+  """
+  Wraps a file and computes the MD5 of the bytes read through it, so the
+  file is read once to both hash and upload it. A seek starts the digest
+  over; it is only valid if the whole file was read from offset 0.
+  It has no fileno(), so the encoder reads it instead of using sendfile.
+  """
+  def __init__(self, f):
+    self._f = f
+    self.name = f.name
+    self._md5 = hashlib.md5()
+    self._valid = True
+    self._eof = False
+
+  def read(self, size=-1):
+    data = self._f.read(size)
+    self._md5.update(data)
+    if not data or size < 0:
+      self._eof = True
+    return data
+
+  def seek(self, offset, whence=0):
+    self._f.seek(offset, whence)
+    self._md5 = hashlib.md5()
+    self._valid = self._f.tell() == 0
+    self._eof = False
+
+  def tell(self):
+    return self._f.tell()
+
+  def close(self):
+    self._f.close()
+
+  def hexdigest(self):
+    """The MD5 of the file, None if it was not read in one pass."""
+    if not self._valid or not self._eof:
+      return None
+    return self._md5.hexdigest()
+
+def _post_image(path, reference, on_md5=None):
+  """
+  POSTs the image. If on_md5 is given, the file is hashed while it is sent
+  and on_md5 is called with its MD5 hex digest.
+  """
+  url = _build_url("images")
+  try:
+    f = open(path, "rb")
+  except IOError as e:
+    logger.error("File IO error: {0}".format(e))
+    raise
+  if on_md5:
+    f = _HashingReader(f)
+  params = {"file": f, "filereference": reference}
+  resp = _post_file(url, params, "media", path)
+  if on_md5:
+    on_md5(f.hexdigest())
+  return resp
 
 def _post_csv(path):
   url = _build_url("datasets")
@@ -83,37 +224,129 @@ def _post_csv(path):
   except IOError as e:
     logger.error("File IO error: {0}".format(e))
     raise
-  size = sys.getsizeof(params)
-  datagen, headers = multipart_encode(params)
+  return _post_file(url, params, "CSV file", path)
+
+def _check_existing(md5s):
+  """
+  Asks the server which of the media MD5s it already stores.
+  Returns: A dict of the stored MD5s to their file information, like the
+  response of an image POST ("file_md5", "file_size", "file_url").
+  """
+  url = _build_url("exists")
+  body = json.dumps({"file_md5s": list(md5s)})
+  resp = _send("POST", url, body, {"Content-Type": "application/json",
+                                   "Content-Length": str(len(body))},
+               "existence check")
+  return json.loads(resp).get("existing", {})
+
+def _chunk_url(action, **query):
+  return "%s?%s" % (_build_url("chunks/" + action), urllib.urlencode(query))
+
+def _hash_range(f, md5, start, end):
+  """Updates md5 with the bytes of f from start to end."""
+  f.seek(start)
+  while start < end:
+    data = f.read(min(CHUNK_SIZE, end - start))
+    if not data:
+      break
+    md5.update(data)
+    start += len(data)
+  return start
+
+def _post_image_chunked(path, reference, progress=None, on_md5=None):
+  """
+  Uploads the file in CHUNK_SIZE chunks, each with its MD5 checked by the
+  server, so that a failure only resends the chunk that failed.
+  An upload resumes from the offset acknowledged by the server: the upload
+  session is looked up in progress (see Connection) and the server is asked
+  for its offset.
+  If on_md5 is given, it is called with the MD5 of the file, computed from
+  the chunks sent. Only the part sent by an earlier attempt is read again.
+  Returns: The response of the finished upload, as _post_image does.
+  """
   try:
-    request = urllib2.Request(url, datagen, headers)
-    request.add_header("Authorization", "Basic %s" % auth_string)
-    starttime = time.time()
-    startptime = time.clock()
-    resp = urllib2.urlopen(request, timeout=TIMEOUT).read()    
-    duration = time.time() - starttime
-    ptime = time.clock() - startptime
-    logger.debug("POSTing CSV file done. Size: {0} Duration: {1} sec. Processing time: {2} sec."
-        .format(size, duration, ptime))
-    return resp
-  except urllib2.HTTPError as e:
-    logger.debug("urllib2.HTTPError caught: {0}".format(e.code))
-    if e.code == 500:
-      logger.error("Fatal Server Exception Detected. HTTP Error code:{0}"
-          .format(e.code))
-      raise ServerException(
-          "Fatal Server Exception Detected. HTTP Error code:{0}".format(e.code))
-    logger.error("Failed to POST the media to server. url={0}, http_status={1},\
-        http_response_content={2}, local_path={3}"
-        .format(request.get_full_url(), e.code, e.read(), path))
-    raise ClientException(
-        "Failed to POST the CSV file to server", url=request.get_full_url(),
-        http_status=e.code, http_response_content=e.read())
-  except (urllib2.URLError, socket.error, socket.timeout, HTTPException) as e:
-    logger.error("{0} caught while POSTing the media. reason={1}, url={2}."
-        .format(type(e), str(e), url))
-    raise ClientException("{0} caught while POSTing the CSV file.".format(type(e)),
-                          reason=str(e), url=url)
+    f = open(path, "rb")
+  except IOError as e:
+    logger.error("File IO error: {0}".format(e))
+    raise
+  with f:
+    st = os.fstat(f.fileno())
+    upload_id = None
+    saved = progress and progress.get_chunk_progress(path, st)
+    if saved:
+      upload_id = saved[0]
+      try:
+        status = json.loads(_send("GET", _chunk_url("status",
+            upload_id=upload_id), None, {}, "chunk status", path))
+        offset = int(status["offset"])
+        logger.info("Resuming the upload of {0} from {1} bytes.".format(
+            path, offset))
+      except ClientException as e:
+        if e.http_status != 404:
+          raise
+        upload_id = None # The server forgot it, start over.
+    if upload_id is None:
+      start = json.loads(_send("POST", _chunk_url(
+          "start", filereference=reference, file_name=os.path.basename(path),
+          file_size=st.st_size), None, {"Content-Length": "0"}, "chunk start",
+          path))
+      upload_id = start["upload_id"]
+      offset = int(start["offset"])
+    if progress:
+      progress.save_chunk_progress(path, st, upload_id, offset)
+
+    conflicts = 0
+    md5 = hashlib.md5()
+    hashed = 0 # The bytes of the file in md5.
+    while offset < st.st_size:
+      if on_md5 and hashed != offset:
+        if hashed > offset:
+          md5 = hashlib.md5()
+          hashed = 0
+        hashed = _hash_range(f, md5, hashed, offset)
+      f.seek(offset)
+      data = f.read(CHUNK_SIZE)
+      if not data:
+        raise IOError("File {0} shrank during the upload.".format(path))
+      chunk_md5 = hashlib.md5(data).hexdigest()
+      try:
+        resp = _send("POST", _chunk_url(
+            "chunk", upload_id=upload_id, offset=offset, chunk_md5=chunk_md5),
+            data, {"Content-Type": "application/octet-stream",
+                   "Content-Length": str(len(data))}, "media chunk", path)
+      except ClientException as e:
+        # 409: the chunk was not taken (wrong offset or checksum), the server
+        # returns the offset it expects.
+        conflicts += 1
+        if e.http_status != 409 or conflicts > CHUNK_CONFLICTS:
+          raise
+        resp = e.http_response_content
+      else:
+        conflicts = 0
+      new_offset = int(json.loads(resp)["offset"])
+      if on_md5 and hashed == offset and new_offset == offset + len(data):
+        md5.update(data)
+        hashed = new_offset
+      offset = new_offset
+      if progress:
+        progress.save_chunk_progress(path, st, upload_id, offset)
+
+    resp = _send("POST", _chunk_url("finish", upload_id=upload_id), None,
+                 {"Content-Length": "0"}, "chunk finish", path)
+    if on_md5:
+      hashed = _hash_range(f, md5, hashed, st.st_size)
+      on_md5(md5.hexdigest() if hashed == st.st_size else None)
+  if progress:
+    progress.clear_chunk_progress(path)
+  logger.debug("Chunked upload of {0} done, {1} bytes.".format(
+      path, st.st_size))
+  return resp
+
+def _is_timeout(e):
+  """True if the network error e is a timeout."""
+  if isinstance(e, urllib2.URLError) and not isinstance(e, urllib2.HTTPError):
+    e = e.reason
+  return isinstance(e, socket.timeout) or "timed out" in str(e)
 
 auth_string = None
 
@@ -164,9 +397,10 @@ def authenticate(user, key):
 
 class ClientException(Exception):
   def __init__(self, msg, url='', http_status=None, reason='', local_path='',
-         http_response_content=''):
+         http_response_content='', timeout=False):
     Exception.__init__(self, msg)
     self.msg = msg
+    self.timeout = timeout
     self.url = url
     self.http_status = http_status
     self.reason = reason
@@ -217,12 +451,25 @@ class ServerException(Exception):
     return self.msg + str(self.http_status)
 
 
+def is_retryable(err):
+  """
+  True if a request that failed with err (a ClientException or a
+  ServerException) may succeed later: a network error, a request timeout or a
+  server error.
+  """
+  if isinstance(err, ServerException):
+    return True
+  status = err.http_status
+  return status is None or status == 408 or 500 <= status <= 599
+
+
 class Connection(object):
   """Convenience class to make requests that will also retry the request"""
 
   def __init__(self, authurl=None, user=None, key=None, retries=4,
                preauthurl=None, preauthtoken=None, snet=False,
-               starting_backoff=1, auth_version="1"):
+               starting_backoff=1, auth_version="1", monitor=None,
+               progress=None):
     """
     Params:
       authurl: authenitcation URL
@@ -233,6 +480,14 @@ class Connection(object):
       preauthtoken: authentication token (if you have already authenticated)
       snet: use SERVICENET internal network default is False
       auth_version: Openstack auth version.
+      monitor: Optional object whose record(duration, size, ok, timeout) is
+               called after each image POST attempt, e.g. an AIMDController.
+      progress: Optional store of the chunked upload progress, with
+                get_chunk_progress(path, st), save_chunk_progress(path, st,
+                upload_id, offset) and clear_chunk_progress(path), e.g. the
+                model module.
+    After post_image with hash_stream, stream_md5 is the MD5 of the file
+    computed while it was sent.
     """
     self.authurl = authurl
     self.user = user
@@ -245,6 +500,9 @@ class Connection(object):
     self.snet = snet
     self.starting_backoff = starting_backoff
     self.auth_version = auth_version
+    self.monitor = monitor
+    self.progress = progress
+    self.stream_md5 = None
 
   def _retry(self, reset_func, func, *args, **kwargs):
     self.attempts = 0
@@ -266,13 +524,7 @@ class Connection(object):
         if err.http_status == 401: # Unauthorized
           if self.attempts > 1:
             raise
-        elif err.http_status == 408: # Request Timeout
-          pass
-        elif 500 <= err.http_status <= 599:
-          pass
-        elif err.http_status is None:
-          pass
-        else:
+        elif not is_retryable(err):
           raise
 
       sleep(backoff)
@@ -280,8 +532,56 @@ class Connection(object):
       if reset_func:
         reset_func(func, *args, **kwargs)
 
-  def post_image(self, path, reference):
-    return self._retry(None, _post_image, path, reference)
+  def _monitored(self, func, path, *args):
+    """
+    Calls func and reports its latency and result to the monitor. The time
+    spent in the rate limiter is not part of the latency, so throttling is
+    not mistaken for a congested link.
+    """
+    try:
+      size = os.path.getsize(path)
+    except OSError:
+      size = 0
+    starttime = time.time() + limiter.thread_delay()
+    def _latency():
+      return time.time() - starttime - limiter.thread_delay()
+    try:
+      rv = func(path, *args)
+    except ClientException as err:
+      self.monitor.record(_latency(), 0, False, err.timeout)
+      raise
+    except ServerException:
+      self.monitor.record(_latency(), 0, False)
+      raise
+    self.monitor.record(_latency(), size, True)
+    return rv
+
+  def _set_stream_md5(self, md5):
+    self.stream_md5 = md5
+
+  def _post_image(self, path, reference, hash_stream=False):
+    self.stream_md5 = None
+    on_md5 = self._set_stream_md5 if hash_stream else None
+    try:
+      chunked = os.path.getsize(path) >= CHUNKED_THRESHOLD
+    except OSError:
+      chunked = False
+    if chunked:
+      return _post_image_chunked(path, reference, self.progress, on_md5)
+    return _post_image(path, reference, on_md5)
+
+  def post_image(self, path, reference, hash_stream=False):
+    """
+    POSTs the image. With hash_stream, the MD5 of the file is computed from
+    the bytes sent and kept in stream_md5.
+    """
+    if self.monitor:
+      return self._retry(None, self._monitored, self._post_image, path,
+                         reference, hash_stream)
+    return self._retry(None, self._post_image, path, reference, hash_stream)
+
+  def check_existing(self, md5s):
+    return self._retry(None, _check_existing, md5s)
 
   def post_csv(self, path):
     return self._retry(None, _post_csv, path)
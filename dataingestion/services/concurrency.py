@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module implements an adaptive limit on the number of concurrent uploads.
+The limit grows by one after each window of successful requests and is halved
+on an error, a timeout or a sharp latency rise (AIMD, as in TCP congestion
+control).
+"""
+import logging, threading, time
+
+logger = logging.getLogger('iDigBioSvc.concurrency')
+
+"""A window whose average latency is this many times the best one is a loss."""
+LATENCY_RISE_FACTOR = 3.0
+"""The weight of a new sample in the moving averages."""
+EWMA_WEIGHT = 0.2
+
+
+class AIMDController(object):
+  """
+  Limits the number of concurrent requests and adapts the limit to the
+  measured latency, throughput and error rate.
+  The upload workers call acquire() before a request and release() after it;
+  Connection reports every request with record().
+  Params:
+    initial: The initial limit.
+    min_limit, max_limit: The bounds of the limit. max_limit should be the
+                          number of upload workers.
+    decrease_factor: The limit is multiplied by this on a loss.
+  """
+  def __init__(self, initial, min_limit=1, max_limit=32, decrease_factor=0.5):
+    self.min_limit = max(int(min_limit), 1)
+    self.max_limit = max(int(max_limit), self.min_limit)
+    self.decrease_factor = float(decrease_factor)
+    self.auto = True
+    self._limit = self._bound(initial)
+    self._active = 0
+    self._cond = threading.Condition(threading.Lock())
+
+    # Stats of the current window, one window is about `limit` requests, i.e.
+    # one round trip of every active worker.
+    self._window_count = 0
+    self._window_latency = 0.0
+    self._window_loss = False
+    self._best_latency = None
+
+    self._requests = 0
+    self._errors = 0
+    self._timeouts = 0
+    self._bytes = 0
+    self._increases = 0
+    self._decreases = 0
+    self._avg_latency = 0.0
+    self._avg_throughput = 0.0 # bytes/sec of one request
+    self._error_rate = 0.0
+    self._starttime = time.time()
+
+  def _bound(self, limit):
+    return min(max(int(limit), self.min_limit), self.max_limit)
+
+  def acquire(self):
+    """Blocks until the number of active requests is below the limit."""
+    with self._cond:
+      while self._active >= self._limit:
+        self._cond.wait()
+      self._active += 1
+
+  def release(self):
+    with self._cond:
+      self._active -= 1
+      self._cond.notify()
+
+  def get_limit(self):
+    with self._cond:
+      return self._limit
+
+  def set_limit(self, limit, auto=False):
+    """
+    Overrides the limit. Unless auto is True, the limit is kept fixed until
+    the next call.
+    """
+    with self._cond:
+      self._limit = self._bound(limit)
+      self.auto = auto
+      self._reset_window()
+      self._cond.notify_all()
+    logger.info("Upload concurrency set to {0}, auto: {1}".format(
+        self._limit, auto))
+
+  def record(self, duration, size=0, ok=True, timeout=False):
+    """
+    Reports one request.
+    Params:
+      duration: The request latency in seconds.
+      size: The bytes sent.
+      ok: False if the request failed.
+      timeout: True if the request failed with a timeout.
+    """
+    with self._cond:
+      self._requests += 1
+      self._bytes += size
+      ok = ok and not timeout
+      if not ok:
+        self._errors += 1
+      if timeout:
+        self._timeouts += 1
+      self._avg_latency += EWMA_WEIGHT * (duration - self._avg_latency)
+      if duration > 0:
+        self._avg_throughput += EWMA_WEIGHT * (
+            size / duration - self._avg_throughput)
+      self._error_rate += EWMA_WEIGHT * ((0.0 if ok else 1.0) -
+                                         self._error_rate)
+
+      if not self.auto:
+        return
+      if not ok and not self._window_loss:
+        # Back off once per window, not once per failed request in flight.
+        self._window_loss = True
+        self._decrease("error" if not timeout else "timeout")
+        return
+      self._window_count += 1
+      self._window_latency += duration
+      if self._window_count < self._limit:
+        return
+
+      latency = self._window_latency / self._window_count
+      if self._best_latency is None or latency < self._best_latency:
+        self._best_latency = latency
+      if self._window_loss:
+        pass
+      elif latency > self._best_latency * LATENCY_RISE_FACTOR:
+        # The requests are queueing up on the link.
+        self._decrease("latency {0:.2f}s".format(latency))
+      elif self._limit < self.max_limit:
+        self._limit += 1
+        self._increases += 1
+        self._cond.notify()
+        logger.debug("Upload concurrency increased to {0}".format(self._limit))
+      self._reset_window()
+
+  def _decrease(self, reason):
+    limit = self._bound(self._limit * self.decrease_factor)
+    if limit < self._limit:
+      self._limit = limit
+      self._decreases += 1
+      logger.info("Upload concurrency decreased to {0} ({1})".format(
+          limit, reason))
+
+  def _reset_window(self):
+    self._window_count = 0
+    self._window_latency = 0.0
+    self._window_loss = False
+
+  def stats(self):
+    """Returns a dict with the limit and the measurements."""
+    with self._cond:
+      elapsed = time.time() - self._starttime
+      return dict(
+          limit=self._limit, active=self._active, auto=self.auto,
+          min_limit=self.min_limit, max_limit=self.max_limit,
+          requests=self._requests, errors=self._errors,
+          timeouts=self._timeouts, bytes=self._bytes,
+          increases=self._increases, decreases=self._decreases,
+          avg_latency=self._avg_latency, best_latency=self._best_latency,
+          avg_request_throughput=self._avg_throughput,
+          throughput=self._bytes / elapsed if elapsed > 0 else 0.0,
+          error_rate=self._error_rate)
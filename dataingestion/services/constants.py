@@ -26,6 +26,10 @@ G_DEFAULT_CSV_OUTPUT_NAME = 'media_records.csv'
 
 IMAGES_TABLENAME = 'imagesV9_0_2'
 BATCHES_TABLENAME = 'batchesV9_0_2'
+FINGERPRINTS_TABLENAME = 'fingerprintsV9_0_2'
+CHUNKED_UPLOADS_TABLENAME = 'chunkedUploadsV9_0_2'
+UPLOAD_JOBS_TABLENAME = 'uploadJobsV9_0_2'
+EXPORT_WATERMARKS_TABLENAME = 'exportWatermarksV9_0_2'
 
 IMAGE_CSV_NAME = "image.csv"
 STUB_CSV_NAME = "stub.csv"
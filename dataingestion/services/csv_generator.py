@@ -7,7 +7,7 @@
 
 import re, os, logging, csv, hashlib, threading, time
 from os.path import isdir, join, dirname, split, exists
-from dataingestion.services import user_config, constants
+from dataingestion.services import user_config, constants, hasher, model
 from dataingestion.services.ingestion_manager import IngestServiceException
 from time import sleep
 
@@ -59,6 +59,33 @@ def get_files(imagepath, recursive):
 
   return filenameset
 
+def _get_image_hashes(filenameset):
+  """
+  Returns the MD5s of the files in the order of filenameset, None for the
+  files that cannot be read.
+  The MD5s of unchanged files come from the fingerprint cache, the others are
+  hashed in the hashing pool.
+  """
+  md5s = [None] * len(filenameset)
+  stats = [None] * len(filenameset)
+  misses = []
+  for index, path in enumerate(filenameset):
+    try:
+      stats[index] = os.stat(path)
+    except OSError:
+      continue
+    md5s[index] = model.get_cached_md5(path, stats[index])
+    if md5s[index] is None:
+      misses.append(index)
+
+  missed_paths = [filenameset[index] for index in misses]
+  for index, md5 in zip(misses, hasher.md5_paths(missed_paths)):
+    md5s[index] = md5
+    if md5 is not None:
+      model.cache_md5(filenameset[index], stats[index], md5)
+  model.flush_fingerprints()
+  return md5s
+
 def get_mediaguids(guid_syntax, guid_prefix, filenameset, commonvalue):
   guidset = []
   starttime = time.time()
@@ -69,15 +96,13 @@ def get_mediaguids(guid_syntax, guid_prefix, filenameset, commonvalue):
     logger.error(status.error)
     raise IngestServiceException(status.error)
   if guid_syntax == "image_hash":
-    for index in range(len(filenameset)):
-      image_md5 = hashlib.md5()
-      with open(filenameset[index], 'rb') as mediafile:
-        while True:
-          image_binary = mediafile.read(128)
-          if not image_binary:
-            break;
-          image_md5.update(image_binary)
-      guidset.append(image_md5.hexdigest())
+    for index, image_md5 in enumerate(_get_image_hashes(filenameset)):
+      if image_md5 is None:
+        status.result = -1
+        status.error = "Cannot read file: " + filenameset[index]
+        logger.error(status.error)
+        raise IngestServiceException(status.error)
+      guidset.append(image_md5)
   elif guid_syntax == "hash":
     for index in range(len(filenameset)):
       md5value = hashlib.md5()
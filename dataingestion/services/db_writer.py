@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module implements a writer thread that applies the updates of the upload
+workers to the DB in batched transactions (group commit).
+"""
+import logging, threading, time
+from Queue import Queue, Empty
+from sys import exc_info
+
+logger = logging.getLogger('iDigBioSvc.db_writer')
+
+# Put by stop() to make the writer flush and exit.
+_STOP = object()
+
+
+class GroupCommitWriter(threading.Thread):
+  """
+  Collects update intents from any thread and applies them in one transaction
+  per batch. A batch is flushed when it has max_batch intents or when its
+  oldest intent is max_delay seconds old.
+  Params:
+    apply_func: Called with the list of intents of a batch, before commit.
+    commit_func: Commits the transaction.
+    lock: Held while a batch is applied and committed, as the DB session is
+          shared with other threads.
+    max_batch: The maximum number of intents in one transaction.
+    max_delay: The maximum seconds an intent waits before it is committed.
+    latency: Optional histogram observing the seconds of each commit, lock
+             wait included, see metrics.
+    rollback_func: Rolls back the transaction of a batch that failed, so its
+                   half applied updates are not committed with the next one.
+  A failed batch is applied again one intent per transaction, the intents
+  that fail on their own are dropped and counted as failed in the stats.
+  """
+  def __init__(self, apply_func, commit_func, lock, max_batch=200,
+               max_delay=1.0, latency=None, rollback_func=None):
+    threading.Thread.__init__(self, name="db_writer")
+    self.daemon = True
+    self.apply_func = apply_func
+    self.commit_func = commit_func
+    self.rollback_func = rollback_func
+    self.lock = lock
+    self.max_batch = max(int(max_batch), 1)
+    self.max_delay = float(max_delay)
+    self.latency = latency
+    self.queue = Queue()
+    self.exc_infos = []
+
+    self._stats_lock = threading.Lock()
+    self._commits = 0
+    self._intents = 0
+    self._failed = 0
+    self._last_batch_size = 0
+    self._max_batch_size = 0
+    self._last_latency = 0.0
+    self._max_latency = 0.0
+    self._total_latency = 0.0
+
+  def submit(self, intent):
+    """Queues an intent. It returns immediately."""
+    self.queue.put(intent)
+
+  def stop(self):
+    """Flushes the queued intents and waits for the writer to exit."""
+    self.queue.put(_STOP)
+    self.join()
+
+  def run(self):
+    stopping = False
+    while not stopping:
+      intent = self.queue.get()
+      if intent is _STOP:
+        break
+      batch = [intent]
+      deadline = time.time() + self.max_delay
+      while len(batch) < self.max_batch:
+        timeout = deadline - time.time()
+        try:
+          if timeout <= 0:
+            intent = self.queue.get_nowait()
+          else:
+            intent = self.queue.get(True, timeout)
+        except Empty:
+          break
+        if intent is _STOP:
+          stopping = True
+          break
+        batch.append(intent)
+      self._flush(batch)
+    # Whatever was submitted before stop() is still written.
+    remaining = []
+    while True:
+      try:
+        intent = self.queue.get_nowait()
+      except Empty:
+        break
+      if intent is not _STOP:
+        remaining.append(intent)
+    if remaining:
+      self._flush(remaining)
+    logger.info("DB writer stopped: {0}".format(self.stats()))
+
+  def _flush(self, batch):
+    starttime = time.time()
+    self.lock.acquire()
+    try:
+      self.apply_func(batch)
+      self.commit_func()
+    except Exception as e:
+      logger.error("DB writer failed to commit {0} updates: {1}".format(
+          len(batch), e))
+      self.exc_infos.append(exc_info())
+      self._rollback()
+      failed = True
+    else:
+      failed = False
+    finally:
+      self.lock.release()
+    if failed:
+      if len(batch) > 1:
+        # Only the intents that fail on their own are lost.
+        for intent in batch:
+          self._flush([intent])
+      else:
+        with self._stats_lock:
+          self._failed += 1
+        logger.error("DB writer dropped the update {0!r}.".format(batch[0]))
+      return
+    latency = time.time() - starttime
+    if self.latency:
+      self.latency.observe(latency)
+    with self._stats_lock:
+      self._commits += 1
+      self._intents += len(batch)
+      self._last_batch_size = len(batch)
+      self._max_batch_size = max(self._max_batch_size, len(batch))
+      self._last_latency = latency
+      self._max_latency = max(self._max_latency, latency)
+      self._total_latency += latency
+    logger.debug("DB writer committed {0} updates in {1:.4f} sec.".format(
+        len(batch), latency))
+
+  def _rollback(self):
+    if not self.rollback_func:
+      return
+    try:
+      self.rollback_func()
+    except Exception as e:
+      logger.error("DB writer failed to roll back: {0}".format(e))
+      self.exc_infos.append(exc_info())
+
+  def stats(self):
+    """
+    Returns a dict with the number of commits, updates and failed updates,
+    and the batch
+    size and commit latency (seconds) of the last commit, the largest and the
+    average.
+    """
+    with self._stats_lock:
+      commits = self._commits
+      return dict(
+          commits=commits, updates=self._intents, failed=self._failed,
+          last_batch_size=self._last_batch_size,
+          max_batch_size=self._max_batch_size,
+          avg_batch_size=float(self._intents) / commits if commits else 0.0,
+          last_commit_latency=self._last_latency,
+          max_commit_latency=self._max_latency,
+          avg_commit_latency=self._total_latency / commits if commits else 0.0)
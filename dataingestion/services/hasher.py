@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module implements the MD5 hashing of media files.
+Files are read in large blocks, or memory-mapped when they are big, and the
+hashing can be spread over a pool of threads or processes.
+"""
+import hashlib, logging, mmap, os
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger('iDigBioSvc.hasher')
+
+BLOCK_SIZE = 2 ** 20 # 1 MB
+"""Files larger than this are memory-mapped instead of read."""
+MMAP_THRESHOLD = 2 ** 24 # 16 MB
+
+POOL_THREAD = 'thread'
+POOL_PROCESS = 'process'
+
+_pool = None
+_pool_type = POOL_THREAD
+_pool_size = 0
+
+def init(pool_size=None, pool_type=POOL_THREAD):
+  """
+  Set up the hashing pool. md5_path and md5_paths hash in it, whatever the
+  number of threads calling them.
+  Params:
+    pool_size: The number of hashing workers, i.e. the files hashed at once,
+               with either pool type. Defaults to the CPU count.
+    pool_type: POOL_THREAD or POOL_PROCESS. hashlib releases the GIL while
+               hashing large blocks, so threads already use several cores;
+               processes also take the file reading off this process.
+  """
+  global _pool, _pool_type, _pool_size
+  close()
+  if pool_type not in (POOL_THREAD, POOL_PROCESS):
+    raise ValueError("Hash pool type not supported: {0}".format(pool_type))
+  _pool_type = pool_type
+  _pool_size = int(pool_size) if pool_size else cpu_count()
+  if _pool_type == POOL_PROCESS:
+    _pool = Pool(_pool_size)
+  else:
+    _pool = ThreadPool(_pool_size)
+  print "Hash pool: %s %ss" % (_pool_size, _pool_type)
+
+def close():
+  global _pool
+  if _pool:
+    _pool.close()
+    _pool.join()
+    _pool = None
+
+def md5_file(f, block_size=BLOCK_SIZE):
+  """
+  Get MD5 of the file object.
+  Returns: A hashlib md5 object.
+  """
+  md5 = hashlib.md5()
+  while True:
+    data = f.read(block_size)
+    if not data:
+      break
+    md5.update(data)
+  return md5
+
+def _md5_path(path):
+  """Returns the MD5 hex digest of the file at path."""
+  with open(path, 'rb') as f:
+    size = os.fstat(f.fileno()).st_size
+    if size < MMAP_THRESHOLD:
+      return md5_file(f).hexdigest()
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      md5 = hashlib.md5()
+      md5.update(mapped)
+      return md5.hexdigest()
+    finally:
+      mapped.close()
+
+def _md5_path_or_none(path):
+  try:
+    return _md5_path(path)
+  except (IOError, OSError) as e:
+    logger.error("Cannot hash file {0}: {1}".format(path, e))
+    return None
+
+def md5_path(path):
+  """
+  Returns the MD5 hex digest of the file at path.
+  The file is hashed by one of the pool workers, the caller waits for it.
+  Raises IOError if the file cannot be read.
+  """
+  if _pool is not None:
+    return _pool.apply(_md5_path, (path,))
+  return _md5_path(path)
+
+def md5_paths(paths):
+  """
+  Hashes the files in the pool.
+  Returns: An iterator of the MD5 hex digests, in the order of paths. The
+  digest is None for a file that cannot be read.
+  """
+  if _pool is None:
+    return (_md5_path_or_none(path) for path in paths)
+  return _pool.imap(_md5_path_or_none, paths, 16)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module implements a pool of HTTP/1.1 keep-alive connections, so the
+uploads reuse their TCP (and TLS) connections instead of opening one per
+request.
+"""
+import httplib, logging, select, socket, threading, time, urlparse
+from poster.streaminghttp import StreamingHTTPConnection
+
+logger = logging.getLogger('iDigBioSvc.http_pool')
+
+"""Seconds a resolved address is reused."""
+DNS_TTL = 300
+
+
+class _DNSCache(object):
+  """Caches the addresses returned by getaddrinfo for DNS_TTL seconds."""
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._entries = {}
+    self.hits = 0
+    self.misses = 0
+
+  def resolve(self, host, port):
+    key = (host, port)
+    now = time.time()
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry and entry[0] > now:
+        self.hits += 1
+        return entry[1]
+      self.misses += 1
+    addrs = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    with self._lock:
+      self._entries[key] = (now + DNS_TTL, addrs)
+    return addrs
+
+  def forget(self, host, port):
+    with self._lock:
+      self._entries.pop((host, port), None)
+
+
+def _connect(dns, host, port, timeout):
+  """Like socket.create_connection, with the addresses from the DNS cache."""
+  err = None
+  for af, socktype, proto, _junk, sa in dns.resolve(host, port):
+    sock = None
+    try:
+      sock = socket.socket(af, socktype, proto)
+      sock.settimeout(timeout)
+      sock.connect(sa)
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      return sock
+    except socket.error as e:
+      err = e
+      if sock is not None:
+        sock.close()
+  # The cached address may be stale.
+  dns.forget(host, port)
+  if err is not None:
+    raise err
+  raise socket.error("getaddrinfo returns an empty list")
+
+
+class PooledHTTPConnection(StreamingHTTPConnection):
+  """A streaming HTTP connection that resolves the host through the cache."""
+  def __init__(self, host, port, timeout, dns):
+    StreamingHTTPConnection.__init__(self, host, port, timeout=timeout)
+    self.dns = dns
+
+  def connect(self):
+    self.sock = _connect(self.dns, self.host, self.port, self.timeout)
+
+
+if hasattr(httplib, 'HTTPS'):
+  import ssl
+  from poster.streaminghttp import StreamingHTTPSConnection
+
+  class PooledHTTPSConnection(StreamingHTTPSConnection):
+    """A streaming HTTPS connection that resolves the host through the cache."""
+    def __init__(self, host, port, timeout, dns):
+      StreamingHTTPSConnection.__init__(self, host, port, timeout=timeout)
+      self.dns = dns
+
+    def connect(self):
+      sock = _connect(self.dns, self.host, self.port, self.timeout)
+      self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file)
+
+
+class StallTimeout(socket.timeout):
+  """No bytes moved for the stall timeout of the request."""
+
+class RequestTimeout(socket.timeout):
+  """The request took longer than its total timeout."""
+
+
+class _Progress(object):
+  """
+  Called with the size of each block sent. It throttles the block, then
+  fails the request once it is past its deadline. The time spent in the
+  throttle does not count.
+  """
+  def __init__(self, throttle, total_timeout):
+    self.throttle = throttle
+    self.total_timeout = total_timeout
+    self.deadline = time.time() + total_timeout
+    self.throttled = 0.0
+
+  def __call__(self, nbytes):
+    if self.throttle:
+      starttime = time.time()
+      self.throttle(nbytes)
+      self.throttled += time.time() - starttime
+    if self.remaining() < 0:
+      raise RequestTimeout(
+          "timed out after {0:.1f} sec".format(self.total_timeout))
+
+  def remaining(self):
+    return self.deadline + self.throttled - time.time()
+
+
+def _is_dead(conn):
+  """
+  An idle keep-alive connection has nothing to read. If it is readable, the
+  server closed it (EOF) or sent something unexpected, so it is not reused.
+  """
+  if conn.sock is None:
+    return True
+  try:
+    readable, _junk, _junk = select.select([conn.sock], [], [], 0)
+  except (select.error, socket.error, ValueError):
+    return True
+  return bool(readable)
+
+
+class HTTPConnectionPool(object):
+  """
+  Keeps up to maxsize idle keep-alive connections per (scheme, host, port).
+  Thread safe, a connection is used by one request at a time.
+  throttle, if given, is called with the size of each block before it is
+  sent, see RateLimiter.consume. allowance, if given, returns the bytes the
+  throttle lets through now, the file bodies are sent with sendfile calls of
+  that size, see RateLimiter.allowance.
+  """
+  def __init__(self, maxsize=10, throttle=None, allowance=None):
+    self.maxsize = maxsize
+    self.throttle = throttle
+    self.allowance = allowance
+    self.dns = _DNSCache()
+    self._lock = threading.Lock()
+    self._idle = {}
+    self._starttime = time.time()
+    self._requests = 0
+    self._connects = 0
+    self._reuses = 0
+    self._dead = 0
+    self._retries = 0
+    self._stalls = 0
+    self._timeouts = 0
+
+  def _get(self, key, timeout):
+    with self._lock:
+      idle = self._idle.get(key, [])
+      while idle:
+        conn = idle.pop()
+        if _is_dead(conn):
+          self._dead += 1
+          conn.close()
+          continue
+        self._reuses += 1
+        conn.timeout = timeout
+        conn.sock.settimeout(timeout)
+        return conn, True
+      self._connects += 1
+    scheme, host, port = key
+    if scheme == "https":
+      conn = PooledHTTPSConnection(host, port, timeout, self.dns)
+    else:
+      conn = PooledHTTPConnection(host, port, timeout, self.dns)
+    conn.throttle = self.throttle
+    conn.allowance = self.allowance
+    return conn, False
+
+  def _put(self, key, conn):
+    with self._lock:
+      idle = self._idle.setdefault(key, [])
+      if len(idle) < self.maxsize:
+        idle.append(conn)
+        return
+    conn.close()
+
+  def clear(self):
+    """Closes all the idle connections."""
+    with self._lock:
+      idle, self._idle = self._idle, {}
+    for conns in idle.itervalues():
+      for conn in conns:
+        conn.close()
+
+  def _timed_out(self, err, sending, total_timeout):
+    """Counts a timeout, and tells a stall from a request timeout."""
+    with self._lock:
+      if isinstance(err, RequestTimeout) or (total_timeout and not sending):
+        self._timeouts += 1
+        if isinstance(err, RequestTimeout):
+          return err
+        return RequestTimeout(
+            "timed out after {0:.1f} sec".format(total_timeout))
+      self._stalls += 1
+      return StallTimeout("no progress: {0}".format(err))
+
+  def request(self, method, url, body=None, headers=None, timeout=None,
+              total_timeout=None):
+    """
+    Sends a request over a pooled connection and reads the whole response.
+    A request that fails on a reused connection before any response is
+    received is retried once on a new connection, as the server may have
+    closed the idle connection meanwhile.
+    Params:
+      timeout: The seconds a connect or a send may make no progress.
+      total_timeout: If set, the seconds the request may take, not counting
+                     the throttle. The wait for the response, while the server
+                     processes the body, gets what is left of it, at least
+                     timeout.
+    Returns: (status, reason, response body).
+    Raises socket.error, httplib.HTTPException, StallTimeout if the bytes
+    stopped moving, or RequestTimeout.
+    """
+    parts = urlparse.urlsplit(url)
+    scheme = parts.scheme or "http"
+    port = parts.port or (443 if scheme == "https" else 80)
+    key = (scheme, parts.hostname, port)
+    path = parts.path or "/"
+    if parts.query:
+      path += "?" + parts.query
+    with self._lock:
+      self._requests += 1
+
+    while True:
+      conn, reused = self._get(key, timeout)
+      progress = None
+      if total_timeout:
+        progress = _Progress(self.throttle, total_timeout)
+        conn.throttle = progress
+      sending = True
+      try:
+        conn.request(method, path, body, headers or {})
+        sending = False
+        if progress and conn.sock is not None:
+          conn.sock.settimeout(max(timeout, progress.remaining()))
+        resp = conn.getresponse()
+      except (socket.error, httplib.HTTPException) as e:
+        conn.close()
+        if isinstance(e, socket.timeout):
+          raise self._timed_out(e, sending, total_timeout)
+        if not reused:
+          raise
+        with self._lock:
+          self._retries += 1
+        logger.debug("Stale pooled connection to {0}, retrying.".format(key))
+        continue
+      try:
+        data = resp.read()
+      except:
+        conn.close()
+        raise
+      finally:
+        conn.throttle = self.throttle
+      if resp.will_close:
+        conn.close()
+      else:
+        self._put(key, conn)
+      return resp.status, resp.reason, data
+
+  def stats(self):
+    """Returns the request, connect and reuse counts and rates."""
+    with self._lock:
+      elapsed = time.time() - self._starttime
+      idle = sum(len(conns) for conns in self._idle.itervalues())
+      attempts = self._connects + self._reuses
+      return dict(
+          maxsize=self.maxsize, idle=idle, requests=self._requests,
+          connects=self._connects, reuses=self._reuses,
+          dead_discarded=self._dead, stale_retries=self._retries,
+          stalls=self._stalls, timeouts=self._timeouts,
+          reuse_ratio=float(self._reuses) / attempts if attempts else 0.0,
+          connects_per_sec=self._connects / elapsed if elapsed > 0 else 0.0,
+          dns_hits=self.dns.hits, dns_misses=self.dns.misses)
@@ -9,20 +9,30 @@
 This module implements the core logic that manages the upload process.
 """
 import os, logging, argparse, tempfile, atexit, cherrypy, csv, json, tempfile
-import hashlib, threading
+import hashlib, itertools, threading, time
 from functools import partial
 from datetime import datetime
-from Queue import Empty, Queue
-from threading import enumerate as threading_enumerate, Thread
-from time import sleep
-from sys import exc_info
+from Queue import Queue
+from threading import Thread
+from sys import exc_info, platform
 from os.path import join
 from traceback import format_exception
 from errno import ENOENT
 from dataingestion.services.api_client import (ClientException, Connection,
                                                ServerException)
-from dataingestion.services import model, user_config, constants
+from dataingestion.services import (model, user_config, constants, hasher,
+                                    api_client, metrics)
+from dataingestion.services.model import UploadJob
+from dataingestion.services.pipeline import Pipeline, Stage
+from dataingestion.services.db_writer import GroupCommitWriter
+from dataingestion.services.concurrency import AIMDController
+from dataingestion.services.retry_scheduler import (CircuitBreaker,
+                                                    RetryScheduler)
 import ast
+try:
+  import resource
+except ImportError: # Windows.
+  resource = None
 
 logger = logging.getLogger('iDigBioSvc.ingestion_manager')
 
@@ -30,7 +40,19 @@ ongoing_upload_task = None
 fatal_server_error = False 
 input_csv_error = False 
 
-worker_thread_count = 10 # init
+worker_thread_count = 10 # init, the initial upload concurrency
+max_worker_thread_count = 32 # init, the upload concurrency upper bound
+hash_thread_count = 4 # init
+stage_queue_size = 100 # init
+commit_batch_size = 200 # init
+commit_interval = 1.0 # init, in seconds
+dedupe_batch_size = 500 # records per bulk DB dedupe
+exists_batch_size = 200 # init, MD5s per server existence check, 0 disables
+hash_before_upload = True # init, False hashes the files while uploading them
+progress_min_interval = 0.25 # seconds between two events of a progress stream
+progress_wait = 25 # seconds a progress long poll waits for a change
+server_give_up_time = 600 # seconds the server may be unhealthy before the
+                          # batch is stopped
 
 class IngestServiceException(Exception):
   def __init__(self, msg, reason=''):
@@ -42,10 +64,59 @@ class InputCSVException(Exception):
     Exception.__init__(self, msg)
     self.reason = reason
 
-def init(wtc):
-  global worker_thread_count
-  worker_thread_count = wtc
-  print "Worker threads: %s" % worker_thread_count
+"""Adapts the number of concurrent uploads, see concurrency."""
+upload_controller = AIMDController(worker_thread_count, 1,
+                                   max_worker_thread_count)
+"""Pauses the uploads while the server fails, see retry_scheduler."""
+upload_breaker = CircuitBreaker()
+
+# The metrics of the uploads since the service started, see get_metrics.
+stage_latency = metrics.registry.histogram(
+    "idigbio_stage_seconds", "Seconds per call of a pipeline stage: per item, "
+    "or per batch for the dedupe and exists stages.", ("stage",))
+commit_latency = metrics.registry.histogram(
+    "idigbio_db_commit_seconds",
+    "Seconds per group commit of the upload results.")
+upload_latency = metrics.registry.histogram(
+    "idigbio_upload_request_seconds", "Seconds per image POST.")
+images_total = metrics.registry.counter(
+    "idigbio_images_total", "Images processed, by outcome.", ("outcome",))
+upload_bytes_total = metrics.registry.counter(
+    "idigbio_upload_bytes_total", "Bytes of the image files uploaded.")
+upload_retries_total = metrics.registry.counter(
+    "idigbio_upload_retries_total", "Image uploads scheduled for a retry.")
+"""The recent upload rates, over the last minute."""
+images_meter = metrics.Meter(60)
+bytes_meter = metrics.Meter(60)
+
+def init(wtc, htc=None, qsize=None, cbsize=None, cinterval=None,
+         max_wtc=None, ebsize=None, hash_first=None):
+  global worker_thread_count, hash_thread_count, stage_queue_size
+  global commit_batch_size, commit_interval, max_worker_thread_count
+  global upload_controller, exists_batch_size, hash_before_upload
+  worker_thread_count = int(wtc)
+  if max_wtc:
+    max_worker_thread_count = int(max_wtc)
+  max_worker_thread_count = max(max_worker_thread_count, worker_thread_count)
+  upload_controller = AIMDController(worker_thread_count, 1,
+                                     max_worker_thread_count)
+  # One keep-alive connection per upload worker, plus one for the CSV.
+  api_client.set_pool_size(max_worker_thread_count + 1)
+  if htc:
+    hash_thread_count = int(htc)
+  if qsize:
+    stage_queue_size = int(qsize)
+  if cbsize:
+    commit_batch_size = int(cbsize)
+  if cinterval:
+    commit_interval = float(cinterval)
+  if ebsize is not None and ebsize != "":
+    exists_batch_size = int(ebsize)
+  if hash_first:
+    hash_before_upload = hash_first.strip().lower() not in ("false", "no", "0")
+  print "Worker threads: %s (max %s)" % (worker_thread_count,
+                                        max_worker_thread_count)
+  print "Hash threads: %s" % hash_thread_count
 
 def _get_conn():
   """
@@ -53,6 +124,99 @@ def _get_conn():
   """
   return Connection()
 
+def get_concurrency():
+  """Returns the upload concurrency limit and its measurements."""
+  return upload_controller.stats()
+
+def set_concurrency(limit, auto=False):
+  """
+  Overrides the upload concurrency limit. It stays fixed unless auto is True,
+  in which case the controller adapts it again from the new value.
+  """
+  upload_controller.set_limit(limit, auto)
+
+def _memory_kb():
+  """
+  Returns the current and the peak resident memory of the process in KB,
+  None where it is unknown.
+  """
+  current = peak = None
+  try:
+    with open("/proc/self/statm") as f:
+      current = int(f.read().split()[1]) * (os.sysconf("SC_PAGE_SIZE") // 1024)
+  except (IOError, OSError, ValueError, AttributeError):
+    pass
+  if resource is not None:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform == "darwin": # In bytes on Mac OS.
+      peak //= 1024
+  return current, peak
+
+def get_pipeline_stats():
+  """
+  Returns the current and peak queue depths of the stages of the ongoing (or
+  last) upload, its retries and circuit breaker, and the memory of the
+  process.
+  """
+  task = ongoing_upload_task
+  pipeline = task.pipeline if task else None
+  retries = task.retries if task else None
+  memory, peak_memory = _memory_kb()
+  return dict(stages=pipeline.stats() if pipeline else [],
+              retries=retries.stats() if retries else None,
+              breaker=upload_breaker.stats(),
+              memory_kb=memory, peak_memory_kb=peak_memory)
+
+def _stage_values(key):
+  """The key of the stats of each stage of the ongoing (or last) task."""
+  task = ongoing_upload_task
+  if not task or not task.pipeline:
+    return {}
+  return dict((stage["name"], stage[key]) for stage in task.pipeline.stats())
+
+def _retries_pending():
+  task = ongoing_upload_task
+  return task.retries.pending() if task and task.retries else 0
+
+def _memory_bytes():
+  memory = _memory_kb()[0]
+  return memory * 1024 if memory is not None else None
+
+metrics.registry.gauge(
+    "idigbio_upload_images_per_second",
+    "Images uploaded per second, over the last minute.", images_meter.rate)
+metrics.registry.gauge(
+    "idigbio_upload_bytes_per_second",
+    "Bytes uploaded per second, over the last minute.", bytes_meter.rate)
+metrics.registry.gauge(
+    "idigbio_stage_queue_depth", "Items waiting in the queue of a stage.",
+    partial(_stage_values, "depth"), ("stage",))
+metrics.registry.gauge(
+    "idigbio_stage_active_workers", "Workers of a stage processing an item.",
+    partial(_stage_values, "active"), ("stage",))
+metrics.registry.gauge(
+    "idigbio_upload_concurrency_limit", "Uploads allowed at a time.",
+    lambda: upload_controller.get_limit())
+metrics.registry.gauge(
+    "idigbio_upload_retries_pending", "Image uploads waiting for a retry.",
+    _retries_pending)
+metrics.registry.gauge(
+    "idigbio_upload_breaker_open",
+    "1 while the uploads are paused as the server fails.",
+    lambda: int(upload_breaker.get_state() != CircuitBreaker.CLOSED))
+metrics.registry.gauge(
+    "idigbio_resident_memory_bytes", "Resident memory of the service.",
+    _memory_bytes)
+
+def get_metrics(prometheus=False):
+  """
+  Returns the metrics of the uploads as a dict, or as a string in the
+  Prometheus text format.
+  """
+  if prometheus:
+    return metrics.registry.to_prometheus()
+  return metrics.registry.to_dict()
+
 def _put_errors_from_threads(threads):
   """
   Places any errors from the threads into error_queue.
@@ -72,16 +236,21 @@ def _put_errors_from_threads(threads):
         raise IngestServiceException("Task failed for unkown reason.")
   return was_error
 
+# Put by QueueFunctionThread.stop() and abort_thread() to wake the thread up.
+_STOP = object()
+
 class QueueFunctionThread(Thread):
 
   def __init__(self, queue, func, *args, **kwargs):
     """
     Calls func for each item in queue; func is called with a queued
-    item as the first arg followed by *args and **kwargs. Use the abort
-    attribute to have the thread empty the queue (without processing)
-    and exit.
+    item as the first arg followed by *args and **kwargs. The thread blocks
+    on the queue while it is empty. Use stop() to have the thread exit once
+    the items queued before are processed, abort_thread() to have it empty
+    the queue (without processing) and exit.
     """
     Thread.__init__(self)
+    self.daemon = True
     self.abort = False
     self.queue = queue
     self.func = func
@@ -92,15 +261,12 @@ class QueueFunctionThread(Thread):
   def run(self):
     global fatal_server_error
     while True:
+      item = self.queue.get()
       try:
-        item = self.queue.get_nowait()
+        if item is _STOP:
+          break
         if not self.abort:
           self.func(item, *self.args, **self.kwargs)
-        self.queue.task_done()
-      except Empty:
-        if self.abort:
-          break
-        sleep(0.01)
       except ServerException as e: 
         logger.error("Fatal Server Error Detected") 
         fatal_server_error = True
@@ -108,12 +274,85 @@ class QueueFunctionThread(Thread):
         logger.error("Exception caught in a QueueFunctionThread:".format(ex))
         self.exc_infos.append(exc_info())
         logger.debug("Thread exiting...")
+      finally:
+        self.queue.task_done()
+
+  def stop(self):
+    """Processes the items already queued, then waits for the thread to exit."""
+    self.queue.put(_STOP)
+    self.join()
 
   def abort_thread(self):
     self.abort = True
+    self.queue.put(_STOP)
 
 batch_attr_lock = threading.Lock()
 batch_check_lock = threading.Lock()
+
+class ProgressCounters(object):
+  """
+  The counts of a batch upload task, in one list under one lock. The workers
+  update it directly and the readers take a consistent snapshot.
+  Each change bumps the version, which wait() blocks on.
+  """
+  TOTAL, SKIPS, SUCCESSES, FAILS, BYTES, UPLOAD_SECONDS = range(6)
+  NAMES = ("total", "skips", "successes", "fails", "bytes", "upload_seconds")
+  __slots__ = ("_cond", "_values", "_version")
+
+  def __init__(self):
+    self._cond = threading.Condition(threading.Lock())
+    self._values = [0, 0, 0, 0, 0, 0.0]
+    self._version = 0
+
+  def add(self, index, amount=1):
+    with self._cond:
+      self._values[index] += amount
+      self._version += 1
+      self._cond.notify_all()
+
+  def add_upload(self, nbytes, seconds):
+    """Counts the bytes of an uploaded file and the seconds its POST took."""
+    with self._cond:
+      self._values[self.BYTES] += nbytes
+      self._values[self.UPLOAD_SECONDS] += seconds
+      self._version += 1
+      self._cond.notify_all()
+
+  def touch(self):
+    """Wakes up the waiters, e.g. when the status of the task changes."""
+    with self._cond:
+      self._version += 1
+      self._cond.notify_all()
+
+  def get(self, index):
+    with self._cond:
+      return self._values[index]
+
+  def snapshot(self):
+    """Returns the counts, in the order of NAMES."""
+    with self._cond:
+      return list(self._values)
+
+  def version(self):
+    with self._cond:
+      return self._version
+
+  def wait(self, version, timeout):
+    """
+    Blocks until the version differs from the given one, at most timeout
+    seconds. Returns the current version.
+    """
+    deadline = time.time() + timeout
+    with self._cond:
+      while self._version == version:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        self._cond.wait(remaining)
+      return self._version
+
+_task_ids = itertools.count(1)
+
 class BatchUploadTask:
   """
   State about a single batch upload task.
@@ -125,48 +364,53 @@ class BatchUploadTask:
 
   def __init__(self, batch=None, max_continuous_fails=1000):
     self.batch = batch
-    self.object_queue = Queue() # Thread safe object in python.
-    self.postprocess_queue = Queue() # Thread safe object in python.
+    self.pipeline = None
+    self.writer = None
+    self.retries = None
+    self.task_id = next(_task_ids)
+    self.counters = ProgressCounters()
     self.error_queue = Queue() # Thread safe object in python.
+    # Set once the first item is counted or the task is finished.
+    self.started = threading.Event()
+    self.finished = threading.Event()
 
-    self._total_count = 0
     self._status = None
     self._error_msg = None
-    self._successes = 0
-    self._skips = 0
-    self._fails = 0
     self._continuous_fails = 0
     self._max_continuous_fails = max_continuous_fails
     self._csv_uploaded = False
+    # Cleared if the server has no existence check.
+    self.exists_check = exists_batch_size > 0
 
   def not_started(self):
-    batch_attr_lock.acquire()
-    not_started = (self._total_count == 0 and self._status != self.STATUS_FINISHED)
-    batch_attr_lock.release()
-    return not_started
+    return not self.started.is_set()
 
-  def get_all_information(self):
+  def snapshot(self):
+    """
+    Returns the counts, in the order of ProgressCounters.NAMES, the CSV
+    uploaded flag and the status, all taken under batch_attr_lock so the
+    status cannot change in between.
+    """
     batch_attr_lock.acquire()
-    total = self._total_count
-    skips = self._skips
-    successes = self._successes
-    fails = self._fails
-    csv = self._csv_uploaded
-    status = self._status
-    batch_attr_lock.release()
+    try:
+      return self.counters.snapshot(), self._csv_uploaded, self._status
+    finally:
+      batch_attr_lock.release()
 
+  def get_all_information(self):
+    values, csv, status = self.snapshot()
+    total, skips, successes, fails = values[:4]
     return total, skips, successes, fails, csv, status
 
   def is_finished(self):
-    batch_attr_lock.acquire()
-    finished = (self._skips + self._successes + self._fails == self._total_count)
-    batch_attr_lock.release()
-    return finished
+    total, skips, successes, fails = self.counters.snapshot()[:4]
+    return skips + successes + fails == total
 
   def set_csv_uploaded(self):
     batch_attr_lock.acquire()
     self._csv_uploaded = True
     batch_attr_lock.release()
+    self.counters.touch()
 
   def csv_uploaded(self):
     batch_attr_lock.acquire()
@@ -175,28 +419,16 @@ class BatchUploadTask:
     return ret
 
   def get_skips(self):
-    batch_attr_lock.acquire()
-    count = self._skips
-    batch_attr_lock.release()
-    return count
+    return self.counters.get(ProgressCounters.SKIPS)
 
   def get_fails(self):
-    batch_attr_lock.acquire()
-    count = self._fails
-    batch_attr_lock.release()
-    return count
+    return self.counters.get(ProgressCounters.FAILS)
 
   def get_successes(self):
-    batch_attr_lock.acquire()
-    count = self._successes
-    batch_attr_lock.release()
-    return count
+    return self.counters.get(ProgressCounters.SUCCESSES)
 
   def get_total_count(self):
-    batch_attr_lock.acquire()
-    count = self._total_count
-    batch_attr_lock.release()
-    return count
+    return self.counters.get(ProgressCounters.TOTAL)
 
   def get_status(self):
     batch_attr_lock.acquire()
@@ -208,21 +440,33 @@ class BatchUploadTask:
     batch_attr_lock.acquire()
     self._status = status
     batch_attr_lock.release()
+    if status == self.STATUS_FINISHED:
+      self.started.set()
+      self.finished.set()
+    self.counters.touch()
+
+  # The outcome label of idigbio_images_total, by ProgressCounters index.
+  _OUTCOMES = {ProgressCounters.SKIPS: "skipped",
+               ProgressCounters.SUCCESSES: "uploaded",
+               ProgressCounters.FAILS: "failed"}
+
+  # Increment a counter, one of the ProgressCounters indexes, by 1.
+  def increment(self, index):
+    self.counters.add(index)
+    if index == ProgressCounters.TOTAL:
+      if not self.started.is_set():
+        self.started.set()
+    else:
+      images_total.inc(outcome=self._OUTCOMES[index])
+      if index == ProgressCounters.SUCCESSES:
+        images_meter.mark()
 
-  # Increment a field's value by 1.
-  def increment(self, field_name_orig):
-    batch_attr_lock.acquire()
-    field_name = "_" + field_name_orig
-    try:
-      if hasattr(self, field_name) and type(getattr(self, field_name)) == int:
-        setattr(self, field_name, getattr(self, field_name) + 1)
-      else:
-        logger.error("BatchUploadTask object doesn't have this field or " +
-            "has a field that cannot be incremented: {0}".format(field_name))
-        raise ValueError("BatchUploadTask object doesn't have this field or " +
-            "has a field that cannot be incremented: {0}".format(field_name))
-    finally:
-      batch_attr_lock.release()
+  def count_upload(self, nbytes, seconds):
+    """Counts an image POST of nbytes that took seconds."""
+    self.counters.add_upload(nbytes, seconds)
+    upload_latency.observe(seconds)
+    upload_bytes_total.inc(nbytes)
+    bytes_meter.mark(nbytes)
 
   # Update the continuous failure times.
   def check_continuous_fails(self, succ_this_time):
@@ -244,33 +488,135 @@ class BatchUploadTask:
     finally:
       batch_check_lock.release()
 
-def get_progress():
+# The tasks queued but not started yet, see task_queued.
+_queued_tasks = 0
+_queued_cond = threading.Condition(threading.Lock())
+"""Seconds the progress readers wait for a queued task to start."""
+TASK_START_TIMEOUT = 5
+
+def task_queued():
   """
-  Return (total items, skips, successes, fails).
+  Called when an upload task is queued. Until it starts, the progress readers
+  wait instead of reporting the last task.
+  """
+  global _queued_tasks
+  with _queued_cond:
+    _queued_tasks += 1
+
+def task_unqueued():
+  """Called when a queued upload task starts, or is not queued after all."""
+  global _queued_tasks
+  with _queued_cond:
+    _queued_tasks = max(_queued_tasks - 1, 0)
+    _queued_cond.notify_all()
+
+def _current_task():
+  """
+  Returns the ongoing (or last) task, once the queued one started.
+  Raises IngestServiceException if there is no task.
   """
+  deadline = time.time() + TASK_START_TIMEOUT
+  with _queued_cond:
+    while _queued_tasks:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        break
+      _queued_cond.wait(remaining)
   task = ongoing_upload_task
-  global fatal_server_error
-  global input_csv_error 
-
   if task is None:
     logger.error("No ongoing upload task.")
     raise IngestServiceException("No ongoing upload task.")
+  return task
 
-  while(task.not_started()):
-    sleep(0.2)
+def get_progress():
+  """
+  Return (total items, skips, successes, fails).
+  """
+  return get_progress_counters()[0]
 
-  total, skips, successes, fails, csv, status = task.get_all_information()
-  return (fatal_server_error, input_csv_error, total, skips, successes, fails,
-          csv,
-          True if status == BatchUploadTask.STATUS_FINISHED else False)
+def get_progress_counters():
+  """
+  Returns the progress tuple of get_progress and a dict of the counts, with
+  the bytes uploaded and the seconds spent in the uploads, both from one
+  snapshot of the ongoing (or last) task. A task that did not start within
+  TASK_START_TIMEOUT seconds is reported idle, with its counts still zero.
+  """
+  global fatal_server_error
+  global input_csv_error 
+
+  task = _current_task()
+  if not task.started.wait(TASK_START_TIMEOUT):
+    logger.debug("The upload task has not started yet.")
+
+  values, csv, status = task.snapshot()
+  total, skips, successes, fails = values[:4]
+  return ((fatal_server_error, input_csv_error, total, skips, successes, fails,
+           csv,
+           True if status == BatchUploadTask.STATUS_FINISHED else False),
+          dict(zip(ProgressCounters.NAMES, values)))
+
+def _progress_dict(task, version):
+  """The progress of task as sent to the UI, tagged with the version."""
+  values, csv, status = task.snapshot()
+  progress = dict(zip(ProgressCounters.NAMES, values))
+  progress.update(
+      task=task.task_id, version=version,
+      fatal_server_error=fatal_server_error, input_csv_error=input_csv_error,
+      csvuploaded=csv, finished=status == BatchUploadTask.STATUS_FINISHED)
+  return progress
+
+def wait_progress(task_id=None, version=None, timeout=None):
+  """
+  Long poll: returns the progress of the ongoing task as a dict, as soon as
+  it differs from the given version of the task with task_id, or after
+  timeout seconds (progress_wait by default). Without a task_id and version,
+  it returns at once.
+  """
+  task = _current_task()
+  if (task_id is not None and version is not None and
+      int(task_id) == task.task_id):
+    current = task.counters.wait(
+        int(version), progress_wait if timeout is None else timeout)
+  else:
+    current = task.counters.version()
+  return _progress_dict(task, current)
+
+def watch_progress(min_interval=None, heartbeat=None):
+  """
+  Returns a generator of the progress of the ongoing task for a stream: a
+  dict each time it changes, at most one per min_interval seconds so a burst
+  of changes is coalesced, or None when nothing changed for heartbeat
+  seconds. It ends after the event of the finished task.
+  """
+  task = _current_task()
+  if min_interval is None:
+    min_interval = progress_min_interval
+  if heartbeat is None:
+    heartbeat = progress_wait
+  def _watch():
+    version = None
+    while True:
+      if version is None:
+        current = task.counters.version()
+      else:
+        current = task.counters.wait(version, heartbeat)
+      if current == version:
+        yield None
+        continue
+      version = current
+      progress = _progress_dict(task, version)
+      yield progress
+      if progress["finished"]:
+        return
+      time.sleep(min_interval)
+  return _watch()
 
 def get_result():
   """
   Return the details of the ongoing task.
   """
   # The result is given only when all the tasks are finished.
-  while ongoing_upload_task.get_status() != BatchUploadTask.STATUS_FINISHED:
-    sleep(0.2)
+  ongoing_upload_task.finished.wait()
   if ongoing_upload_task.batch:
     return model.get_batch_details_brief(ongoing_upload_task.batch.id)
   else:
@@ -289,12 +635,36 @@ def get_history(batch_id):
   else:
     return model.get_batch_details_brief(batch_id)
 
-def upload_task(values):
+def get_history_page(batch_id, offset, limit, sort_column=None,
+                     descending=False, search="", status=None):
+  """
+  Gets a page of the history of the batches if batch_id is not given, else
+  of the images of the batch with batch_id. See model.get_batches_page and
+  model.get_images_page.
+  Returns: (total rows, rows matching search and status, rows of the page).
+  Raises IngestServiceException if the sort column or the status is invalid.
+  """
+  # The DB session is shared with the upload threads.
+  commit_lock.acquire()
+  try:
+    if batch_id is None or batch_id == "":
+      return model.get_batches_page(offset, limit, sort_column, descending,
+                                    search)
+    return model.get_images_page(batch_id, offset, limit, sort_column,
+                                 descending, search, status)
+  except model.ModelException as ex:
+    raise IngestServiceException(str(ex))
+  finally:
+    commit_lock.release()
+
+def upload_task(values, retry=False, retry_batch_id=None):
   """
   Execute either a new upload task or resume last unsuccessful upload task
   from the DB.
+  With retry, only the images not uploaded are uploaded again, see
+  retry_failed.
   This method returns true when all file upload tasks are executed and
-  postprocess and error queues are emptied.
+  the error queue is emptied.
   Return: False is the upload is not executed due to an existing ongoing task.
   """
   global ongoing_upload_task
@@ -303,19 +673,14 @@ def upload_task(values):
   if (ongoing_upload_task and
       ongoing_upload_task.get_status() != BatchUploadTask.STATUS_FINISHED):
     # Ongoing task exists
+    task_unqueued()
     return False
 
+  error_thread = None
   try:
     ongoing_upload_task = BatchUploadTask()
     ongoing_upload_task.set_status(BatchUploadTask.STATUS_RUNNING)
-
-    postprocess_queue = ongoing_upload_task.postprocess_queue
-
-    def _postprocess(func=None, *args):
-      func and func(*args)
-
-    postprocess_thread = QueueFunctionThread(postprocess_queue, _postprocess)
-    postprocess_thread.start()
+    task_unqueued()
 
     def _error(item):
       logger.error(item)
@@ -327,27 +692,18 @@ def upload_task(values):
 
     # Multi-threaded from here.
     try:
-      _upload_images(ongoing_upload_task, values)
+      _upload_images(ongoing_upload_task, values, retry, retry_batch_id)
     except (ClientException, IOError):
       error_queue.put(str(IOError))
-    while not postprocess_queue.empty():
-      sleep(0.2)
-    postprocess_thread.abort = True
-    while postprocess_thread.isAlive():
-      postprocess_thread.join(0.01)
     try:
       _upload_csv(_get_conn())
-      if (ongoing_upload_task.get_fails() == 0
+      if (_batch_done(ongoing_upload_task, retry)
           and ongoing_upload_task.csv_uploaded()): # All done.
         ongoing_upload_task.batch.finish_time = datetime.now()
         model.commit()
     except (ClientException, IOError):
       error_queue.put(str(IOError))
-    while not error_queue.empty():
-      sleep(0.01)
-    error_thread.abort = True
-    while error_thread.isAlive():
-      error_thread.join(0.01)
+    error_thread.stop()
 
     logger.info("Upload task execution completed.")
   except InputCSVException as e: 
@@ -357,23 +713,69 @@ def upload_task(values):
   except (SystemExit, Exception) as ex:
     logger.error("Error happens in _upload: %s" %ex)
     logger.error("Aborting all threads...")
-    for thread in threading_enumerate():
-      thread.abort = True
+    if error_thread:
+      error_thread.abort_thread()
     raise
   finally:
+    # E.g. after an InputCSVException.
+    if error_thread and error_thread.isAlive():
+      error_thread.stop()
     # Reset of singleton task in the module.
     ongoing_upload_task.set_status(BatchUploadTask.STATUS_FINISHED)
 
-def _upload_images(ongoing_upload_task, values):
-  object_queue = ongoing_upload_task.object_queue
-  postprocess_queue = ongoing_upload_task.postprocess_queue
+def _batch_done(task, retry):
+  """
+  Whether all the images of the batch of task are uploaded. A retry may not
+  cover the whole batch: it is done once its CSV was fed completely and none
+  of its images is left to upload.
+  """
+  if not retry:
+    return task.get_fails() == 0
+  batch = task.batch
+  return (batch is not None and bool(batch.RecordCount) and
+          model.count_failed_images(batch.id) == 0)
+
+def retry_failed(batch_id=None):
+  """
+  Uploads again the images that are not uploaded, of the batch with batch_id
+  or of all the batches if it is None. The images are selected from the DB
+  by index, the CSV file is not read, so a retry costs as much as the
+  number of failures.
+  Return: False if the retry is not executed due to an ongoing task.
+  """
+  return upload_task(None, True, batch_id)
+
+def _upload_images(ongoing_upload_task, values, retry=False,
+                   retry_batch_id=None):
   error_queue = ongoing_upload_task.error_queue
   global worker_thread_count
   global fatal_server_error 
+  global upload_breaker
 
   conn = _get_conn()
+  pipeline = None
+  writer = None
+  retries = None
   try:
-    if not values: # Resume.
+    # Fetches the work items of the images to upload from the DB, one page
+    # of those after a given id at a time; None if the CSV rows are fed.
+    get_page = None
+    # The batches of a retry of all of them, whose fails are counted again.
+    retried_batch_ids = None
+    if retry:
+      logger.debug("Retry the failed uploads of batch {0}.".format(
+          retry_batch_id or "all"))
+      if retry_batch_id:
+        batch = model.load_batch(int(retry_batch_id))
+      else:
+        batch = model.load_last_batch()
+      if batch is None:
+        raise IngestServiceException("No batch to retry.")
+      get_page = partial(model.get_failed_images,
+                         int(retry_batch_id) if retry_batch_id else None)
+      if not retry_batch_id:
+        retried_batch_ids = model.get_failed_batch_ids()
+    elif not values: # Resume.
       logger.debug("Resume last batch.")
 
       oldbatch = model.load_last_batch()
@@ -382,10 +784,7 @@ def _upload_images(ongoing_upload_task, values):
         raise IngestServiceException("Last batch already finished, why resume?")
       # Assign local variables with values in DB.
       CSVfilePath = oldbatch.CSVfilePath
-      batch = model.add_batch(
-          oldbatch.CSVfilePath, oldbatch.iDigbioProvidedByGUID,
-          oldbatch.RightsLicense, oldbatch.RightsLicenseStatementUrl,
-          oldbatch.RightsLicenseLogoUrl)
+      batch, get_page = _resume_batch(oldbatch)
     else: # Not resume. It is a new upload.
       logger.debug("Start a new csv batch.")
 
@@ -405,84 +804,94 @@ def _upload_images(ongoing_upload_task, values):
 
     model.commit()
     ongoing_upload_task.batch = batch
-    batch_id = str(batch.id)
-
-    # the object_queue and _upload_single_image are passed to the thread.
-    object_threads = [QueueFunctionThread(object_queue, _upload_single_image,
-        batch_id, _get_conn()) for _junk in xrange(int(worker_thread_count))]
-    ongoing_upload_task.object_threads = object_threads
-
-    # Put all the records to the data base and the job queue.
-    # Get items from the CSV row, which is an array.
-    # In current version, the row is simply [path, providerid].
-    logger.debug('Put all image records into db...')
-    with open(CSVfilePath, 'rb') as csvfile:
-      csv.register_dialect('mydialect', delimiter=',', quotechar='"',
-                           skipinitialspace=True)
-      reader = csv.reader(csvfile, 'mydialect')
-      headerline = None
-      recordCount = 0
-      for row in reader: # For each line do the work.
-        if not headerline:
-          batch.ErrorCode = "CSV File Format Error."
-          headerline = row
-          batch.ErrorCode = ""
-          continue
-
-        # Validity test for each line in CSV file  
-        if len(row) != len(headerline):
-          logger.debug("Input CSV File weird. At least one row has different"
-              + " number of columns")
-          raise InputCSVException("Input CSV File weird. At least one row has"
-              + " different number of columns")
-
-        for col in row: 
-          if "\"" in col:
-            logger.debug("One of CSV field contains \"(Double Quatation)")
-            raise InputCSVException(
-                "One of CSV field contains Double Quatation Mark(\")") 
-
-        # Get the image record
-        image_record = model.add_image(batch, row, headerline)
-
-        fn = partial(ongoing_upload_task.increment, 'total_count')
-        ongoing_upload_task.postprocess_queue.put(fn)
-
-        if image_record is None:
-          # Skip this one because it's already uploaded.
-          # Increment skips count and return.
-          fn = partial(ongoing_upload_task.increment, 'skips')
-          ongoing_upload_task.postprocess_queue.put(fn)
-        else:
-          object_queue.put(image_record)
+    batch_id = batch.id
+
+    # The results of the workers are committed by the writer in batches,
+    # instead of one commit (and one disk sync) per image.
+    writer = GroupCommitWriter(model.apply_updates, model.commit,
+                               commit_lock, commit_batch_size, commit_interval,
+                               commit_latency, model.rollback)
+    writer.start()
+    ongoing_upload_task.writer = writer
+
+    # The CSV rows flow through the stages below, each with its own bounded
+    # queue and workers, so the uploads start as soon as the first rows are
+    # hashed and the disk I/O overlaps the network I/O.
+    # The work items read from the DB skip the hash and dedupe stages.
+    stages = [] if get_page else [
+        Stage("hash", _hash_single_row, hash_thread_count, stage_queue_size),
+        Stage("dedupe", _dedupe_records, 1, stage_queue_size,
+              lambda: (ongoing_upload_task, batch), dedupe_batch_size)]
+    # An upload worker makes a single attempt; the failed uploads are put
+    # back into the upload stage by the retry scheduler after a backoff, so
+    # the workers upload other files meanwhile.
+    upload_breaker = CircuitBreaker()
+    fatal_server_error = False
+    upload_stage = Stage(
+        "upload", _upload_single_image, upload_controller.max_limit,
+        stage_queue_size,
+        lambda: (Connection(retries=0, monitor=upload_controller,
+                            progress=model), upload_controller, writer,
+                 retries, upload_breaker))
+    retries = RetryScheduler(upload_stage)
+    retries.start()
+    ongoing_upload_task.retries = retries
+    pipeline = Pipeline(stages + [
+        Stage("exists", _skip_existing, 1, stage_queue_size,
+              lambda: (ongoing_upload_task, _get_conn(), writer, batch_id),
+              max(exists_batch_size, 1)),
+        upload_stage,
+        Stage("verify", _verify_single_image, 1, stage_queue_size,
+              lambda: (None if retried_batch_ids is not None else batch_id,
+                       writer))], stage_latency)
+    ongoing_upload_task.pipeline = pipeline
+    pipeline.start()
+    logger.debug('{0} upload worker threads started, {1} active.'.format(
+        upload_controller.max_limit, upload_controller.get_limit()))
+
+    if get_page:
+      _feed_work_items(pipeline, ongoing_upload_task, get_page)
+    else:
+      _feed_csv(pipeline, ongoing_upload_task, batch, CSVfilePath)
+    pipeline.close()
+    logger.debug('Put all image records into the pipeline done.')
+
+    # Wait until all images are executed. The batch is stopped if the server
+    # stays unhealthy, the images left are uploaded by a resume or a retry.
+    while not pipeline.join(1):
+      if upload_breaker.unhealthy_for() > server_give_up_time:
+        logger.error("Fatal Server Error Detected")
+        fatal_server_error = True
+        raise ServerException("Fatal Server Error Detected")
 
-        recordCount = recordCount + 1
-      batch.RecordCount = recordCount
-      model.commit()
-    logger.debug('Put all image records into db done.')
-
-    for thread in object_threads:
-      thread.start()
-    logger.debug(
-        '{0} upload worker threads started.'.format(worker_thread_count))
-
-    # Wait until all images are executed.
-    #while not object_queue.empty():
-    #  sleep(0.01)
-    while (not ongoing_upload_task.is_finished()):
-      if fatal_server_error: 
-        raise ServerException  
-      sleep(1)
-    
-    for thread in object_threads:
-      thread.abort = True
-      while thread.isAlive():
-        thread.join(0.01)
-
-    batch.FailCount = ongoing_upload_task.get_fails()
-    batch.SkipCount = ongoing_upload_task.get_skips()
-
-    was_error = _put_errors_from_threads(object_threads)
+    if retried_batch_ids is None:
+      commit_lock.acquire()
+      try:
+        if get_page:
+          batch.SkipCount = (batch.SkipCount or 0) + ongoing_upload_task.get_skips()
+        else:
+          batch.SkipCount = ongoing_upload_task.get_skips()
+        batch.FailCount = ongoing_upload_task.get_fails()
+      finally:
+        commit_lock.release()
+
+    writer.stop()
+    if retried_batch_ids is not None:
+      # The fails of the retry belong to the batches of the images.
+      commit_lock.acquire()
+      try:
+        for retried_id in retried_batch_ids:
+          retried = model.load_batch(retried_id)
+          if retried is not None:
+            retried.FailCount = model.count_failed_images(retried_id)
+        model.commit()
+      finally:
+        commit_lock.release()
+    logger.info("Peak queue depths: {0}. Peak memory: {1} KB.".format(
+        ", ".join("{0} {1}/{2}".format(
+            stage["name"], stage["peak_depth"], stage["maxsize"])
+            for stage in pipeline.stats()), _memory_kb()[1]))
+    was_error = _put_errors_from_threads(pipeline.threads() + [writer])
     if not was_error:
       logger.info("Image upload finishes with no error")
     else:
@@ -494,96 +903,329 @@ def _upload_images(ongoing_upload_task, values):
     error_queue.put('Upload failed outside of the worker thread.')
 
   finally:
+    if pipeline and not pipeline.join(0):
+      upload_breaker.cancel()
+      pipeline.abort()
+    if retries:
+      retries.stop()
+    if writer and writer.isAlive():
+      writer.stop()
+    commit_lock.acquire()
+    try:
+      model.commit()
+    finally:
+      commit_lock.release()
+
+def _resume_batch(oldbatch):
+  """
+  Returns (batch, get_page) to resume oldbatch with: get_page pages the
+  unfinished upload jobs if the whole CSV was fed before, else it is None
+  and the CSV is fed again.
+  """
+  if not model.has_jobs(oldbatch.id):
+    # The batch was made before the upload jobs were recorded.
+    batch = model.add_batch(
+        oldbatch.CSVfilePath, oldbatch.iDigbioProvidedByGUID,
+        oldbatch.RightsLicense, oldbatch.RightsLicenseStatementUrl,
+        oldbatch.RightsLicenseLogoUrl)
+    return batch, None
+  if not oldbatch.RecordCount:
+    # Interrupted while the CSV was fed, the rows after that have no job.
+    # The rows fed before are skipped by the dedupe if they are uploaded,
+    # else they get their job again.
+    logger.info("The CSV of batch {0} was not fed completely, it is read "
+                "again.".format(oldbatch.id))
+    return oldbatch, None
+  # Only the unfinished jobs are uploaded, the CSV is not read again.
+  return oldbatch, partial(model.get_unfinished_jobs, oldbatch.id)
+
+def _feed_work_items(pipeline, task, get_page):
+  """
+  Puts the work items read from the DB into the pipeline, one page at a time.
+  get_page(after_id) returns the page of the items after after_id.
+  """
+  logger.debug('Put the work items from the DB into the pipeline...')
+  after_id = 0
+  while True:
+    commit_lock.acquire()
+    try:
+      items = get_page(after_id)
+    finally:
+      commit_lock.release()
+    if not items:
+      break
+    after_id = items[-1].id
+    for item in items:
+      task.increment(ProgressCounters.TOTAL)
+      # Blocks while the stage is full.
+      pipeline.put(item)
+
+def _feed_csv(pipeline, task, batch, CSVfilePath):
+  """
+  Parses the CSV file and feeds the rows to the pipeline.
+  """
+  # Get items from the CSV row, which is an array.
+  # In current version, the row is simply [path, providerid].
+  logger.debug('Put all image records into the pipeline...')
+  with open(CSVfilePath, 'rb') as csvfile:
+    csv.register_dialect('mydialect', delimiter=',', quotechar='"',
+                         skipinitialspace=True)
+    reader = csv.reader(csvfile, 'mydialect')
+    headerline = None
+    recordCount = 0
+    for row in reader: # For each line do the work.
+      if not headerline:
+        batch.ErrorCode = "CSV File Format Error."
+        headerline = row
+        batch.ErrorCode = ""
+        continue
+
+      # Validity test for each line in CSV file  
+      if len(row) != len(headerline):
+        logger.debug("Input CSV File weird. At least one row has different"
+            + " number of columns")
+        raise InputCSVException("Input CSV File weird. At least one row has"
+            + " different number of columns")
+
+      for col in row: 
+        if "\"" in col:
+          logger.debug("One of CSV field contains \"(Double Quatation)")
+          raise InputCSVException(
+              "One of CSV field contains Double Quatation Mark(\")") 
+
+      task.increment(ProgressCounters.TOTAL)
+
+      # Blocks while the hash stage is full.
+      pipeline.put((row, headerline))
+
+      recordCount = recordCount + 1
+  # The record count marks the batch as fed completely, a resume then
+  # reads its jobs instead of the CSV. See _resume_batch.
+  commit_lock.acquire()
+  try:
+    batch.RecordCount = recordCount
     model.commit()
+  finally:
+    commit_lock.release()
 
 commit_lock = threading.Lock()
 
-def _upload_single_image(image_record, batch_id, conn):
-  '''
-  This function is passed to the threads.
-  Note: session in model is singleton. It is not thread-safe.
-  commit_lock makes sure any access to image_record to be exclusive.
-  '''
-  global ongoing_upload_task
-
-  filename = ""
-  mediaGUID = ""
+def _hash_single_row(item):
+  """
+  Hash stage: hashes the media file of a CSV row and collects its metadata.
+  Without hash_before_upload the file is only stat'ed, the upload stage
+  hashes it.
+  It does not touch the DB, so it runs in several threads.
+  """
+  row, headerline = item
+  return model.generate_record(row, headerline, hash_before_upload)
 
+def _dedupe_records(records, task, batch):
+  """
+  DB dedupe stage: adds the records to the DB in bulk, skipping the ones
+  already uploaded, and records an upload job for each of the others.
+  Returns the work items to upload, None for the skipped ones.
+  """
   commit_lock.acquire()
   try:
-    if not image_record:
-      logger.error("image_record is None.")
-      raise ClientException("image_record is None.")
-
-    logger.info("Image job started: OriginalFileName: {0}"
-        .format(image_record.OriginalFileName))
-
-    if image_record.Error:
-      logger.error("image record has error: {0}".format(image_record.Error))
-      raise ClientException(image_record.Error)
-    filename = image_record.OriginalFileName
-    mediaGUID = image_record.MediaGUID
+    items = model.add_records(batch, records)
+    model.add_jobs(batch.id, [item for item in items if item is not None])
   finally:
     commit_lock.release()
 
+  for item in items:
+    if item is None:
+      # Skip this one because it's already uploaded.
+      # Increment skips count.
+      task.increment(ProgressCounters.SKIPS)
+  return items
+
+def _skip_existing(work_items, task, conn, writer, batch_id):
+  '''
+  Existence check stage: asks the server which of the media files it already
+  stores, in one request per batch. Those are recorded as uploaded with the
+  server's file URL and counted as skips, without sending their bytes.
+  The check is best effort: on an error the images are simply uploaded.
+  Returns the work items to upload.
+  '''
+  md5s = set(item.mmd5 for item in work_items if not item.error and item.mmd5)
+  if not task.exists_check or not md5s:
+    return work_items
+  try:
+    existing = conn.check_existing(sorted(md5s))
+  except ClientException as ex:
+    if ex.http_status in (404, 405):
+      logger.warning("The server has no existence check, it is skipped.")
+      task.exists_check = False
+    else:
+      logger.error("Existence check failed: {0}".format(ex))
+    return work_items
+  except ServerException as ex:
+    logger.error("Existence check failed: {0}".format(ex))
+    return work_items
+
+  upload_items = []
+  for item in work_items:
+    info = None if item.error else existing.get(item.mmd5)
+    if info is None:
+      upload_items.append(item)
+      continue
+    logger.debug("Already on the server: {0}".format(item.path))
+    writer.submit((item.id, {
+        "BatchID": batch_id, "MediaAPContent": json.dumps(info),
+        "MediaURL": info.get("file_url"),
+        "UploadTime": str(datetime.utcnow())}))
+    writer.submit(model.JobUpdate(item.id, {"state": UploadJob.STATE_DONE}))
+    task.increment(ProgressCounters.SKIPS)
+  return upload_items
+
+def _upload_single_image(work_item, conn, controller, writer, retries,
+                         breaker):
+  '''
+  Upload stage: posts the image. The returned result is checked by the verify
+  stage.
+  work_item is a model.ImageWorkItem, a plain tuple, so no lock is needed.
+  The stage runs max_limit workers, the controller lets only `limit` of them
+  post at a time, and none while the breaker is open.
+  A file not hashed yet is hashed while it is sent, and its MD5 is passed to
+  the verify stage.
+  A POST that may succeed later is scheduled for a retry by retries, the job
+  is pending meanwhile. The upload job is in flight until the verify stage
+  records its outcome; a failed POST fails it here.
+  '''
+  global ongoing_upload_task
+
+  filename = work_item.path
+
+  logger.info("Image job started: OriginalFileName: {0}".format(filename))
+
+  if work_item.error:
+    logger.error("image record has error: {0}".format(work_item.error))
+    ongoing_upload_task.increment(ProgressCounters.FAILS)
+    raise ClientException(work_item.error)
+
+  # Blocks while the server is unhealthy.
+  admitted = breaker.wait()
+  if not admitted:
+    return None # The upload is aborted.
+  retries.started(work_item.id)
   try:
+    writer.submit(model.JobUpdate(
+        work_item.id, {"state": UploadJob.STATE_INFLIGHT}))
+    stream_hash = not work_item.mmd5
+    st = os.stat(filename)
     # Post image to API.
     # ma_str is the return from server
-    img_str = conn.post_image(filename, mediaGUID)
-    #    image_record.OriginalFileName, image_record.MediaGUID)
+    controller.acquire()
+    try:
+      starttime = time.time()
+      img_str = conn.post_image(filename, work_item.mediaguid, stream_hash)
+      ongoing_upload_task.count_upload(st.st_size, time.time() - starttime)
+    finally:
+      controller.release()
+    breaker.record(True, admitted)
+    retries.done(work_item.id)
+
+    stream_md5 = conn.stream_md5 if stream_hash else None
+    if stream_md5:
+      model.cache_md5(filename, st, stream_md5)
+    return work_item, img_str, stream_md5, conn.attempts
+  except (ClientException, ServerException) as ex:
+    retryable = api_client.is_retryable(ex)
+    breaker.record(not retryable, admitted)
+    if retryable:
+      delay = retries.schedule(work_item, work_item.id)
+      if delay is not None:
+        upload_retries_total.inc()
+        logger.warning("An image job failed, retry in {0:.1f} sec. Reason: "
+            "{1}".format(delay, ex))
+        writer.submit(model.JobUpdate(work_item.id, {
+            "state": UploadJob.STATE_PENDING, "attempts": conn.attempts,
+            "last_error": str(ex)}))
+        return None
+    retries.done(work_item.id)
+    logger.error("An image job failed. Reason: %s" %ex)
+    writer.submit(model.JobUpdate(work_item.id, {
+        "state": UploadJob.STATE_FAILED, "attempts": conn.attempts,
+        "last_error": str(ex)}))
+    ongoing_upload_task.increment(ProgressCounters.FAILS)
+    if isinstance(ex, ServerException):
+      return None
+    #def _abort_if_necessary():
+    #  if ongoing_upload_task.check_continuous_fails(False):
+    #    logger.info("Aborting threads because continuous failures exceed the"
+    #        + " threshold.")
+    #    map(lambda x: x.abort_thread(), ongoing_upload_task.object_threads)
+    #ongoing_upload_task.postprocess_queue.put(_abort_if_necessary) # Multi-thread
+    raise
+  except (IOError, OSError) as err:
+    breaker.record(None, admitted)
+    retries.done(work_item.id)
+    logger.error("IOError: An image job failed.")
+    if err.errno == ENOENT: # No such file or directory.
+      writer.submit(model.JobUpdate(work_item.id, {
+          "state": UploadJob.STATE_FAILED,
+          "last_error": model.FILE_NOT_FOUND}))
+      ongoing_upload_task.error_queue.put(
+          'Local file %s not found' % repr(filename))
+      ongoing_upload_task.increment(ProgressCounters.FAILS)
+    else:
+      raise
+
+def _verify_single_image(item, batch_id, writer):
+  '''
+  Verify stage: checks the MD5 returned by the server and hands the result to
+  the DB writer. The local MD5 is the one computed while the file was sent if
+  it was not hashed before.
+  '''
+  global ongoing_upload_task
+
+  work_item, img_str, stream_md5, attempts = item
+  try:
     result_obj = json.loads(img_str)
     url = result_obj["file_url"]
 
     # img_etag is not stored in the db.
     img_etag = result_obj["file_md5"]
 
-    commit_lock.acquire()
-    try:
-      # First, change the batch ID to this one. This field is overwriten.
-      image_record.BatchID = batch_id
-      image_record.MediaAPContent = img_str
-      # Check the image integrity.
-      if img_etag and image_record.MediaMD5 == img_etag:
-        image_record.UploadTime = str(datetime.utcnow())
-        image_record.MediaURL = url
-      else:
-        logger.error("Upload failed because local MD5 does not match the eTag"
-            + " or no eTag is returned.")
-        raise ClientException("Upload failed because local MD5 does not match"
-            + " the eTag or no eTag is returned.")
-      model.commit()
-    finally:
-      commit_lock.release()
+    local_md5 = work_item.mmd5 or stream_md5
 
-    if conn.attempts > 1:
-      logger.debug('Done after %d attempts' % (conn.attempts))
+    # First, change the batch ID to this one. This field is overwriten.
+    # A retry of all the batches leaves the images in theirs, batch_id None.
+    fields = {"MediaAPContent": img_str}
+    if batch_id is not None:
+      fields["BatchID"] = batch_id
+    # Check the image integrity.
+    if not img_etag or local_md5 != img_etag:
+      writer.submit((work_item.id, fields))
+      writer.submit(model.JobUpdate(work_item.id, {
+          "state": UploadJob.STATE_FAILED, "attempts": attempts,
+          "last_error": "Local MD5 does not match the eTag."}))
+      logger.error("Upload failed because local MD5 does not match the eTag"
+          + " or no eTag is returned.")
+      raise ClientException("Upload failed because local MD5 does not match"
+          + " the eTag or no eTag is returned.")
+    fields["UploadTime"] = str(datetime.utcnow())
+    fields["MediaURL"] = url
+    fields["Error"] = "" # E.g. a file found again by a retry.
+    if not work_item.mmd5:
+      fields["MediaMD5"] = local_md5
+      fields["AllMD5"] = model.record_md5(
+          work_item.mediaguid, work_item.sruuid, local_md5)
+    writer.submit((work_item.id, fields))
+    writer.submit(model.JobUpdate(work_item.id, {
+        "state": UploadJob.STATE_DONE, "attempts": attempts,
+        "last_error": ""}))
 
     # Increment the successes by 1.
-    fn = partial(ongoing_upload_task.increment, 'successes')
-    ongoing_upload_task.postprocess_queue.put(fn) # Multi-thread
+    ongoing_upload_task.increment(ProgressCounters.SUCCESSES)
     # It's sccessful this time.
     #fn = partial(ongoing_upload_task.check_continuous_fails, True)
     #ongoing_upload_task.postprocess_queue.put(fn) # Multi-thread
   except ClientException as ex:
     logger.error("ClientException: An image job failed. Reason: %s" %ex)
-    fn = partial(ongoing_upload_task.increment, 'fails')
-    ongoing_upload_task.postprocess_queue.put(fn) # Multi-thread
-    #def _abort_if_necessary():
-    #  if ongoing_upload_task.check_continuous_fails(False):
-    #    logger.info("Aborting threads because continuous failures exceed the"
-    #        + " threshold.")
-    #    map(lambda x: x.abort_thread(), ongoing_upload_task.object_threads)
-    #ongoing_upload_task.postprocess_queue.put(_abort_if_necessary) # Multi-thread
+    ongoing_upload_task.increment(ProgressCounters.FAILS)
     raise
-  except IOError as err:
-    logger.error("IOError: An image job failed.")
-    if err.errno == ENOENT: # No such file or directory.
-      error_queue.put(
-          'Local file %s not found' % repr(image_record.OriginalFileName))
-      fn = partial(ongoing_upload_task.increment, 'fails')
-      ongoing_upload_task.postprocess_queue.put(fn) # Multi-thread
-    else:
-      raise
 
 def _upload_csv(conn):
   '''
@@ -626,19 +1268,9 @@ def _make_csvtempfile():
         f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
     header = model.get_batch_details_fieldnames()
     csvwriter.writerow(header)
-    rows = model.get_unuploaded_information()
-    for row in rows:
+    # Read in chunks, so the memory does not grow with the batch size.
+    for row in model.iter_unuploaded_information(lock=commit_lock):
       csvwriter.writerow(row)
-  with open(fname, "rb") as f:
-    md5 = _md5_file(f)
+  md5 = hasher.md5_path(fname)
   logger.debug("Making temporary CSV file done.")
   return fname, md5
-
-def _md5_file(f, block_size=2*20):
-  md5 = hashlib.md5()
-  while True:
-    data = f.read(block_size)
-    if not data:
-      break
-    md5.update(data)
-  return md5.hexdigest()
@@ -16,18 +16,46 @@ from dataingestion.services import (ingestion_manager, constants, api_client,
 from dataingestion.services.user_config import (get_user_config,
                                                 set_user_config, rm_user_config)
 
-singleton_task = BackgroundTaskQueue(cherrypy.engine, qsize=1, qwait=20)
+singleton_task = BackgroundTaskQueue(cherrypy.engine, qsize=1)
 singleton_task.subscribe()
 singleton_task.start()
 
 logger = logging.getLogger("iDigBioSvc.ingestion_service")
 
+def _authenticate_queued():
+  """Authenticates before a queued task starts, which it does not on error."""
+  try:
+    api_client.authenticate(get_user_config('accountuuid'),
+                            get_user_config('apikey'))
+  except:
+    ingestion_manager.task_unqueued()
+    raise
+
 def _upload_task(values):
-  api_client.authenticate(get_user_config('accountuuid'),
-                          get_user_config('apikey'))
+  _authenticate_queued()
   ingestion_manager.upload_task(values)
   cherrypy.log('Upload task finished.',  __name__)
 
+def _retry_task(batch_id):
+  _authenticate_queued()
+  ingestion_manager.retry_failed(batch_id)
+  cherrypy.log('Retry task finished.',  __name__)
+
+def start_retry(batch_id=None):
+  """
+  Start a task uploading the failed images again and then return.
+  Parameter:
+    batch_id: The batch whose failed images are retried, None for all the
+              batches.
+  Returns: True if a task is added to the queue. False if queue is full.
+  """
+  ingestion_manager.task_queued()
+  try:
+    return singleton_task.put(_retry_task, batch_id)
+  except Queue.Full:
+    ingestion_manager.task_unqueued()
+    cherrypy.log('Task ongoing.')
+
 def start_upload(values=None):
   """
   Start the upload tasks and then return.
@@ -46,8 +74,10 @@ def start_upload(values=None):
       error = 'The CSV path is a directory.'
       logger.error(error)
       raise ValueError(error)
+  ingestion_manager.task_queued()
   try:
     return singleton_task.put(_upload_task, values)
   except Queue.Full:
+    ingestion_manager.task_unqueued()
     cherrypy.log('Task ongoing.')
 
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module implements a registry of metrics: counters, latency histograms,
+gauges read from the stats of the other modules, and meters of the recent
+rates. The registry is rendered as JSON or in the Prometheus text format.
+"""
+import bisect, math, threading, time
+
+"""Upper bounds in seconds of the default latency buckets."""
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Metric(object):
+  """
+  A metric with optional labels: the values are kept per label values, e.g.
+  one histogram per stage for labelnames ("stage",).
+  """
+  TYPE = None
+
+  def __init__(self, name, help, labelnames=()):
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labelnames)
+    self._lock = threading.Lock()
+    self._values = {}
+
+  def _key(self, labels):
+    if len(labels) != len(self.labelnames):
+      raise ValueError("{0} takes the labels {1}, not {2}.".format(
+          self.name, self.labelnames, sorted(labels)))
+    try:
+      return tuple(str(labels[name]) for name in self.labelnames)
+    except KeyError:
+      raise ValueError("{0} takes the labels {1}, not {2}.".format(
+          self.name, self.labelnames, sorted(labels)))
+
+  def _labels(self, key):
+    return dict(zip(self.labelnames, key))
+
+  def collect(self):
+    """
+    Returns the list of (labels, value) of the metric. A metric without
+    labels has a value from the start.
+    """
+    with self._lock:
+      if not self.labelnames and not self._values:
+        return [({}, self._value(self._initial()))]
+      return [(self._labels(key), self._value(value))
+              for key, value in sorted(self._values.iteritems())]
+
+  def _initial(self):
+    return 0
+
+  def _value(self, value):
+    return value
+
+
+class Counter(_Metric):
+  """A count that only goes up, e.g. the bytes uploaded."""
+  TYPE = "counter"
+
+  def inc(self, amount=1, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + amount
+
+  def get(self, **labels):
+    key = self._key(labels)
+    with self._lock:
+      return self._values.get(key, 0)
+
+
+class Histogram(_Metric):
+  """
+  Counts the observed values, e.g. latencies, per bucket. The quantiles are
+  estimated from the buckets, as Prometheus does.
+  """
+  TYPE = "histogram"
+
+  def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    _Metric.__init__(self, name, help, labelnames)
+    self.buckets = tuple(sorted(float(bound) for bound in buckets))
+
+  def observe(self, value, **labels):
+    key = self._key(labels)
+    with self._lock:
+      state = self._values.get(key)
+      if state is None:
+        state = self._values[key] = self._initial()
+      state[0][bisect.bisect_left(self.buckets, value)] += 1
+      state[1] += 1
+      state[2] += value
+
+  def _initial(self):
+    # The counts per bucket, the last one is +Inf, then the count and sum.
+    return [[0] * (len(self.buckets) + 1), 0, 0.0]
+
+  def _value(self, state):
+    counts, count, total = state
+    cumulative = []
+    running = 0
+    for bucket_count in counts:
+      running += bucket_count
+      cumulative.append(running)
+    value = dict(
+        count=count, sum=total, mean=total / count if count else 0.0,
+        buckets=zip(self.buckets + (float("inf"),), cumulative))
+    for quantile in (0.5, 0.9, 0.99):
+      value["p{0:g}".format(quantile * 100)] = self._quantile(
+          quantile, cumulative)
+    return value
+
+  def _quantile(self, quantile, cumulative):
+    """Interpolates the quantile within its bucket, 0.0 without values."""
+    count = cumulative[-1]
+    if not count:
+      return 0.0
+    rank = quantile * count
+    index = bisect.bisect_left(cumulative, rank)
+    if index >= len(self.buckets):
+      # In the +Inf bucket, the largest finite bound is the best guess.
+      return self.buckets[-1]
+    lower = self.buckets[index - 1] if index else 0.0
+    below = cumulative[index - 1] if index else 0
+    in_bucket = cumulative[index] - below
+    return lower + (self.buckets[index] - lower) * (rank - below) / in_bucket
+
+
+class Gauge(_Metric):
+  """
+  A value read when the metrics are collected, from func. func returns a
+  number, or for a gauge with one label a dict of label value -> number,
+  e.g. the queue depth of each stage. None means unknown, it is omitted.
+  """
+  TYPE = "gauge"
+
+  def __init__(self, name, help, func, labelnames=()):
+    _Metric.__init__(self, name, help, labelnames)
+    if len(self.labelnames) > 1:
+      raise ValueError("A gauge takes at most one label.")
+    self.func = func
+
+  def collect(self):
+    value = self.func()
+    if value is None:
+      return []
+    if not self.labelnames:
+      return [({}, value)]
+    return [({self.labelnames[0]: str(label)}, value)
+            for label, value in sorted(value.iteritems())
+            if value is not None]
+
+
+class Meter(object):
+  """
+  Measures the rate of events over the last window seconds, in one slot per
+  second, e.g. the images uploaded per second.
+  """
+  def __init__(self, window=60):
+    self.window = max(int(window), 1)
+    self._lock = threading.Lock()
+    self._slots = [0] * self.window
+    self._second = int(time.time())
+    self._starttime = time.time()
+
+  def _advance(self, now):
+    second = int(now)
+    for tick in xrange(self._second + 1,
+                       min(second, self._second + self.window) + 1):
+      self._slots[tick % self.window] = 0
+    self._second = max(second, self._second)
+
+  def mark(self, count=1):
+    now = time.time()
+    with self._lock:
+      self._advance(now)
+      self._slots[self._second % self.window] += count
+
+  def rate(self):
+    """The events per second, over the time since the start if shorter."""
+    now = time.time()
+    with self._lock:
+      self._advance(now)
+      # The current second is only partly over.
+      elapsed = min(self.window - 1 + now % 1, now - self._starttime)
+      if elapsed <= 0:
+        return 0.0
+      return sum(self._slots) / elapsed
+
+
+class Registry(object):
+  """The metrics, by name, in the order they were added."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._metrics = []
+    self._names = {}
+
+  def register(self, metric):
+    with self._lock:
+      if metric.name in self._names:
+        raise ValueError("Metric {0} already registered.".format(metric.name))
+      self._names[metric.name] = metric
+      self._metrics.append(metric)
+    return metric
+
+  def counter(self, name, help, labelnames=()):
+    return self.register(Counter(name, help, labelnames))
+
+  def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    return self.register(Histogram(name, help, labelnames, buckets))
+
+  def gauge(self, name, help, func, labelnames=()):
+    return self.register(Gauge(name, help, func, labelnames))
+
+  def get(self, name):
+    with self._lock:
+      return self._names.get(name)
+
+  def _collect(self):
+    with self._lock:
+      metrics = list(self._metrics)
+    return [(metric, metric.collect()) for metric in metrics]
+
+  def to_dict(self):
+    """
+    Returns the metrics as name -> {type, help, values}, where values is a
+    list of {labels, value}. The value of a histogram is a dict with its
+    count, sum, mean, estimated p50/p90/p99 and cumulative buckets, the last
+    bound is "+Inf" as JSON has no infinity.
+    """
+    result = {}
+    for metric, values in self._collect():
+      if metric.TYPE == "histogram":
+        for _junk, value in values:
+          value["buckets"][-1] = ("+Inf", value["buckets"][-1][1])
+      result[metric.name] = dict(
+          type=metric.TYPE, help=metric.help,
+          values=[dict(labels=labels, value=value)
+                  for labels, value in values])
+    return result
+
+  def to_prometheus(self):
+    """Returns the metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric, values in self._collect():
+      lines.append("# HELP {0} {1}".format(
+          metric.name, metric.help.replace("\\", "\\\\").replace("\n", "\\n")))
+      lines.append("# TYPE {0} {1}".format(metric.name, metric.TYPE))
+      for labels, value in values:
+        if metric.TYPE != "histogram":
+          lines.append(_sample(metric.name, labels, value))
+          continue
+        for bound, count in value["buckets"]:
+          bucket_labels = dict(labels, le=_format_value(bound))
+          lines.append(_sample(metric.name + "_bucket", bucket_labels, count))
+        lines.append(_sample(metric.name + "_sum", labels, value["sum"]))
+        lines.append(_sample(metric.name + "_count", labels, value["count"]))
+    return "\n".join(lines) + "\n"
+
+
+def _format_value(value):
+  if isinstance(value, bool):
+    return "1" if value else "0"
+  if isinstance(value, float):
+    if math.isinf(value):
+      return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+      return "NaN"
+    return repr(value)
+  return str(value)
+
+def _escape(value):
+  return (str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+          .replace("\n", "\\n"))
+
+def _sample(name, labels, value):
+  if labels:
+    name += "{" + ",".join('{0}="{1}"'.format(label, _escape(labels[label]))
+                           for label in sorted(labels)) + "}"
+  return "{0} {1}".format(name, _format_value(value))
+
+
+"""The metrics of the service, see ingestion_manager."""
+registry = Registry()
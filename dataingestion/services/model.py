@@ -8,18 +8,26 @@
 This module implements the data model for the service.
 """
 from sqlalchemy import (create_engine, Column, Integer, String, DateTime,
-                        Boolean, types, distinct)
+                        Boolean, Float, Index, types, distinct)
 from sqlalchemy.orm import scoped_session, sessionmaker, relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.schema import ForeignKey
-from sqlalchemy.sql.expression import desc
-import logging, hashlib, argparse, os, time, struct, re, json
+from sqlalchemy.sql.expression import (desc, bindparam, text, select, func,
+                                       and_, not_)
+import logging, hashlib, argparse, os, time, struct, re, json, threading
 # import pyexiv2
 from datetime import datetime
+from collections import namedtuple, OrderedDict
 import types as pytypes
-from dataingestion.services import constants
+from dataingestion.services import constants, hasher
 
 THRESHOLD_TIME = 2 # sec
+"""The number of AllMD5 values in one IN query, below SQLite's 999 limit."""
+BULK_CHUNK_SIZE = 500
+"""The largest page of a history table, see get_batches_page."""
+MAX_PAGE_SIZE = 1000
+"""The Error of an image whose file was missing, a retry checks it again."""
+FILE_NOT_FOUND = "File not found."
 
 if os.name == 'posix':
   import pwd
@@ -28,16 +36,20 @@ elif os.name == 'nt':
 
 __images_tablename__ = constants.IMAGES_TABLENAME
 __batches_tablename__ = constants.BATCHES_TABLENAME
+__fingerprints_tablename__ = constants.FINGERPRINTS_TABLENAME
+__chunked_uploads_tablename__ = constants.CHUNKED_UPLOADS_TABLENAME
+__upload_jobs_tablename__ = constants.UPLOAD_JOBS_TABLENAME
+__export_watermarks_tablename__ = constants.EXPORT_WATERMARKS_TABLENAME
 
 Base = declarative_base()
 
 logger = logging.getLogger('iDigBioSvc.model')
 
 def check_session(func):
-  def wrapper(*args):
+  def wrapper(*args, **kwargs):
     if session is None:
       raise ValueError('DB session is None.')
-    return func(*args)
+    return func(*args, **kwargs)
   return wrapper
 
 
@@ -183,37 +195,287 @@ class ImageRecord(Base):
     self.BatchID = batch.id
 
 
+ImageWorkItem = namedtuple(
+    'ImageWorkItem',
+    ['id', 'path', 'mediaguid', 'error', 'mmd5', 'size', 'sruuid'])
+"""
+The lightweight description of an image to upload, returned by add_records
+instead of a live ImageRecord. id is the ImageRecord id. mmd5 is empty if the
+file was not hashed before the upload, see generate_record.
+"""
+
+
+class FileFingerprint(Base):
+  """
+  Caches the MD5 of a media file. The cached MD5 is valid as long as the size,
+  modification time and inode of the file are unchanged, so re-runs and
+  resumes do not read the unchanged files again.
+  """
+  __tablename__ = __fingerprints_tablename__
+
+  path = Column(String, primary_key=True)
+  size = Column(Integer)
+  mtime = Column(Float)
+  inode = Column(Integer)
+  MediaMD5 = Column(String)
+
+
+class ChunkedUpload(Base):
+  """
+  The progress of a chunked upload of a large media file: the upload session
+  on the server and the offset it acknowledged. It is valid as long as the
+  file is unchanged, so an interrupted upload resumes after a restart.
+  """
+  __tablename__ = __chunked_uploads_tablename__
+
+  path = Column(String, primary_key=True)
+  size = Column(Integer)
+  mtime = Column(Float)
+  upload_id = Column(String)
+  offset = Column(Integer)
+
+
+class UploadJob(Base):
+  """
+  The upload state of an image in a batch. A resumed batch uploads the
+  images whose job is not done, without reading the CSV file or hashing the
+  media files again.
+  """
+  __tablename__ = __upload_jobs_tablename__
+
+  STATE_PENDING = "pending"
+  STATE_INFLIGHT = "inflight"
+  STATE_DONE = "done"
+  STATE_FAILED = "failed"
+
+  image_id = Column(Integer, ForeignKey(ImageRecord.id), primary_key=True)
+  batch_id = Column(Integer)
+  """One of the STATE_ values."""
+  state = Column(String)
+  """The POST attempts made, including the retries."""
+  attempts = Column(Integer)
+  last_error = Column(String)
+  updated = Column(DateTime)
+
+  __table_args__ = (Index("ix_%s_batch_state" % __upload_jobs_tablename__,
+                          "batch_id", "state"),)
+
+
+class ExportWatermark(Base):
+  """
+  How far the incremental exports to a consumer went: the UploadTime and id
+  of the last image record exported. The next export writes the records
+  uploaded after it, see iter_uploaded_details.
+  """
+  __tablename__ = __export_watermarks_tablename__
+
+  consumer = Column(String, primary_key=True)
+  UploadTime = Column(String)
+  image_id = Column(Integer)
+  """When the last export was written, and its number of rows."""
+  exported = Column(DateTime)
+  rows = Column(Integer)
+
+
+JobUpdate = namedtuple('JobUpdate', ['id', 'fields'])
+"""
+An update intent of the UploadJob of the image with id, for apply_updates.
+fields may have state, last_error and attempts, which is added to the
+attempts made so far.
+"""
+
+
 session = None
+engine = None
+_pending_fingerprints = []
+_fingerprints_lock = threading.Lock()
+# path -> the ChunkedUpload row to write, or None to delete it.
+_pending_chunk_progress = {}
+_chunk_progress_lock = threading.Lock()
 
 def setup(db_file):
   """
   Set up the database.
   """
-  global session
+  global session, engine
 
   db_conn = "sqlite:///%s" % db_file
   logger.info("DB Connection: %s" % db_conn)
   engine = create_engine(db_conn, connect_args={'check_same_thread':False})
   engine.Echo = True
   Base.metadata.create_all(engine)
+  _create_indexes(engine)
 
   Session = scoped_session(sessionmaker(bind=engine))
   session = Session()
   print "DB Connection: %s" % db_conn
 
-def _md5_file(f, block_size=2 ** 20):
+def _create_indexes(bind):
   """
-  Get MD5 of the file.
+  Creates the indexes of the image records that create_all does not add to
+  the tables of an existing DB file.
   """
-  md5 = hashlib.md5()
-  while True:
-    data = f.read(block_size)
-    if not data:
-      break
-    md5.update(data)
-  return md5
+  images = __images_tablename__
+  for name, columns in (("batch_upload", "BatchID, UploadTime"),
+                        ("upload", "UploadTime"),
+                        ("batch", "BatchID"),
+                        ("batch_name", "BatchID, OriginalFileName")):
+    bind.execute("CREATE INDEX IF NOT EXISTS ix_%s_%s ON %s (%s)" % (
+        images, name, images, columns))
+
+def get_cached_md5(path, st):
+  """
+  Returns the cached MD5 of the file at path, or None if it is not cached or
+  the file changed since it was cached.
+  Parameters:
+    path: The path of the media file.
+    st: The os.stat result of the file.
+  Note: It uses its own connection, so it can be called from any thread.
+  """
+  if engine is None:
+    return None
+  table = FileFingerprint.__table__
+  try:
+    row = engine.execute(
+        table.select().where(table.c.path == path)).first()
+  except Exception as e:
+    logger.error('get_cached_md5: error occur during SQLITE access:{0}'
+        .format(e))
+    return None
+  if (row is None or row.size != st.st_size or row.mtime != st.st_mtime
+      or row.inode != st.st_ino):
+    return None
+  return row.MediaMD5
+
+def cache_md5(path, st, md5):
+  """
+  Stores the MD5 of the file at path with its fingerprint.
+  Parameters:
+    path: The path of the media file.
+    st: The os.stat result of the file taken before it was hashed.
+    md5: The MD5 hex digest of the file.
+  Note: It can be called from any thread. The fingerprint is kept in memory
+  and written by the next commit() or flush_fingerprints(), so the hashing
+  threads never wait for the DB write lock.
+  """
+  with _fingerprints_lock:
+    _pending_fingerprints.append(dict(
+        path=path, size=st.st_size, mtime=st.st_mtime, inode=st.st_ino,
+        MediaMD5=md5))
+
+def _take_pending_fingerprints():
+  global _pending_fingerprints
+  with _fingerprints_lock:
+    rows = _pending_fingerprints
+    _pending_fingerprints = []
+  return rows
+
+def _write_fingerprints(bind):
+  rows = _take_pending_fingerprints()
+  if not rows:
+    return
+  try:
+    bind.execute(
+        FileFingerprint.__table__.insert().prefix_with("OR REPLACE"), rows)
+  except Exception as e:
+    # A lost fingerprint only means the file is hashed again next time.
+    logger.error('cache_md5: error occur during SQLITE access:{0}'.format(e))
+
+def get_chunk_progress(path, st):
+  """
+  Returns (upload_id, offset) of the unfinished chunked upload of the file at
+  path, or None if there is none or the file changed since.
+  Note: It uses its own connection, so it can be called from any thread.
+  """
+  with _chunk_progress_lock:
+    if path in _pending_chunk_progress:
+      row = _pending_chunk_progress[path]
+      if (row is None or row["size"] != st.st_size
+          or row["mtime"] != st.st_mtime):
+        return None
+      return row["upload_id"], row["offset"]
+  if engine is None:
+    return None
+  table = ChunkedUpload.__table__
+  try:
+    row = engine.execute(table.select().where(table.c.path == path)).first()
+  except Exception as e:
+    logger.error('get_chunk_progress: error occur during SQLITE access:{0}'
+        .format(e))
+    return None
+  if row is None or row.size != st.st_size or row.mtime != st.st_mtime:
+    return None
+  return row.upload_id, row.offset
 
-def _generate_record(csvrow, headerline):
+def save_chunk_progress(path, st, upload_id, offset):
+  """
+  Records the offset acknowledged by the server for the chunked upload of
+  the file at path. Like cache_md5, it is written by the next commit().
+  """
+  with _chunk_progress_lock:
+    _pending_chunk_progress[path] = dict(
+        path=path, size=st.st_size, mtime=st.st_mtime, upload_id=upload_id,
+        offset=offset)
+
+def clear_chunk_progress(path):
+  """Forgets the chunked upload of the file at path, once it finished."""
+  with _chunk_progress_lock:
+    _pending_chunk_progress[path] = None
+
+def _write_chunk_progress(bind):
+  global _pending_chunk_progress
+  with _chunk_progress_lock:
+    pending = _pending_chunk_progress
+    _pending_chunk_progress = {}
+  if not pending:
+    return
+  table = ChunkedUpload.__table__
+  rows = [row for row in pending.itervalues() if row is not None]
+  try:
+    bind.execute(table.delete().where(table.c.path.in_(pending.keys())))
+    if rows:
+      bind.execute(table.insert(), rows)
+  except Exception as e:
+    # A lost offset only means the server is asked for it again.
+    logger.error('save_chunk_progress: error occur during SQLITE access:{0}'
+        .format(e))
+
+def flush_fingerprints():
+  """
+  Writes the pending fingerprints through its own connection. It is for the
+  callers that do not commit the session, like the CSV generator.
+  """
+  if engine is not None:
+    _write_fingerprints(engine)
+
+def md5_path_cached(path):
+  """
+  Returns the MD5 hex digest and the os.stat result of the file at path.
+  The file is only hashed if its fingerprint is not in the cache.
+  Raises OSError or IOError if the file cannot be read.
+  """
+  st = os.stat(path)
+  md5 = get_cached_md5(path, st)
+  if md5 is None:
+    md5 = hasher.md5_path(path)
+    cache_md5(path, st, md5)
+  return md5, st
+
+def record_md5(mediaguid, sruuid, mmd5):
+  """Returns the AllMD5 of an image record, as generate_record does."""
+  return hashlib.md5(mediaguid + sruuid + mmd5).hexdigest()
+
+def generate_record(csvrow, headerline, hash_file=True):
+  """
+  Builds the fields of an image record from a CSV row: hashes the media file
+  and collects its metadata.
+  It does not touch the DB session, so it can run in any thread.
+  If hash_file is False, the file is only stat'ed: its MD5 is taken from the
+  fingerprint cache, or left empty to be computed while it is uploaded. The
+  AllMD5 is then provisional, made from the path, size and mtime instead of
+  the MD5, until the upload records the real one.
+  Returns: A tuple which can be given to add_record.
+  """
   mediapath = ""
   mediaguid = ""
   sruuid = ""
@@ -258,12 +520,14 @@ def _generate_record(csvrow, headerline):
       logger.error("os path splitext error: " + mediapath)
 
     try:
-      with open(mediapath, 'rb') as f:
-        filemd5 = _md5_file(f)
-        filemd5hexdigest = filemd5.hexdigest()
-    except IOError as err:
+      if hash_file:
+        filemd5hexdigest, st = md5_path_cached(mediapath)
+      else:
+        st = os.stat(mediapath)
+        filemd5hexdigest = get_cached_md5(mediapath, st) or ""
+    except (IOError, OSError) as err:
       logger.error("File " + mediapath + " open error.")
-      error = "File not found."
+      error = FILE_NOT_FOUND
 
   if error: # File not exist, cannot go further. Just return.
     logger.debug('Generating image record done with error.')
@@ -271,18 +535,16 @@ def _generate_record(csvrow, headerline):
         msize, ctime, fowner, exif, json.dumps(annotations_dict), filemd5hexdigest,
         recordmd5.hexdigest())
 
-  recordmd5.update(filemd5hexdigest)
-
-  try:
-    msize = os.path.getsize(mediapath)
-  except os.error:
-    logger.error("os path getsize error: " + mediapath)
-    warnings += "[File getsize error.]"
+  if filemd5hexdigest:
+    recordmd5.update(filemd5hexdigest)
+  else:
+    recordmd5.update("stat:%s:%d:%r" % (mediapath, st.st_size, st.st_mtime))
 
-  ctime = time.ctime(os.path.getmtime(mediapath))
+  msize = st.st_size
+  ctime = time.ctime(st.st_mtime)
 
   if os.name == 'posix':
-    fowner = pwd.getpwuid(os.stat(mediapath).st_uid)[0]
+    fowner = pwd.getpwuid(st.st_uid)[0]
   elif os.name == 'nt':
     try:
       fowner = win_api.get_file_owner(mediapath)
@@ -335,9 +597,20 @@ def add_image(batch, csvrow, headerline):
   Return type: ImageRecord or None.
   Note: Image identity is not determined by path but rather by its MD5.
   """
+  return add_record(batch, generate_record(csvrow, headerline))
+
+@check_session
+def add_record(batch, record):
+  """
+  Adds a record generated by generate_record to the session.
+  Parameters:
+    batch: The UploadBatch instance this image belongs to.
+    record: The tuple returned by generate_record.
+  Return the image or None is the image should not be uploaded.
+  Return type: ImageRecord or None.
+  """
   (mediapath, mediaguid, sruuid, error, warnings, mimetype, msize, ctime,
-   fowner, exif, annotations, mmd5, amd5) = _generate_record(
-       csvrow, headerline)
+   fowner, exif, annotations, mmd5, amd5) = record
 
   try:
     record = session.query(ImageRecord).filter_by(AllMD5=amd5).first()
@@ -362,6 +635,247 @@ def add_image(batch, csvrow, headerline):
     record.BatchID = batch.id
     return record
 
+@check_session
+def add_records(batch, records):
+  """
+  Adds the records generated by generate_record in bulk: the existing AllMD5
+  values are looked up with chunked IN queries and the new records are
+  inserted with one executemany per chunk.
+  Parameters:
+    batch: The UploadBatch instance these images belong to.
+    records: A list of tuples returned by generate_record.
+  Returns: A list in the order of records, with an ImageWorkItem for each
+  image to upload, or None if the image should not be uploaded (already
+  uploaded, or a duplicate of an earlier record in the list).
+  """
+  ret = []
+  for start in xrange(0, len(records), BULK_CHUNK_SIZE):
+    ret.extend(_add_records_chunk(batch, records[start:start + BULK_CHUNK_SIZE]))
+  return ret
+
+def _add_records_chunk(batch, records):
+  table = ImageRecord.__table__
+  amd5s = list(set(record[12] for record in records))
+  try:
+    existing = dict(
+        (row.AllMD5, row) for row in session.execute(
+            table.select().where(table.c.AllMD5.in_(amd5s))))
+
+    new_rows = []
+    retry_ids = []
+    seen = set()
+    for (mediapath, mediaguid, sruuid, error, warnings, mimetype, msize, ctime,
+         fowner, exif, annotations, mmd5, amd5) in records:
+      if amd5 in seen:
+        continue
+      seen.add(amd5)
+      row = existing.get(amd5)
+      if row is None: # New record.
+        new_rows.append(dict(
+            OriginalFileName=mediapath, MediaGUID=mediaguid,
+            SpecimenRecordUUID=sruuid, Error=error, Warnings=warnings,
+            MimeType=mimetype, MediaSizeInBytes=msize,
+            ProviderCreatedTimeStamp=ctime, ProviderCreatedByGUID=fowner,
+            MediaEXIF=exif, Annotations=annotations, MediaMD5=mmd5,
+            AllMD5=amd5, BatchID=batch.id))
+      elif not row.UploadTime: # Not uploaded or file not found.
+        retry_ids.append(row.id)
+
+    if new_rows:
+      session.execute(table.insert(), new_rows)
+    if retry_ids:
+      session.execute(table.update().where(table.c.id.in_(retry_ids)),
+                      {"BatchID": batch.id})
+    if new_rows:
+      # executemany does not return the new ids.
+      new_amd5s = [row["AllMD5"] for row in new_rows]
+      existing.update(
+          (row.AllMD5, row) for row in session.execute(
+              table.select().where(table.c.AllMD5.in_(new_amd5s))))
+  except Exception as e:
+    logger.error('add_records: error occur during SQLITE access:{0}'.format(e))
+    raise ModelException("Error occur during SQLITE access:{0}".format(e))
+
+  ret = []
+  seen = set()
+  for record in records:
+    amd5 = record[12]
+    row = existing[amd5]
+    if amd5 in seen or row.UploadTime:
+      ret.append(None)
+    else:
+      ret.append(_work_item(row))
+    seen.add(amd5)
+  logger.debug('add_records: {0} records, {1} new.'.format(
+      len(records), len(new_rows)))
+  return ret
+
+def _work_item(row):
+  """Returns the ImageWorkItem of an image record row."""
+  return ImageWorkItem(row.id, row.OriginalFileName, row.MediaGUID, row.Error,
+                       row.MediaMD5, row.MediaSizeInBytes,
+                       row.SpecimenRecordUUID)
+
+@check_session
+def apply_image_updates(updates):
+  """
+  Applies update intents to the image records with one executemany per set
+  of updated fields. The caller commits them.
+  Parameters:
+    updates: A list of (image_id, fields) tuples, fields is a dictionary
+             of the ImageRecord field names and their new values.
+  An AllMD5 that another record already has is not applied, that record
+  keeps it.
+  """
+  table = ImageRecord.__table__
+  groups = {}
+  amd5_params = []
+  for image_id, fields in updates:
+    params = dict(fields)
+    if "AllMD5" in params:
+      amd5_params.append({"_id": image_id, "amd5": params.pop("AllMD5")})
+    if not params:
+      continue
+    groups.setdefault(tuple(sorted(params)), []).append(params)
+    params["_id"] = image_id
+  for params in groups.itervalues():
+    session.execute(
+        table.update().where(table.c.id == bindparam("_id")), params)
+  if amd5_params:
+    # The SQLAlchemy update() has no prefixes for "OR IGNORE".
+    session.execute(text("UPDATE OR IGNORE %s SET AllMD5 = :amd5 "
+                         "WHERE id = :_id" % table.name), amd5_params)
+
+def apply_updates(updates):
+  """
+  Applies the intents of the DB writer: JobUpdate intents to the upload jobs,
+  the others to the image records (see apply_image_updates).
+  """
+  images = []
+  jobs = []
+  for update in updates:
+    (jobs if isinstance(update, JobUpdate) else images).append(update)
+  if images:
+    apply_image_updates(images)
+  if jobs:
+    apply_job_updates(jobs)
+
+@check_session
+def apply_job_updates(updates):
+  """
+  Applies JobUpdate intents with one executemany per set of updated fields.
+  The intents of a job are merged in order first, as the groups are not.
+  The caller commits them.
+  """
+  table = UploadJob.__table__
+  now = datetime.now()
+  merged = OrderedDict()
+  for image_id, fields in updates:
+    job = merged.setdefault(image_id, {})
+    for key, value in fields.iteritems():
+      if key == "attempts":
+        value += job.get(key, 0)
+      job[key] = value
+  groups = {}
+  for image_id, fields in merged.iteritems():
+    params = dict(("_" + key, value) for key, value in fields.iteritems())
+    params["_id"] = image_id
+    groups.setdefault(tuple(sorted(fields)), []).append(params)
+  for keys, params in groups.iteritems():
+    values = dict((key, bindparam("_" + key)) for key in keys)
+    if "attempts" in values:
+      values["attempts"] = table.c.attempts + bindparam("_attempts")
+    values["updated"] = now
+    session.execute(
+        table.update().where(table.c.image_id == bindparam("_id"))
+        .values(values), params)
+
+@check_session
+def add_jobs(batch_id, work_items):
+  """
+  Creates (or resets) the upload jobs of the work items returned by
+  add_records. A work item with an error is failed right away.
+  The caller commits them.
+  """
+  if not work_items:
+    return
+  now = datetime.now()
+  session.execute(UploadJob.__table__.insert().prefix_with("OR REPLACE"), [
+      dict(image_id=item.id, batch_id=batch_id,
+           state=(UploadJob.STATE_FAILED if item.error
+                  else UploadJob.STATE_PENDING),
+           attempts=0, last_error=item.error or "", updated=now)
+      for item in work_items])
+
+@check_session
+def has_jobs(batch_id):
+  """True if the batch has upload jobs, i.e. it can be resumed from them."""
+  table = UploadJob.__table__
+  return session.execute(
+      table.select().where(table.c.batch_id == batch_id).limit(1)
+      ).first() is not None
+
+@check_session
+def get_unfinished_jobs(batch_id, after_id=0, limit=BULK_CHUNK_SIZE):
+  """
+  Returns the ImageWorkItems of the images of the batch whose upload job is
+  not done, ordered by id, up to limit of them with an id above after_id.
+  """
+  jobs = UploadJob.__table__
+  images = ImageRecord.__table__
+  rows = session.execute(
+      images.select().where(images.c.id == jobs.c.image_id)
+      .where(jobs.c.batch_id == batch_id)
+      .where(jobs.c.state != UploadJob.STATE_DONE)
+      .where(jobs.c.image_id > after_id)
+      .order_by(jobs.c.image_id).limit(limit))
+  return [_work_item(row) for row in rows]
+
+@check_session
+def get_failed_images(batch_id, after_id=0, limit=BULK_CHUNK_SIZE):
+  """
+  Returns the ImageWorkItems of the images not uploaded, of the batch with
+  batch_id or of all the batches if it is None, ordered by id, up to limit
+  of them with an id above after_id. The query is answered from the
+  (BatchID, UploadTime) and (UploadTime) indexes.
+  The FILE_NOT_FOUND error is not in the work items, the file may be back,
+  the upload checks it again.
+  """
+  table = ImageRecord.__table__
+  query = table.select().where(table.c.UploadTime == None).where(
+      table.c.id > after_id)
+  if batch_id is not None:
+    query = query.where(table.c.BatchID == batch_id)
+  rows = session.execute(query.order_by(table.c.id).limit(limit))
+  items = [_work_item(row) for row in rows]
+  return [item._replace(error="") if item.error == FILE_NOT_FOUND else item
+          for item in items]
+
+@check_session
+def get_failed_batch_ids():
+  """Returns the ids of the batches with images not uploaded."""
+  table = ImageRecord.__table__
+  return [row[0] for row in session.execute(
+      select([distinct(table.c.BatchID)]).where(table.c.UploadTime == None)
+      .order_by(table.c.BatchID))]
+
+@check_session
+def count_failed_images(batch_id):
+  """Returns the number of images of the batch that are not uploaded."""
+  table = ImageRecord.__table__
+  return session.execute(
+      select([func.count()]).where(table.c.BatchID == batch_id)
+      .where(table.c.UploadTime == None)).scalar()
+
+@check_session
+def get_job_counts(batch_id):
+  """Returns a dict of the job states of the batch to their counts."""
+  table = UploadJob.__table__
+  return dict(session.execute(
+      select([table.c.state, func.count()])
+      .where(table.c.batch_id == batch_id).group_by(table.c.state))
+      .fetchall())
+
 @check_session
 def add_batch(path, accountID, license, licenseStatementUrl, licenseLogoUrl):
   """
@@ -378,7 +892,7 @@ def add_batch(path, accountID, license, licenseStatementUrl, licenseLogoUrl):
   start_time = datetime.now()
   try:
     with open(path, 'rb') as f:
-      md5value = _md5_file(f)
+      md5value = hasher.md5_file(f)
   except:
     raise ModelException("CSV File %s is not a valid file." %path)
   md5value.update(accountID)
@@ -424,77 +938,185 @@ def get_batch_details_brief(batch_id):
     ).filter(ImageRecord.BatchID == batch_id).filter(UploadBatch.id == batch_id
     ).order_by(ImageRecord.id) # 3 elements.
 
-  logger.debug("get_batch_details: record count={0}.".format(query.count()))
+  result = query.all()
+  logger.debug("get_batch_details_brief: record count={0}.".format(
+      len(result)))
+  return result
+
+"""The columns of a row of get_batch_details, see its fieldnames."""
+BATCH_DETAILS_COLUMNS = (
+    ImageRecord.MediaGUID,
+    ImageRecord.OriginalFileName,
+    ImageRecord.SpecimenRecordUUID,
+    ImageRecord.Error,
+    ImageRecord.Warnings,
+    ImageRecord.UploadTime,
+    ImageRecord.MediaURL,
+    ImageRecord.MimeType,
+    ImageRecord.MediaSizeInBytes,
+    ImageRecord.ProviderCreatedTimeStamp,
+    ImageRecord.ProviderCreatedByGUID,
+    # 0 - 10 above.
+    ImageRecord.Annotations,
+    ImageRecord.etag,
+    ImageRecord.MediaMD5,
+    UploadBatch.CSVfilePath,
+    UploadBatch.iDigbioProvidedByGUID,
+    UploadBatch.RightsLicense,
+    UploadBatch.RightsLicenseStatementUrl,
+    UploadBatch.RightsLicenseLogoUrl,
+    ImageRecord.BatchID
+    # 11 - 19 above
+    ) # 20 elements.
 
-  return query.all()
+"""The rows read per query by the iter_ functions."""
+EXPORT_CHUNK_SIZE = 1000
+
+def _iter_keyset(query, keys, start, chunk_size, lock):
+  """
+  Yields (key, row) for the rows of query, a select ordered by its last
+  len(keys) columns, the key, and limited to chunk_size rows. The key columns
+  are labelled, else a column also in the row is only selected once. The bind params
+  keys are set to the key of the last row read, start at first, for the next
+  chunk.
+  So the memory used does not grow with the number of rows and no cursor
+  stays open between the chunks: the session is shared, and a commit in
+  between resets the open cursors.
+  lock, if given, is held during each query.
+  """
+  params = dict(zip(keys, start))
+  while True:
+    if lock:
+      lock.acquire()
+    try:
+      rows = session.execute(query, params).fetchall()
+    finally:
+      if lock:
+        lock.release()
+    if not rows:
+      return
+    width = len(rows[0]) - len(keys)
+    for row in rows:
+      row = tuple(row)
+      yield row[width:], row[:width]
+    params = dict(zip(keys, row[width:]))
+    if len(rows) < chunk_size:
+      return
+
+def _iter_details(filters, chunk_size, lock, columns=BATCH_DETAILS_COLUMNS):
+  """
+  Yields the rows of columns of the image records matching filters, joined
+  with their batch, ordered by the image id. See _iter_keyset.
+  The chunks are plain SQL selects, as the ORM takes several times longer to
+  build the rows.
+  """
+  query = select(list(columns) + [ImageRecord.id.label("key_id")]).where(
+      ImageRecord.BatchID == UploadBatch.id)
+  for condition in filters:
+    query = query.where(condition)
+  query = query.where(ImageRecord.id > bindparam("after_id")).order_by(
+      ImageRecord.id).limit(chunk_size)
+  for _junk, row in _iter_keyset(query, ("after_id",), (0,), chunk_size,
+                                 lock):
+    yield row
 
 @check_session
-def get_batch_details(batch_id):
-  '''Gets all the image records for a batch with batch_id.'''
+def iter_batch_details(batch_id, chunk_size=EXPORT_CHUNK_SIZE, lock=None,
+                       columns=BATCH_DETAILS_COLUMNS):
+  '''
+  Yields the image records of the batch with batch_id, the last batch if it
+  is 0, as the rows of get_batch_details, or of the given columns only.
+  See _iter_details.
+  '''
   batch_id = int(batch_id)
   if (batch_id == 0): # Get the last batch.
     batch_id = int(session.query(UploadBatch.id).order_by(desc(UploadBatch.id)).first()[0])
-  query = session.query(
-      ImageRecord.MediaGUID,
-      ImageRecord.OriginalFileName,
-      ImageRecord.SpecimenRecordUUID,
-      ImageRecord.Error,
-      ImageRecord.Warnings,
-      ImageRecord.UploadTime,
-      ImageRecord.MediaURL,
-      ImageRecord.MimeType,
-      ImageRecord.MediaSizeInBytes,
-      ImageRecord.ProviderCreatedTimeStamp,
-      ImageRecord.ProviderCreatedByGUID,
-      # 0 - 10 above.
-      ImageRecord.Annotations,
-      ImageRecord.etag,
-      ImageRecord.MediaMD5,
-      UploadBatch.CSVfilePath,
-      UploadBatch.iDigbioProvidedByGUID,
-      UploadBatch.RightsLicense,
-      UploadBatch.RightsLicenseStatementUrl,
-      UploadBatch.RightsLicenseLogoUrl,
-      ImageRecord.BatchID
-      # 11 - 19 above
-    ).filter(ImageRecord.BatchID == batch_id).filter(UploadBatch.id == batch_id
-    ).order_by(ImageRecord.id) # 20 elements.
+  return _iter_details([ImageRecord.BatchID == batch_id], chunk_size, lock,
+                       columns)
 
-  logger.debug("get_batch_details: record count={0}.".format(query.count()))
-  return query.all()
+@check_session
+def iter_unuploaded_information(chunk_size=EXPORT_CHUNK_SIZE, lock=None):
+  '''
+  Yields the image records of the batches whose CSV file is not uploaded,
+  as the rows of get_batch_details. See _iter_details.
+  '''
+  return _iter_details([UploadBatch.CSVUploaded == False], chunk_size, lock)
 
 @check_session
-def get_unuploaded_information():
-  '''Gets all the image records for a batch with batch_id.'''
-  query = session.query(
-      ImageRecord.MediaGUID,
-      ImageRecord.OriginalFileName,
-      ImageRecord.SpecimenRecordUUID,
-      ImageRecord.Error,
-      ImageRecord.Warnings,
-      ImageRecord.UploadTime,
-      ImageRecord.MediaURL,
-      ImageRecord.MimeType,
-      ImageRecord.MediaSizeInBytes,
-      ImageRecord.ProviderCreatedTimeStamp,
-      ImageRecord.ProviderCreatedByGUID,
-      # 0 - 10 above.
-      ImageRecord.Annotations,
-      ImageRecord.etag,
-      ImageRecord.MediaMD5,
-      UploadBatch.CSVfilePath,
-      UploadBatch.iDigbioProvidedByGUID,
-      UploadBatch.RightsLicense,
-      UploadBatch.RightsLicenseStatementUrl,
-      UploadBatch.RightsLicenseLogoUrl,
-      ImageRecord.BatchID
-      # 11 - 19 above
-    ).filter(UploadBatch.CSVUploaded == False).filter(ImageRecord.BatchID == UploadBatch.id
-    ).order_by(ImageRecord.id) # 20 elements.
+def iter_all_success_details(chunk_size=EXPORT_CHUNK_SIZE, lock=None):
+  '''
+  Yields the uploaded image records of all the batches, as the rows of
+  get_batch_details. See _iter_details.
+  '''
+  return _iter_details([ImageRecord.UploadTime != None], chunk_size, lock)
 
-  logger.debug("get_unuploaded_information: record count={0}.".format(query.count()))
+@check_session
+def iter_uploaded_details(after=None, until=None, chunk_size=EXPORT_CHUNK_SIZE,
+                          lock=None, columns=BATCH_DETAILS_COLUMNS):
+  '''
+  Yields (key, row) for the image records uploaded after the key after, up
+  to the UploadTime until, where row has the columns of get_batch_details and
+  key is the (UploadTime, id) of the record, for an ExportWatermark.
+  The records are ordered by their key, the chunks read from the UploadTime
+  index, so the time taken depends on the records after the key only.
+  after None means all the uploaded records. See _iter_keyset.
+  '''
+  upload_time, image_id = after or ("", 0)
+  after_time = bindparam("after_time")
+  query = select(list(columns) + [ImageRecord.UploadTime.label("key_time"),
+                                  ImageRecord.id.label("key_id")]
+      ).where(ImageRecord.BatchID == UploadBatch.id
+      ).where(ImageRecord.UploadTime >= after_time
+      ).where(not_(and_(ImageRecord.UploadTime == after_time,
+                        ImageRecord.id <= bindparam("after_id"))))
+  if until is not None:
+    query = query.where(ImageRecord.UploadTime <= until)
+  query = query.order_by(ImageRecord.UploadTime, ImageRecord.id).limit(
+      chunk_size)
+  return _iter_keyset(query, ("after_time", "after_id"),
+                      (upload_time, image_id), chunk_size, lock)
 
-  return query.all()
+@check_session
+def get_export_watermark(consumer):
+  '''
+  Returns the (UploadTime, id) of the last image record exported to
+  consumer, None if nothing was exported to it yet.
+  '''
+  watermark = session.query(ExportWatermark).filter_by(
+      consumer=consumer).first()
+  if watermark is None:
+    return None
+  return watermark.UploadTime, watermark.image_id
+
+@check_session
+def set_export_watermark(consumer, key, rows):
+  '''
+  Records that the records up to key, an (UploadTime, id), were exported to
+  consumer, rows of them by this export. None forgets the watermark, the
+  next export writes all the uploaded records.
+  '''
+  watermark = session.query(ExportWatermark).filter_by(
+      consumer=consumer).first()
+  if key is None:
+    if watermark is not None:
+      session.delete(watermark)
+    return
+  if watermark is None:
+    watermark = ExportWatermark(consumer=consumer)
+    session.add(watermark)
+  watermark.UploadTime, watermark.image_id = key
+  watermark.exported = datetime.now()
+  watermark.rows = rows
+
+@check_session
+def get_batch_details(batch_id):
+  '''Gets all the image records for a batch with batch_id.'''
+  return list(iter_batch_details(batch_id))
+
+@check_session
+def get_unuploaded_information():
+  '''Gets all the image records of the batches whose CSV is not uploaded.'''
+  return list(iter_unuploaded_information())
 
 @check_session
 def set_all_csv_uploaded():
@@ -504,75 +1126,168 @@ def set_all_csv_uploaded():
 @check_session
 def get_all_success_details():
   '''Gets all the image records for all batches.'''
-  
-  query = session.query(
-      ImageRecord.MediaGUID,
-      ImageRecord.OriginalFileName,
-      ImageRecord.SpecimenRecordUUID,
-      ImageRecord.Error,
-      ImageRecord.Warnings,
-      ImageRecord.UploadTime,
-      ImageRecord.MediaURL,
-      ImageRecord.MimeType,
-      ImageRecord.MediaSizeInBytes,
-      ImageRecord.ProviderCreatedTimeStamp,
-      ImageRecord.ProviderCreatedByGUID,
-      # 0 - 10 above.
-      ImageRecord.Annotations,
-      ImageRecord.etag,
-      ImageRecord.MediaMD5,
-      UploadBatch.CSVfilePath,
-      UploadBatch.iDigbioProvidedByGUID,
-      UploadBatch.RightsLicense,
-      UploadBatch.RightsLicenseStatementUrl,
-      UploadBatch.RightsLicenseLogoUrl,
-      ImageRecord.BatchID
-      # 11 - 19 above
-    ).filter(ImageRecord.UploadTime != None
-    ).filter(ImageRecord.BatchID == UploadBatch.id
-    ).order_by(ImageRecord.id) # 20 elements.
-
-  logger.debug("get_all_success_details: record count={0}.".format(query.count()))
-
-  return query.all()
-
+  return list(iter_all_success_details())
 
-@check_session
-def get_all_batches():
-  """
-  Get all the batches in the batch table.
-  Return: A list of all batches, each batch is a list of all fields.
-  """
 
-  query = session.query(
+"""The columns of a row of get_all_batches, the batch history table."""
+BATCH_HISTORY_COLUMNS = (
     UploadBatch.id,
     UploadBatch.CSVfilePath,
     UploadBatch.iDigbioProvidedByGUID,
     UploadBatch.RightsLicense,
-    UploadBatch.RightsLicenseStatementUrl, 
+    UploadBatch.RightsLicenseStatementUrl,
     UploadBatch.RightsLicenseLogoUrl,
     UploadBatch.start_time,
     UploadBatch.finish_time,
     UploadBatch.RecordCount,
     UploadBatch.FailCount,
-    UploadBatch.SkipCount
-    ).order_by(UploadBatch.id) # 11 elements
+    UploadBatch.SkipCount) # 11 elements
 
-  ret = []
-  for elem in query:
-    newelem = []
-    index = 0
-    for origitem in elem:
-      item = str(origitem)
-      if index == 6: # start_time?
-        item = item[0:item.index('.')]
-      newelem.append(str(item))
-      index = index + 1
-    ret.append(newelem)
+"""
+The columns of a row of get_batch_details_brief, the image history table,
+and those it can be sorted by: the ones with an index on (BatchID, column).
+"""
+IMAGE_HISTORY_COLUMNS = (
+    ImageRecord.OriginalFileName,
+    ImageRecord.Error,
+    ImageRecord.MediaURL) # 3 elements
+IMAGE_SORT_COLUMNS = (0,)
+
+"""The status filters of get_images_page."""
+IMAGE_UPLOADED = "uploaded"
+IMAGE_NOT_UPLOADED = "failed"
+
+def _batch_row(elem):
+  """A row of the batch history, all fields as strings."""
+  newelem = []
+  index = 0
+  for origitem in elem:
+    item = str(origitem)
+    if index == 6 and '.' in item: # start_time?
+      item = item[0:item.index('.')]
+    newelem.append(str(item))
+    index = index + 1
+  return newelem
+
+def _contains(column, text):
+  """column contains text, the LIKE wildcards in text match themselves."""
+  escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace(
+      "_", "\\_")
+  return column.like("%" + escaped + "%", escape="\\")
+
+def _page_bounds(offset, limit):
+  offset = max(int(offset), 0)
+  limit = int(limit)
+  if limit < 0 or limit > MAX_PAGE_SIZE: # -1 is all the rows.
+    limit = MAX_PAGE_SIZE
+  return offset, limit
+
+@check_session
+def get_all_batches():
+  """
+  Get all the batches in the batch table.
+  Return: A list of all batches, each batch is a list of all fields.
+  """
+
+  query = session.query(*BATCH_HISTORY_COLUMNS).order_by(UploadBatch.id)
+  ret = [_batch_row(elem) for elem in query]
 
   logger.debug("get_all_batches: batch count={0}.".format(len(ret)))
   return ret
 
+@check_session
+def get_batches_page(offset=0, limit=MAX_PAGE_SIZE, sort_column=None,
+                     descending=False, search=""):
+  """
+  Gets a page of the batch history, for a table paged by the server.
+  Params:
+    sort_column: The index of the column in BATCH_HISTORY_COLUMNS to sort
+                 by, the batch id if None.
+    search: Only the batches whose CSV file path contains it.
+  Returns: (the number of batches, the number of those matching search, the
+           rows of the page as in get_all_batches). A page has at most
+           MAX_PAGE_SIZE rows.
+  Raises ModelException if the sort column is not one of the columns.
+  """
+  offset, limit = _page_bounds(offset, limit)
+  if sort_column is None:
+    order = UploadBatch.id
+  elif 0 <= int(sort_column) < len(BATCH_HISTORY_COLUMNS):
+    order = BATCH_HISTORY_COLUMNS[int(sort_column)]
+  else:
+    raise ModelException("Cannot sort the batches by column %s." % sort_column)
+  count = session.query(func.count(UploadBatch.id))
+  total = matching = count.scalar()
+  query = session.query(*BATCH_HISTORY_COLUMNS)
+  if search:
+    condition = _contains(UploadBatch.CSVfilePath, search)
+    matching = count.filter(condition).scalar()
+    query = query.filter(condition)
+  if descending:
+    query = query.order_by(desc(order), desc(UploadBatch.id))
+  else:
+    query = query.order_by(order, UploadBatch.id)
+  rows = [_batch_row(elem) for elem in query.offset(offset).limit(limit)]
+  return total, matching, rows
+
+@check_session
+def get_images_page(batch_id, offset=0, limit=MAX_PAGE_SIZE, sort_column=None,
+                    descending=False, search="", status=None):
+  """
+  Gets a page of the image records of a batch, for a table paged by the
+  server. Each query is answered from an index on (BatchID, ...), so a page
+  costs the same in a large batch as in a small one, except for a search.
+  Params:
+    sort_column: One of IMAGE_SORT_COLUMNS, the index of the column in
+                 IMAGE_HISTORY_COLUMNS to sort by, the id if None.
+    search: Only the images whose OriginalFileName contains it.
+    status: IMAGE_UPLOADED or IMAGE_NOT_UPLOADED for only those images.
+  Returns: (the number of images of the batch, the number of those matching
+           search and status, the rows of the page as in
+           get_batch_details_brief). A page has at most MAX_PAGE_SIZE rows.
+  Raises ModelException if the sort column or the status is not valid.
+  """
+  batch_id = int(batch_id)
+  offset, limit = _page_bounds(offset, limit)
+  if sort_column is None:
+    order = ImageRecord.id
+  elif int(sort_column) in IMAGE_SORT_COLUMNS:
+    order = IMAGE_HISTORY_COLUMNS[int(sort_column)]
+  else:
+    raise ModelException("Cannot sort the images by column %s." % sort_column)
+  conditions = []
+  if status == IMAGE_UPLOADED:
+    conditions.append(ImageRecord.UploadTime != None)
+  elif status == IMAGE_NOT_UPLOADED:
+    conditions.append(ImageRecord.UploadTime == None)
+  elif status:
+    raise ModelException("Unknown image status %s." % status)
+  if search:
+    conditions.append(_contains(ImageRecord.OriginalFileName, search))
+
+  count = session.query(func.count(ImageRecord.id)).filter(
+      ImageRecord.BatchID == batch_id)
+  total = matching = count.scalar()
+  query = session.query(*IMAGE_HISTORY_COLUMNS).filter(
+      ImageRecord.BatchID == batch_id)
+  for condition in conditions:
+    count = count.filter(condition)
+    query = query.filter(condition)
+  if order is ImageRecord.id:
+    query = query.order_by(desc(order) if descending else order)
+  elif descending:
+    query = query.order_by(desc(order), desc(ImageRecord.id))
+  else:
+    query = query.order_by(order, ImageRecord.id)
+  rows = [tuple(row) for row in query.offset(offset).limit(limit)]
+  if conditions:
+    # A search scans the batch, a short last page saves the second scan.
+    if len(rows) < limit and (rows or not offset):
+      matching = offset + len(rows)
+    else:
+      matching = count.scalar()
+  return total, matching, rows
+
 @check_session
 def get_last_batch_info():
   """
@@ -607,6 +1322,10 @@ def get_last_batch_info():
     retdict = {'Empty': True, 'ErrorCode': 'Network Connection Error.'}
     return retdict
 
+@check_session
+def load_batch(batch_id):
+  return session.query(UploadBatch).filter_by(id=batch_id).first()
+
 @check_session
 def load_last_batch():
   batch = session.query(UploadBatch).order_by(desc(UploadBatch.id)).first()
@@ -619,10 +1338,17 @@ def get_csv_path(batch_id):
 
 @check_session
 def commit():
+  _write_fingerprints(session)
+  _write_chunk_progress(session)
   session.commit()
 
+@check_session
+def rollback():
+  session.rollback()
+
 def close():
-  global session
+  global session, engine
   if session:
     session.close()
     session = None
+  engine = None
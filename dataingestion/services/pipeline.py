@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module implements a staged pipeline: a chain of bounded queues, each
+drained by its own pool of worker threads.
+"""
+import logging, threading, time
+from Queue import Queue, Empty, Full
+from sys import exc_info
+
+logger = logging.getLogger('iDigBioSvc.pipeline')
+
+# Put once per worker to tell the workers of a stage to exit.
+_STOP = object()
+
+
+class StageThread(threading.Thread):
+  """
+  A worker of a Stage. Calls stage.func for each item (or batch of items) in
+  the stage queue and hands the non-None results to the next stage.
+  Exceptions raised by func are kept in exc_infos, in the same way as
+  QueueFunctionThread does. The seconds of each call of func are observed by
+  the latency histogram of the stage, if any.
+  """
+  def __init__(self, stage, args):
+    threading.Thread.__init__(self, name=stage.name)
+    self.daemon = True
+    self.stage = stage
+    self.args = args
+    self.exc_infos = []
+
+  def run(self):
+    stage = self.stage
+    try:
+      stopping = False
+      while not stopping:
+        items = [stage.queue.get()]
+        if stage.batch_size:
+          # Take what is already queued, up to batch_size items, so a batch
+          # never waits for more items to arrive.
+          while len(items) < stage.batch_size:
+            try:
+              items.append(stage.queue.get_nowait())
+            except Empty:
+              break
+        if _STOP in items:
+          stopping = True
+          # Anything after the stop mark belongs to the other workers.
+          for item in items[items.index(_STOP) + 1:]:
+            stage.queue.put(item)
+            stage.queue.task_done()
+          items = items[:items.index(_STOP)]
+          stage.queue.task_done()
+        try:
+          if items and not stage.aborted:
+            self._process(stage, items)
+        finally:
+          for _junk in items:
+            stage.queue.task_done()
+          stage._items_done(len(items))
+    finally:
+      stage._worker_exited()
+
+  def _process(self, stage, items):
+    stage._busy(1)
+    starttime = time.time()
+    try:
+      if stage.batch_size:
+        results = stage.func(items, *self.args) or ()
+      else:
+        results = (stage.func(items[0], *self.args),)
+    except Exception:
+      logger.error("Exception caught in stage {0}.".format(stage.name))
+      self.exc_infos.append(exc_info())
+      return
+    finally:
+      stage._busy(-1)
+      if stage.latency:
+        stage.latency.observe(time.time() - starttime, stage=stage.name)
+    if stage.next_stage:
+      for result in results:
+        if result is not None:
+          stage.next_stage.put(result)
+
+
+class Stage(object):
+  """
+  One step of a Pipeline.
+  Params:
+    name: The name of the stage, used for logging and thread names.
+    func: Called as func(item, *args) for each item. A non-None return value
+          is put into the next stage.
+    workers: The number of worker threads of this stage.
+    maxsize: The bound of the stage queue. put() blocks while it is full,
+             which throttles the upstream stages.
+    make_args: Optional callable returning the extra args for one worker,
+               e.g. a connection that should not be shared between threads.
+    batch_size: If set, func is called with a list of up to batch_size items
+                instead of one item, and returns an iterable of results.
+  """
+  def __init__(self, name, func, workers=1, maxsize=0, make_args=None,
+               batch_size=None):
+    self.name = name
+    self.func = func
+    self.workers = max(int(workers), 1)
+    self.queue = Queue(maxsize)
+    self.make_args = make_args
+    self.batch_size = batch_size
+    self.next_stage = None
+    self.aborted = False
+    self.threads = []
+    self.done = threading.Event()
+    self.peak_depth = 0
+    self.latency = None # Set by the Pipeline.
+    self._active = 0
+    self._alive = 0
+    self._unfinished = 0
+    self._holds = 0
+    self._closing = False
+    self._closed = False
+    self._lock = threading.Lock()
+
+  def start(self):
+    with self._lock:
+      for _junk in xrange(self.workers):
+        args = self.make_args() if self.make_args else ()
+        self.threads.append(StageThread(self, args))
+      self._alive = len(self.threads)
+    for thread in self.threads:
+      thread.start()
+    logger.debug("Stage {0} started with {1} workers.".format(
+        self.name, self.workers))
+
+  def put(self, item):
+    """Blocks while the stage queue is full."""
+    with self._lock:
+      self._unfinished += 1
+    self.queue.put(item)
+    depth = self.queue.qsize()
+    with self._lock:
+      if depth > self.peak_depth:
+        self.peak_depth = depth
+
+  def close(self):
+    """
+    No more items will be put, except the held ones. Workers exit once the
+    queue is drained, the items are processed and no hold is left.
+    Closing the stage again does nothing.
+    """
+    with self._lock:
+      if self._closed:
+        return
+      self._closed = True
+      self._closing = True
+    self._stop_if_finished()
+
+  def hold(self):
+    """
+    Keeps the stage from finishing until unhold(), as an item will be put
+    again later, e.g. the retry of an item that failed.
+    """
+    with self._lock:
+      self._holds += 1
+
+  def unhold(self):
+    with self._lock:
+      self._holds -= 1
+    self._stop_if_finished()
+
+  def abort(self):
+    """Workers drop the remaining items without processing them."""
+    self.aborted = True
+
+  def stats(self):
+    """
+    Returns the current and the peak depth of the stage queue, and the
+    workers processing an item.
+    """
+    with self._lock:
+      return dict(name=self.name, workers=self.workers, active=self._active,
+                  maxsize=self.queue.maxsize, depth=self.queue.qsize(),
+                  peak_depth=self.peak_depth)
+
+  def _busy(self, delta):
+    with self._lock:
+      self._active += delta
+
+  def _items_done(self, count):
+    with self._lock:
+      self._unfinished -= count
+    self._stop_if_finished()
+
+  def _stop_if_finished(self):
+    # The stop marks are put once, after the last item is processed, as
+    # processing an item may hold the stage.
+    with self._lock:
+      if not self._closing or self._unfinished or self._holds:
+        return
+      self._closing = False
+    for _junk in xrange(self.workers):
+      if not self.aborted:
+        self.queue.put(_STOP)
+        continue
+      # The workers of an aborted stage may have exited, nobody drains it.
+      try:
+        self.queue.put_nowait(_STOP)
+      except Full:
+        break
+
+  def _worker_exited(self):
+    with self._lock:
+      self._alive -= 1
+      last = self._alive == 0
+    if last:
+      logger.debug("Stage {0} finished.".format(self.name))
+      if self.next_stage:
+        self.next_stage.close()
+      self.done.set()
+
+
+class Pipeline(object):
+  """
+  Chains the stages in the given order. Closing the pipeline closes the first
+  stage; each stage closes the next one after its last worker exits, so the
+  pipeline is finished when the last stage is done.
+  latency: Optional histogram observing the seconds of each call of the
+           function of a stage, labelled with the stage name, see metrics.
+  """
+  def __init__(self, stages, latency=None):
+    self.stages = stages
+    for stage in stages:
+      stage.latency = latency
+    for upstream, downstream in zip(stages, stages[1:]):
+      upstream.next_stage = downstream
+
+  def start(self):
+    for stage in reversed(self.stages):
+      stage.start()
+
+  def put(self, item):
+    self.stages[0].put(item)
+
+  def close(self):
+    self.stages[0].close()
+
+  def join(self, timeout=None):
+    """Returns True if all the stages are finished."""
+    self.stages[-1].done.wait(timeout)
+    return self.stages[-1].done.is_set()
+
+  def abort(self):
+    """
+    Drops the queued items and lets all the workers exit. The pipeline is
+    closed unless it already was.
+    """
+    for stage in self.stages:
+      stage.abort()
+    self.close()
+
+  def threads(self):
+    return [thread for stage in self.stages for thread in stage.threads]
+
+  def stats(self):
+    """Returns the queue stats of the stages, in order."""
+    return [stage.stats() for stage in self.stages]
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module implements a token bucket shared by all the upload threads, which
+caps the aggregate upload bandwidth following a time-of-day schedule.
+"""
+import logging, re, threading, time
+from datetime import datetime
+
+logger = logging.getLogger('iDigBioSvc.rate_limiter')
+
+_UNITS = {"": 1, "K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30}
+_RATE_RE = re.compile(r"^(\d+(?:\.\d+)?)\s*([KMG]?)(?:B|B/S)?$", re.I)
+_RANGE_RE = re.compile(r"^(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})$")
+
+
+def parse_rate(text):
+  """
+  Parses a rate like "2M", "512K", "2MB/s" or "1048576" (bytes/sec).
+  Returns: The rate in bytes/sec, None for "unlimited" or "0".
+  Raises ValueError if the text is not a rate.
+  """
+  text = text.strip()
+  if text.lower() in ("", "unlimited", "none", "0"):
+    return None
+  match = _RATE_RE.match(text)
+  if not match:
+    raise ValueError("Invalid upload rate: {0}".format(text))
+  rate = float(match.group(1)) * _UNITS[match.group(2).upper()]
+  return rate or None
+
+def parse_schedule(text):
+  """
+  Parses a schedule: comma separated "HH:MM-HH:MM=RATE" entries, e.g.
+  "08:00-18:00=2M, 18:00-20:00=8M". A range may wrap midnight. A bare RATE
+  applies all day. The time not covered by any entry is unlimited.
+  Returns: A list of (start minute, end minute, rate) tuples.
+  Raises ValueError if the text is not a schedule.
+  """
+  schedule = []
+  for entry in (text or "").split(","):
+    entry = entry.strip()
+    if not entry:
+      continue
+    if "=" not in entry:
+      schedule.append((0, 24 * 60, parse_rate(entry)))
+      continue
+    span, rate = entry.split("=", 1)
+    match = _RANGE_RE.match(span.strip())
+    if not match:
+      raise ValueError("Invalid upload schedule time range: {0}".format(span))
+    h1, m1, h2, m2 = [int(x) for x in match.groups()]
+    if h1 > 24 or h2 > 24 or m1 > 59 or m2 > 59:
+      raise ValueError("Invalid upload schedule time range: {0}".format(span))
+    schedule.append((h1 * 60 + m1, h2 * 60 + m2, parse_rate(rate)))
+  return schedule
+
+
+class RateLimiter(object):
+  """
+  A token bucket holding up to one second of the current rate. Senders call
+  consume(n) before sending n bytes; it sleeps while the bucket is empty.
+  """
+  def __init__(self, schedule=None):
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._schedule = []
+    self._schedule_text = ""
+    self._tokens = 0.0
+    self._last = time.time()
+    self._bytes = 0
+    self._throttled_bytes = 0
+    self._delay = 0.0
+    self._max_delay = 0.0
+    if schedule:
+      self.set_schedule(schedule)
+
+  def set_schedule(self, text):
+    """
+    Sets the schedule, see parse_schedule.
+    Raises ValueError if the text is not a schedule.
+    """
+    schedule = parse_schedule(text)
+    with self._lock:
+      self._schedule = schedule
+      self._schedule_text = text or ""
+    logger.info("Upload rate schedule: {0}".format(text or "unlimited"))
+
+  def current_rate(self, now=None):
+    """Returns the rate in bytes/sec at now (a datetime), None if unlimited."""
+    now = now or datetime.now()
+    minute = now.hour * 60 + now.minute
+    for start, end, rate in self._schedule:
+      if start <= end:
+        if start <= minute < end:
+          return rate
+      elif minute >= start or minute < end: # Wraps midnight.
+        return rate
+    return None
+
+  def consume(self, nbytes):
+    """Blocks until nbytes may be sent."""
+    rate = self.current_rate()
+    if rate is None:
+      with self._lock:
+        self._bytes += nbytes
+      return
+    with self._lock:
+      now = time.time()
+      self._tokens = min(self._tokens + (now - self._last) * rate, rate)
+      self._last = now
+      # Take the tokens now and sleep off the debt, so the threads queue up
+      # in order instead of polling.
+      self._tokens -= nbytes
+      wait = -self._tokens / rate if self._tokens < 0 else 0.0
+      self._bytes += nbytes
+      if wait:
+        self._throttled_bytes += nbytes
+        self._delay += wait
+        self._max_delay = max(self._max_delay, wait)
+    if wait:
+      self._local.delay = self.thread_delay() + wait
+      time.sleep(wait)
+
+  def allowance(self):
+    """
+    Returns the bytes that may be sent now without waiting, None if the
+    rate is unlimited. Lets the senders size their writes to the bucket.
+    """
+    rate = self.current_rate()
+    if rate is None:
+      return None
+    with self._lock:
+      tokens = min(self._tokens + (time.time() - self._last) * rate, rate)
+    return max(tokens, 0)
+
+  def thread_delay(self):
+    """The total seconds the calling thread was throttled."""
+    return getattr(self._local, "delay", 0.0)
+
+  def stats(self):
+    """Returns the schedule, the current rate and the delay added."""
+    rate = self.current_rate()
+    with self._lock:
+      return dict(
+          schedule=self._schedule_text, current_rate=rate,
+          bytes=self._bytes, throttled_bytes=self._throttled_bytes,
+          throttle_delay=self._delay, max_throttle_delay=self._max_delay)
@@ -9,44 +9,77 @@
 This module implements the result file generation functionalities.
 """
 
-import ast, os, logging, csv, zipfile
-from dataingestion.services import constants, model
+import ast, os, logging, csv, itertools, json
+from datetime import datetime, timedelta
+from multiprocessing import cpu_count
+from dataingestion.services import (constants, model, ingestion_manager,
+                                    zip_stream)
 
 logger = logging.getLogger('iDigBioSvc.result_generator')
 
-def _processTargetPaths(target_path, batch_id):
-  csv_path = ""
+"""The rows written between two progress log lines of an export."""
+PROGRESS_INTERVAL = 100000
+"""
+The records uploaded in the last seconds are left to the next incremental
+export, as their upload time is set before their commit.
+"""
+WATERMARK_LAG = 60
+"""The threads compressing the zip export, see zip_stream."""
+ZIP_WORKERS = cpu_count()
+
+_json_decoder = json.JSONDecoder()
+
+def _write_rows(csv_writer, rows, target_path):
+  """
+  Writes the rows as they are read, logging the progress.
+  Returns: The number of rows written.
+  """
+  count = 0
+  for row in rows:
+    csv_writer.writerow(row)
+    count += 1
+    if count % PROGRESS_INTERVAL == 0:
+      logger.info("Write to CSV file {0}: {1} rows written.".format(
+          target_path, count))
+  return count
+
+def _processTargetPath(target_path, batch_id):
   if target_path is "":
     csv_path = model.get_csv_path(batch_id)
     targetdir = os.path.dirname(os.path.realpath(csv_path)) 
     target_path = os.path.join(targetdir, constants.ZIP_NAME)
-  else:
-    targetdir = os.path.dirname(os.path.realpath(target_path)) 
-  image_csv_path = os.path.join(targetdir, constants.IMAGE_CSV_NAME)
-  stub_csv_path = os.path.join(targetdir, constants.STUB_CSV_NAME)
-  return target_path, image_csv_path, stub_csv_path
+  return target_path
+
+def _check_target_path(target_path):
+  """Returns the error if a CSV file cannot be written at target_path."""
+  error = ""
+  if not os.path.isabs(target_path):
+    error = "File " + str(target_path) + " open error. It is not an absolute path."
+    logger.error(error)
+  elif os.path.isdir(target_path):
+    error = "File " + str(target_path) + " open error. It is a directory."
+    logger.error(error)
+  return error
 
 def generateCSV(batch_id, target_path):
+  # The rows are read from the DB in chunks while the file is written, the
+  # lock is held per chunk as the uploads share the DB session.
   if not batch_id:
-    result = model.get_all_success_details()
+    rows = model.iter_all_success_details(
+        lock=ingestion_manager.commit_lock)
   else:
-    result = model.get_batch_details(batch_id)
+    rows = model.iter_batch_details(
+        batch_id, lock=ingestion_manager.commit_lock)
 
-  if not result:
+  first = next(rows, None)
+  if first is None:
     error = "No batch with id = {0}".format(batch_id)
     return target_path, error
   # Make the outputstream for csv_path.
   csv_headerline = model.get_batch_details_fieldnames()
 
-  error = ""
-
-  if not os.path.isabs(target_path):
-    error = "File " + str(target_path) + " open error. It is not an absolute path."
-    logger.error(error)
-    return target_path, error
-  elif os.path.isdir(target_path):
-    error = "File " + str(target_path) + " open error. It is a directory."
-    logger.error(error)
+  error = _check_target_path(target_path)
+  if error:
     return target_path, error
 
   try:
@@ -54,80 +87,132 @@ def generateCSV(batch_id, target_path):
       csv_writer = csv.writer(csv_file, delimiter=',', quotechar='"',
                               quoting=csv.QUOTE_MINIMAL)
       csv_writer.writerow(csv_headerline)
-      logger.info("Write to CSV file: rows={0}.".format(len(result)))
-      csv_writer.writerows(result)
-      logger.info("CSV file is successfully written.")
+      count = _write_rows(csv_writer, itertools.chain([first], rows),
+                          target_path)
+      logger.info("CSV file is successfully written: rows={0}.".format(count))
   except IOError as ex:
     error = "File " + str(target_path) + " open error."
     logger.error(error)
 
   return target_path, error
 
-def generateZip(batch_id, target_path):
-  result = model.get_batch_details(batch_id)
-  if not result:
-    print "No batch with id = " + batch_id
-    return None
-
-  target_path, image_csv_path, stub_csv_path = _processTargetPaths(
-      target_path, batch_id)
-
-  # Make the outputstream for image_csv_file.
-  image_csv_headerline = ["id", "localpath"]
-  image_csv_content = []
-  for item in result:
-    tmp = []
-    tmp.append(item[1])
-    tmp.append(item[0])
-    image_csv_content.append(tmp)
-
-  with open(image_csv_path, 'wb') as image_csv_file:
-    csv_writer = csv.writer(image_csv_file, delimiter=',', quotechar='"',
-                            quoting=csv.QUOTE_MINIMAL)
-    csv_writer.writerow(image_csv_headerline)
-    csv_writer.writerows(image_csv_content)
-  
-  # Make the outputstream for stub_csv_path.
-  stub_csv_headerline = model.get_batch_details_fieldnames()
-  del stub_csv_headerline[0]
-  stub_csv_headerline.insert(0, "coreid")
-  del stub_csv_headerline[14]
-  
-  annotation = {}
+def _decode_annotations(value):
+  """
+  Returns the dict of the annotations of an image, stored as JSON. The
+  records of the older versions are Python literals, they are only tried
+  once the JSON decoding fails.
+  """
+  if not value:
+    return {}
   try:
-    annotation = ast.literal_eval(result[0][14])
-  except ex:
-    annotation = {}
-  for key in annotation:
-    stub_csv_headerline.append(key)
-
-  stub_csv_content = []
-
-  for item in result:
-    # Element 14 Annotations should be extended.
-    record = []
-    for element in item:
-      record.append(element)
-    annotation = item[14]
-    del record[14]
+    annotations = _json_decoder.decode(value)
+  except ValueError:
     try:
-      annotation = ast.literal_eval(item[14])
-    except ex:
-      annotation = {}
-    for key in annotation:
-      record.append(annotation[key])
-    stub_csv_content.append(record)
-
-  with open(stub_csv_path, 'wb') as stub_csv_file:
-    csv_writer = csv.writer(stub_csv_file, delimiter=',', quotechar='"',
-                            quoting=csv.QUOTE_MINIMAL)
-    csv_writer.writerow(stub_csv_headerline)
-    csv_writer.writerows(stub_csv_content)
-
-  # Put the two files into zip file.
-  zf = zipfile.ZipFile(target_path, "w")
-  zf.write(image_csv_path, constants.IMAGE_CSV_NAME)
-  zf.write(stub_csv_path, constants.STUB_CSV_NAME)
-  zf.close()
+      annotations = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+      logger.warning("Annotations not decoded: {0}".format(value))
+      return {}
+  if not isinstance(annotations, dict):
+    return {}
+  return annotations
+
+def generateIncrementalCSV(consumer, target_path, full=False):
+  """
+  Writes the records uploaded since the last export to consumer, all of them
+  with full or the first time, then moves the watermark of consumer to the
+  last record written. The watermark is only moved once the file is written,
+  a failed export is written again by the next one.
+  Returns: (target_path, error, the number of rows written).
+  """
+  error = _check_target_path(target_path)
+  if error:
+    return target_path, error, 0
+
+  lock = ingestion_manager.commit_lock
+  with lock:
+    after = None if full else model.get_export_watermark(consumer)
+  until = str(datetime.utcnow() - timedelta(seconds=WATERMARK_LAG))
+  watermark = [after]
+  def _rows():
+    for key, row in model.iter_uploaded_details(after, until, lock=lock):
+      watermark[0] = key
+      yield row
 
+  try:
+    with open(target_path, 'wb') as csv_file:
+      csv_writer = csv.writer(csv_file, delimiter=',', quotechar='"',
+                              quoting=csv.QUOTE_MINIMAL)
+      csv_writer.writerow(model.get_batch_details_fieldnames())
+      count = _write_rows(csv_writer, _rows(), target_path)
+  except IOError as ex:
+    error = "File " + str(target_path) + " open error."
+    logger.error(error)
+    return target_path, error, 0
+
+  with lock:
+    model.set_export_watermark(consumer, watermark[0], count)
+    model.commit()
+  logger.info("Incremental CSV file of {0} is successfully written: rows={1}, "
+              "after {2}.".format(consumer, count, after))
+  return target_path, error, count
+
+def generateZip(batch_id, target_path):
+  """
+  Writes the image.csv and stub.csv of the batch into a zip file, streamed
+  from the DB into the zip entries. stub.csv has one column per annotation
+  key of the batch, so the first pass, writing image.csv, collects them.
+  Returns: The path of the zip file, None if there is no such batch.
+  """
+  lock = ingestion_manager.commit_lock
+  rows = model.iter_batch_details(
+      batch_id, lock=lock, columns=(model.ImageRecord.MediaGUID,
+                                    model.ImageRecord.OriginalFileName,
+                                    model.ImageRecord.Annotations,
+                                    model.ImageRecord.BatchID))
+  first = next(rows, None)
+  if first is None:
+    print "No batch with id = " + str(batch_id)
+    return None
+  # The last batch is resolved once, a batch may start between the passes.
+  batch_id = first[3]
+  with lock:
+    target_path = _processTargetPath(target_path, batch_id)
+
+  keys = []
+  seen_keys = set()
+  with open(target_path, 'wb') as zip_file:
+    with zip_stream.ZipStreamWriter(zip_file, workers=ZIP_WORKERS) as zf:
+      with zf.open(constants.IMAGE_CSV_NAME) as image_csv_file:
+        csv_writer = csv.writer(image_csv_file, delimiter=',', quotechar='"',
+                                quoting=csv.QUOTE_MINIMAL)
+        csv_writer.writerow(["id", "localpath"])
+        for mediaguid, path, annotations, _junk in itertools.chain(
+            [first], rows):
+          csv_writer.writerow([mediaguid, path])
+          for key in _decode_annotations(annotations):
+            if key not in seen_keys:
+              seen_keys.add(key)
+              keys.append(key)
+
+      stub_csv_headerline = model.get_batch_details_fieldnames()
+      annotations_index = stub_csv_headerline.index("Annotations")
+      stub_csv_headerline[0] = "coreid"
+      del stub_csv_headerline[annotations_index]
+      with zf.open(constants.STUB_CSV_NAME) as stub_csv_file:
+        csv_writer = csv.writer(stub_csv_file, delimiter=',', quotechar='"',
+                                quoting=csv.QUOTE_MINIMAL)
+        csv_writer.writerow(stub_csv_headerline + keys)
+        count = 0
+        for item in model.iter_batch_details(batch_id, lock=lock):
+          # The Annotations are extended to one column per key.
+          record = list(item)
+          annotations = _decode_annotations(record.pop(annotations_index))
+          record.extend([annotations.get(key, "") for key in keys])
+          csv_writer.writerow(record)
+          count += 1
+          if count % PROGRESS_INTERVAL == 0:
+            logger.info("Write to zip file {0}: {1} rows written.".format(
+                target_path, count))
+
+  logger.info("Zip file is successfully written: rows={0}.".format(count))
   return target_path
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module implements the retries of the failed uploads: a delay queue that
+puts the failed items back into the upload stage after a jittered exponential
+backoff, within a retry budget, and a circuit breaker that pauses the uploads
+while the server is unhealthy.
+The upload workers do not sleep between the attempts of a file, they upload
+the other files meanwhile.
+"""
+import heapq, itertools, logging, random, threading, time
+
+logger = logging.getLogger('iDigBioSvc.retry_scheduler')
+
+
+class RetryScheduler(threading.Thread):
+  """
+  Puts the scheduled items back into a stage once their delay has passed.
+  The delay of the nth retry of an item is drawn between half and all of
+  base_delay * 2 ** (n - 1), capped at max_delay, so the retries of the files
+  that failed together are spread out.
+  The retries are capped per item by max_retries and in total by the budget:
+  min_retries plus budget_ratio of the requests started, so an unhealthy
+  server does not get a multiple of the normal load.
+  Params:
+    stage: Where the due items are put back, with put(item). hold() is
+           called for each scheduled item and unhold() once it is put back or
+           dropped, so the stage does not finish while retries are pending.
+           E.g. a pipeline Stage.
+  """
+  def __init__(self, stage, base_delay=1.0, max_delay=16.0, max_retries=4,
+               budget_ratio=0.2, min_retries=10):
+    threading.Thread.__init__(self, name="retry_scheduler")
+    self.daemon = True
+    self.stage = stage
+    self.base_delay = float(base_delay)
+    self.max_delay = float(max_delay)
+    self.max_retries = int(max_retries)
+    self.budget_ratio = float(budget_ratio)
+    self.min_retries = int(min_retries)
+    self._cond = threading.Condition(threading.Lock())
+    self._heap = []
+    self._seq = itertools.count()
+    self._attempts = {} # key -> retries scheduled so far
+    self._stopped = False
+
+    self._requests = 0
+    self._retries = 0
+    self._exhausted = 0
+    self._over_budget = 0
+    self._dropped = 0
+
+  def backoff(self, retry):
+    """Returns the delay in seconds of the given retry of an item (from 1)."""
+    delay = min(self.base_delay * 2 ** (retry - 1), self.max_delay)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+  def started(self, key):
+    """Counts a request, unless it is a retry of key."""
+    with self._cond:
+      if key not in self._attempts:
+        self._requests += 1
+
+  def schedule(self, item, key):
+    """
+    Schedules a retry of item, the key identifying it between its attempts.
+    Returns: The delay in seconds, None if the item is not retried as it used
+             up its retries or the retry budget is spent.
+    """
+    with self._cond:
+      retry = self._attempts.get(key, 0) + 1
+      if self._stopped:
+        return None
+      if retry > self.max_retries:
+        self._attempts.pop(key, None)
+        self._exhausted += 1
+        return None
+      if self._retries >= self.min_retries + self.budget_ratio * self._requests:
+        self._attempts.pop(key, None)
+        self._over_budget += 1
+        logger.warning("Retry budget spent, {0} is not retried.".format(key))
+        return None
+      self._attempts[key] = retry
+      self._retries += 1
+      delay = self.backoff(retry)
+      # Held before the item leaves the stage, so it cannot finish meanwhile.
+      self.stage.hold()
+      heapq.heappush(self._heap, (time.time() + delay, next(self._seq), item))
+      self._cond.notify()
+    return delay
+
+  def done(self, key):
+    """Forgets the retries of key, once it succeeded or failed for good."""
+    with self._cond:
+      self._attempts.pop(key, None)
+
+  def pending(self):
+    """The number of items waiting for their retry."""
+    with self._cond:
+      return len(self._heap)
+
+  def stop(self):
+    """Drops the pending retries and waits for the scheduler to exit."""
+    with self._cond:
+      self._stopped = True
+      self._cond.notify()
+    if self.isAlive():
+      self.join()
+
+  def run(self):
+    while True:
+      with self._cond:
+        while not self._stopped:
+          if self._heap:
+            wait = self._heap[0][0] - time.time()
+            if wait <= 0:
+              break
+            self._cond.wait(wait)
+          else:
+            self._cond.wait()
+        if self._stopped:
+          dropped, self._heap = self._heap, []
+          self._dropped += len(dropped)
+          break
+        _junk, _junk, item = heapq.heappop(self._heap)
+      # Blocks while the stage is full, so the lock is not held.
+      try:
+        self.stage.put(item)
+      finally:
+        self.stage.unhold()
+    for _junk in dropped:
+      self.stage.unhold()
+    logger.debug("Retry scheduler stopped: {0}".format(self.stats()))
+
+  def stats(self):
+    """Returns the pending retries and the retry budget use."""
+    with self._cond:
+      return dict(
+          pending=len(self._heap), requests=self._requests,
+          retries=self._retries, exhausted=self._exhausted,
+          over_budget=self._over_budget, dropped=self._dropped,
+          budget=self.min_retries + self.budget_ratio * self._requests)
+
+
+class CircuitBreaker(object):
+  """
+  Pauses the requests to an unhealthy server.
+  It opens after failure_threshold consecutive failures. While it is open,
+  wait() blocks; after reset_timeout seconds it is half open and lets a single
+  trial request through. The breaker closes if the trial succeeds, else it
+  opens again for twice as long, up to max_reset_timeout.
+  The callers of wait() report the outcome of their request with record(),
+  passing it what wait() returned so the trial request is told apart.
+  """
+  CLOSED = "closed"
+  OPEN = "open"
+  HALF_OPEN = "half-open"
+  """Returned by wait() to the caller that sends the trial request."""
+  TRIAL = "trial"
+
+  def __init__(self, failure_threshold=5, reset_timeout=5.0,
+               max_reset_timeout=120.0):
+    self.failure_threshold = max(int(failure_threshold), 1)
+    self.base_reset_timeout = float(reset_timeout)
+    self.max_reset_timeout = float(max_reset_timeout)
+    self._cond = threading.Condition(threading.Lock())
+    self._state = self.CLOSED
+    self._failures = 0
+    self._reset_timeout = self.base_reset_timeout
+    self._retry_at = 0.0
+    self._trial = False
+    self._opened_at = None
+    self._cancelled = False
+    self._opens = 0
+
+  def wait(self):
+    """
+    Blocks while the breaker is open.
+    Returns: False if cancel() was called, TRIAL to the caller of the trial
+             request, else True.
+    """
+    with self._cond:
+      while not self._cancelled:
+        if self._state == self.CLOSED:
+          return True
+        now = time.time()
+        if self._state == self.OPEN and now >= self._retry_at:
+          self._state = self.HALF_OPEN
+          logger.info("Circuit breaker half open, sending a trial request.")
+        if self._state == self.HALF_OPEN and not self._trial:
+          self._trial = True
+          return self.TRIAL
+        if self._state == self.OPEN:
+          self._cond.wait(self._retry_at - now)
+        else:
+          self._cond.wait()
+      return False
+
+  def record(self, ok, token=True):
+    """
+    Reports the outcome of a request: True if the server handled it, False if
+    the server failed, None if the request was not made.
+    token is what wait() returned, only the trial request decides whether a
+    half open breaker closes or opens again.
+    """
+    with self._cond:
+      trial = token == self.TRIAL and self._trial
+      if trial:
+        self._trial = False
+      if ok is None:
+        if trial:
+          self._cond.notify()
+        return
+      if ok:
+        self._failures = 0
+        if self._state != self.CLOSED:
+          logger.info("Circuit breaker closed, the server is back after "
+              "{0:.1f} sec.".format(time.time() - self._opened_at))
+          self._state = self.CLOSED
+          self._reset_timeout = self.base_reset_timeout
+          self._opened_at = None
+          self._cond.notify_all()
+        return
+      self._failures += 1
+      if self._state == self.HALF_OPEN:
+        if not trial:
+          return # A request let through before the breaker opened.
+        self._reset_timeout = min(self._reset_timeout * 2,
+                                  self.max_reset_timeout)
+        self._open()
+      elif (self._state == self.CLOSED and
+            self._failures >= self.failure_threshold):
+        self._open()
+
+  def _open(self):
+    self._state = self.OPEN
+    self._retry_at = time.time() + self._reset_timeout
+    if self._opened_at is None:
+      self._opened_at = time.time()
+    self._opens += 1
+    logger.warning("Circuit breaker open after {0} failures, uploads paused "
+        "for {1:.1f} sec.".format(self._failures, self._reset_timeout))
+    self._cond.notify_all()
+
+  def cancel(self):
+    """Wakes up the waiting callers, wait() returns False from now on."""
+    with self._cond:
+      self._cancelled = True
+      self._cond.notify_all()
+
+  def get_state(self):
+    with self._cond:
+      return self._state
+
+  def unhealthy_for(self):
+    """Seconds since the breaker opened without closing again, else 0."""
+    with self._cond:
+      if self._opened_at is None:
+        return 0.0
+      return time.time() - self._opened_at
+
+  def stats(self):
+    """Returns the state, the consecutive failures and the opens."""
+    with self._cond:
+      return dict(
+          state=self._state, consecutive_failures=self._failures,
+          opens=self._opens, reset_timeout=self._reset_timeout,
+          unhealthy_for=(time.time() - self._opened_at
+                         if self._opened_at is not None else 0.0))
@@ -12,7 +12,7 @@ from cherrypy import HTTPError
 from cherrypy._cpcompat import ntob
 from dataingestion.services import (constants, ingestion_service, csv_generator,
                                     ingestion_manager, api_client, model,
-                                    result_generator, user_config)
+                                    result_generator, user_config, metrics)
 
 logger = logging.getLogger('iDigBioSvc.service_rest')
 
@@ -98,6 +98,13 @@ class UserConfig(object):
     Sets a user configuration name with a value.
     """
     logger.debug("UserConfig POST: {0}, {1}".format(name, value))
+    if name == user_config.UPLOAD_RATE_SCHEDULE:
+      # Takes effect immediately, for the ongoing upload too.
+      try:
+        api_client.set_rate_schedule(value)
+      except ValueError as ex:
+        logger.error(str(ex))
+        raise JsonHTTPError(400, str(ex))
     ingestion_service.set_user_config(name, value)
 
   def DELETE(self):
@@ -129,9 +136,11 @@ class LastBatchInfo(object):
 class IngestionProgress(object):
   exposed = True
 
-  def GET(self, **params):
+  def GET(self, task=None, version=None, **params):
     """
     Get ingestion status.
+    With the task and version of the last status received, it is a long poll:
+    it returns once the status changes, see ingestion_manager.wait_progress.
     """
     # **params added by Kyuho in July 23rd 2013 
     # It is required to accept dummy parameters. 
@@ -139,14 +148,21 @@ class IngestionProgress(object):
     # cache. Internet explorer does execute $.get when the url is the same for
     # the time being. 
     try:
+      if task is not None and version is not None:
+        try:
+          return json.dumps(ingestion_manager.wait_progress(task, version))
+        except ValueError:
+          raise JsonHTTPError(400, "Error: task and version must be integers.")
+      progress, counters = ingestion_manager.get_progress_counters()
       (fatal_server_error, input_csv_error, total, skips, successes, fails,
-       csvuploaded, finished) = ingestion_manager.get_progress()
+       csvuploaded, finished) = progress
       return json.dumps(
           dict(fatal_server_error=fatal_server_error,
                input_csv_error=input_csv_error, total=total,
                successes=successes, skips=skips, fails=fails,
                csvuploaded=csvuploaded,
-               finished=finished))
+               finished=finished, bytes=counters["bytes"],
+               upload_seconds=counters["upload_seconds"]))
     except IngestServiceException as ex:
       error = "Error: " + str(ex)
       print error
@@ -154,6 +170,33 @@ class IngestionProgress(object):
       raise JsonHTTPError(409, str(ex))
 
 
+class ProgressStream(object):
+  """
+  Pushes the ingestion status as Server-Sent Events, one "data:" line of the
+  JSON status per change. The stream ends once the task is finished.
+  """
+  exposed = True
+  _cp_config = {'response.stream': True}
+
+  def GET(self, **params):
+    try:
+      events = ingestion_manager.watch_progress()
+    except IngestServiceException as ex:
+      logger.error("Error: " + str(ex))
+      raise JsonHTTPError(409, str(ex))
+    cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+    cherrypy.response.headers['Cache-Control'] = 'no-cache'
+    def _stream():
+      # Tells the browser to reconnect after 1 sec if the stream breaks.
+      yield ntob("retry: 1000\n\n")
+      for progress in events:
+        if progress is None:
+          yield ntob(": keep-alive\n\n") # Also detects a closed client.
+        else:
+          yield ntob("data: {0}\n\n".format(json.dumps(progress)))
+    return _stream()
+
+
 class IngestionResult(object):
   exposed = True
   
@@ -173,14 +216,133 @@ class IngestionResult(object):
       raise JsonHTTPError(409, str(ex))
 
 
+class Concurrency(object):
+  exposed = True
+
+  def GET(self, **params):
+    """
+    Returns the upload concurrency limit and the measured latency, throughput
+    and error rate.
+    """
+    logger.debug("Concurrency GET.")
+    return json.dumps(ingestion_manager.get_concurrency())
+
+  def POST(self, limit, auto="false"):
+    """
+    Overrides the upload concurrency limit. With auto=true the controller
+    keeps adapting it from the new value, otherwise it stays fixed.
+    """
+    logger.debug("Concurrency POST: limit={0}, auto={1}".format(limit, auto))
+    try:
+      limit = int(limit)
+    except ValueError:
+      raise JsonHTTPError(400, "Error: limit must be an integer.")
+    ingestion_manager.set_concurrency(limit, auto.lower() == "true")
+    return json.dumps(ingestion_manager.get_concurrency())
+
+
+class ConnectionPool(object):
+  exposed = True
+
+  def GET(self, **params):
+    """
+    Returns the stats of the keep-alive connections to the storage API.
+    """
+    logger.debug("ConnectionPool GET.")
+    return json.dumps(api_client.get_pool_stats())
+
+
+class RateLimit(object):
+  exposed = True
+
+  def GET(self, **params):
+    """
+    Returns the upload rate schedule, the current rate and the throttle delay
+    added to the uploads.
+    """
+    logger.debug("RateLimit GET.")
+    return json.dumps(api_client.get_rate_stats())
+
+
+class Timeouts(object):
+  exposed = True
+
+  def GET(self, **params):
+    """
+    Returns the throughput estimate the request timeouts are derived from and
+    the counts of the stalled and the timed out requests.
+    """
+    logger.debug("Timeouts GET.")
+    return json.dumps(api_client.get_timeout_stats())
+
+
+class PipelineStats(object):
+  exposed = True
+
+  def GET(self, **params):
+    """
+    Returns the current and peak queue depths of the upload stages and the
+    memory used by the service.
+    """
+    logger.debug("PipelineStats GET.")
+    return json.dumps(ingestion_manager.get_pipeline_stats())
+
+
+class Metrics(object):
+  exposed = True
+
+  def GET(self, format=None, **params):
+    """
+    Returns the upload metrics: the stage, DB commit and POST latency
+    histograms, the images and bytes uploaded, the rates, retries, queue
+    depths and active workers.
+    They are in the Prometheus text format with format=prometheus, or if the
+    client accepts text/plain but not JSON (a Prometheus scraper), else JSON.
+    """
+    logger.debug("Metrics GET.")
+    accept = cherrypy.request.headers.get('Accept', '')
+    if format is None:
+      prometheus = 'text/plain' in accept and 'application/json' not in accept
+    elif format in ('prometheus', 'json'):
+      prometheus = format == 'prometheus'
+    else:
+      raise JsonHTTPError(400, "Error: format must be json or prometheus.")
+    if prometheus:
+      cherrypy.response.headers['Content-Type'] = (
+          metrics.PROMETHEUS_CONTENT_TYPE)
+      return ingestion_manager.get_metrics(True)
+    cherrypy.response.headers['Content-Type'] = 'application/json'
+    return json.dumps(ingestion_manager.get_metrics())
+
+
 class History(object):
   exposed = True
   
-  def GET(self, table_id):
+  def GET(self, table_id="", sEcho=None, iDisplayStart=0, iDisplayLength=10,
+          iSortingCols=0, iSortCol_0=None, sSortDir_0="asc", sSearch="",
+          status="", **params):
     """
     Get the history of batches or images (depends on table_id).
+    With sEcho, it is a request of a DataTables table processed on the server
+    and only the requested page is returned: iDisplayStart and
+    iDisplayLength select the rows, iSortCol_0 and sSortDir_0 the order,
+    sSearch and status ("uploaded" or "failed", for images) filter them.
     """
     logger.debug("History GET: table_id={0}".format(table_id))
+    if sEcho is not None:
+      try:
+        echo = int(sEcho)
+        sort_column = int(iSortCol_0) if int(iSortingCols) else None
+        total, matching, rows = ingestion_manager.get_history_page(
+            table_id, int(iDisplayStart), int(iDisplayLength), sort_column,
+            sSortDir_0 == "desc", sSearch, status)
+      except ValueError:
+        raise JsonHTTPError(400, "Error: The paging parameters must be "
+                            "integers.")
+      except IngestServiceException as ex:
+        raise JsonHTTPError(400, "Error: " + str(ex))
+      return json.dumps(dict(sEcho=echo, iTotalRecords=total,
+                             iTotalDisplayRecords=matching, aaData=rows))
     try:
       result = ingestion_manager.get_history(table_id)
       resultdump = json.dumps(result)
@@ -261,9 +423,28 @@ class CsvIngestionService(object):
       raise JsonHTTPError(409, str(ex)) 
 
 
+class RetryIngestion(object):
+  exposed = True
+
+  def POST(self, batch_id=None):
+    """
+    Uploads the failed images of the batch with batch_id again, or of all the
+    batches if batch_id is not given. The CSV file is not read again.
+    """
+    logger.debug("RetryIngestion POST: batch_id={0}".format(batch_id))
+    if batch_id:
+      try:
+        batch_id = int(batch_id)
+      except ValueError:
+        raise JsonHTTPError(400, "Error: batch_id must be an integer.")
+    ingestion_service.start_retry(batch_id or None)
+
+
 class GenerateAllCsv(object):
   """
-  Generate the output CSV files, and put them into a zip file.
+  Generate the output CSV file of all the uploaded images.
+  With a consumer, only the images uploaded since its last export are
+  written, all of them with full, see result_generator.generateIncrementalCSV.
   """
   exposed = True
 
@@ -271,6 +452,10 @@ class GenerateAllCsv(object):
     logger.debug("DownloadAllCsv GET.")
     try:
       dic = ast.literal_eval(values) # Parse the string to dictionary.
+      if dic.get('consumer'):
+        path, error, rows = result_generator.generateIncrementalCSV(
+            dic['consumer'], dic['target_path'], bool(dic.get('full')))
+        return json.dumps(dict(path=path, error=error, rows=rows))
       path, error = result_generator.generateCSV(
           None, dic['target_path'])
       return json.dumps(dict(path=path, error=error))
@@ -339,8 +524,16 @@ class DataIngestionService(object):
     self.config = UserConfig()
     self.lastbatchinfo = LastBatchInfo()
     self.ingest = CsvIngestionService()
+    self.retry = RetryIngestion()
     self.ingestionprogress = IngestionProgress()
+    self.progressstream = ProgressStream()
     self.ingestionresult = IngestionResult()
+    self.concurrency = Concurrency()
+    self.connectionpool = ConnectionPool()
+    self.ratelimit = RateLimit()
+    self.timeouts = Timeouts()
+    self.pipeline = PipelineStats()
+    self.metrics = Metrics()
     self.history = History()
     self.generatecsv = GenerateCSV()
     self.csvgenprogress = CSVGenProgress()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module derives the timeout of a request from the size of its body and
+the throughput measured on the recent uploads, so a large file gets the time
+it needs while a small one still fails fast.
+"""
+import logging, threading
+
+logger = logging.getLogger('iDigBioSvc.timeouts')
+
+"""Smaller bodies measure the latency more than the throughput."""
+MIN_SAMPLE_SIZE = 256 * 2 ** 10
+"""The weight of a new sample in the moving average."""
+EWMA_WEIGHT = 0.2
+"""The throughput estimate never drops below this, in bytes/sec."""
+MIN_THROUGHPUT = 4 * 2 ** 10
+
+
+class AdaptiveTimeout(object):
+  """
+  The timeout of a request is min_timeout plus safety_factor times the time
+  its body takes at the measured throughput: a moving average of the bytes/sec
+  of one request, initial_throughput until the first sample. A request that
+  times out halves the estimate, so a slower link does not fail every upload.
+  Independently of the size, a request fails if no bytes move for
+  stall_timeout seconds, see HTTPConnectionPool.request.
+  """
+  def __init__(self, min_timeout=10.0, stall_timeout=20.0,
+               initial_throughput=64 * 2 ** 10, safety_factor=4.0):
+    self.min_timeout = float(min_timeout)
+    self.stall_timeout = float(stall_timeout)
+    self.safety_factor = float(safety_factor)
+    self._lock = threading.Lock()
+    self._throughput = float(initial_throughput)
+    self._samples = 0
+    self._max_timeout = 0.0
+
+  def set_stall_timeout(self, seconds):
+    """Sets the seconds without progress after which a request fails."""
+    seconds = float(seconds)
+    if seconds <= 0:
+      raise ValueError("The stall timeout must be positive.")
+    self.stall_timeout = seconds
+
+  def get(self, size):
+    """Returns the timeout in seconds of a request with a size bytes body."""
+    with self._lock:
+      timeout = self.min_timeout + self.safety_factor * size / self._throughput
+      self._max_timeout = max(self._max_timeout, timeout)
+    return timeout
+
+  def record(self, size, duration):
+    """Records a request that sent size bytes in duration seconds."""
+    if size < MIN_SAMPLE_SIZE or duration <= 0:
+      return
+    with self._lock:
+      sample = size / duration
+      if self._samples:
+        self._throughput += EWMA_WEIGHT * (sample - self._throughput)
+      else:
+        self._throughput = sample
+      self._throughput = max(self._throughput, MIN_THROUGHPUT)
+      self._samples += 1
+
+  def timed_out(self):
+    """Records a request that exceeded its timeout."""
+    with self._lock:
+      self._throughput = max(self._throughput / 2, MIN_THROUGHPUT)
+      throughput = self._throughput
+    logger.warning("Request timed out, throughput estimate lowered to "
+        "{0:.0f} bytes/sec.".format(throughput))
+
+  def stats(self):
+    """Returns the throughput estimate and the largest timeout given."""
+    with self._lock:
+      return dict(
+          throughput=self._throughput, samples=self._samples,
+          min_timeout=self.min_timeout, stall_timeout=self.stall_timeout,
+          safety_factor=self.safety_factor, max_timeout=self._max_timeout)
@@ -5,6 +5,8 @@ import ConfigParser
 CONFIG_SECTION = 'iDigBio'
 DISABLE_CHECK = "devmode_disable_startup_service_check"
 IDIGBIOPROVIDEDBYGUID = 'accountuuid'
+# e.g. "08:00-18:00=2M", see rate_limiter.parse_schedule.
+UPLOAD_RATE_SCHEDULE = 'uploadrateschedule'
 
 CSV_PATH = 'CSVfilePath'
 RECORDSET_GUID = 'RecordSetGUID'
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distributed according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+"""
+This module writes zip files whose entries are streamed: the data of an entry
+is compressed and written as it comes, its size and CRC follow it in a data
+descriptor, so neither the entry nor a temporary file is held whole.
+The zipfile module of Python 2 only adds whole files or strings.
+The compression can be spread over a pool of threads, one chunk each.
+"""
+import collections, struct, time, zipfile, zlib
+from multiprocessing.pool import ThreadPool
+
+CHUNK_SIZE = 2 ** 20 # 1 MB
+"""The flags of an entry: its sizes and CRC are in the data descriptor."""
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+_VERSION = 20
+"""Made on Unix, for the file permissions."""
+_CREATE_SYSTEM = 3
+_MAX_SIZE = 0xFFFFFFFF
+
+_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+_DATA_DESCRIPTOR = struct.Struct("<4s3L")
+_CENTRAL_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+_END_OF_CENTRAL_DIR = struct.Struct("<4s4H2LH")
+
+
+def _deflate_chunk(data, level, final):
+  """
+  Compresses one chunk into a raw deflate stream of its own, ended by a sync
+  flush so the streams of the chunks are one stream end to end, or by the
+  final block for the last chunk.
+  """
+  compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+  return compressor.compress(data) + compressor.flush(
+      zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class ZipStreamWriter(object):
+  """
+  Writes a zip file to fileobj, which only needs write(). The entries are
+  written one at a time: open(name) returns the entry to write to, it must be
+  closed before the next one is opened.
+  Params:
+    compress: Deflate the entries, else store them.
+    workers: With more than one, the chunks of an entry are compressed by a
+             pool of that many threads, as zlib releases the GIL. Each chunk
+             starts a new dictionary, the output is a little larger.
+  """
+  def __init__(self, fileobj, compress=True, workers=0, level=6,
+               chunk_size=CHUNK_SIZE):
+    self.fileobj = fileobj
+    self.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    self.level = level
+    self.chunk_size = int(chunk_size)
+    self.workers = int(workers or 0)
+    self._pool = ThreadPool(self.workers) if self.workers > 1 else None
+    self._offset = 0
+    self._entries = []
+    self._entry = None
+    self._closed = False
+
+  def _write(self, data):
+    if data:
+      self.fileobj.write(data)
+      self._offset += len(data)
+
+  def open(self, name, date_time=None):
+    """Starts the entry name, returns it to write its data to."""
+    if self._closed:
+      raise ValueError("Write to a closed zip file.")
+    if self._entry is not None:
+      raise ValueError("The entry {0} is not closed.".format(self._entry.name))
+    self._entry = _ZipEntry(self, name, date_time or time.localtime()[:6])
+    return self._entry
+
+  def _closed_entry(self, entry):
+    self._entries.append(entry)
+    self._entry = None
+
+  def close(self):
+    """Writes the central directory. The file object is not closed."""
+    if self._closed:
+      return
+    if self._entry is not None:
+      self._entry.close()
+    self._closed = True
+    if self._pool:
+      self._pool.close()
+      self._pool.join()
+    start = self._offset
+    if len(self._entries) > 0xFFFF or start > _MAX_SIZE:
+      raise zipfile.LargeZipFile("Zip file would require ZIP64 extensions.")
+    for entry in self._entries:
+      self._write(_CENTRAL_HEADER.pack(
+          "PK\x01\x02", _VERSION, _CREATE_SYSTEM, _VERSION, 0, entry.flags,
+          entry.compress_type, entry.dostime, entry.dosdate, entry.crc,
+          entry.compress_size, entry.file_size, len(entry.filename), 0, 0, 0,
+          0, 0644 << 16, entry.header_offset) + entry.filename)
+    self._write(_END_OF_CENTRAL_DIR.pack(
+        "PK\x05\x06", 0, 0, len(self._entries), len(self._entries),
+        self._offset - start, start, 0))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    # A failed export leaves a truncated file rather than one that looks fine.
+    if exc_type is None:
+      self.close()
+    elif self._pool:
+      self._pool.terminate()
+
+
+class _ZipEntry(object):
+  """An entry of a ZipStreamWriter, its data is written with write()."""
+  def __init__(self, zip_writer, name, date_time):
+    self.zip_writer = zip_writer
+    self.name = name
+    if isinstance(name, unicode):
+      self.filename = name.encode("utf-8")
+      self.flags = _FLAG_DATA_DESCRIPTOR | _FLAG_UTF8
+    else:
+      self.filename = name
+      self.flags = _FLAG_DATA_DESCRIPTOR
+    self.compress_type = zip_writer.compress_type
+    year, month, day, hour, minute, second = date_time
+    self.dosdate = (year - 1980) << 9 | month << 5 | day
+    self.dostime = hour << 11 | minute << 5 | second // 2
+    self.crc = 0
+    self.file_size = 0
+    self.compress_size = 0
+    self.header_offset = zip_writer._offset
+    self._buffer = []
+    self._buffered = 0
+    self._pending = collections.deque()
+    self._compressor = None
+    if (self.compress_type == zipfile.ZIP_DEFLATED and
+        not zip_writer._pool):
+      self._compressor = zlib.compressobj(
+          zip_writer.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    self._closed = False
+    zip_writer._write(_LOCAL_HEADER.pack(
+        "PK\x03\x04", _VERSION, 0, self.flags, self.compress_type,
+        self.dostime, self.dosdate, 0, 0, 0, len(self.filename), 0) +
+        self.filename)
+
+  def write(self, data):
+    if self._closed:
+      raise ValueError("Write to a closed zip entry.")
+    if isinstance(data, unicode):
+      data = data.encode("utf-8")
+    self._buffer.append(data)
+    self._buffered += len(data)
+    if self._buffered >= self.zip_writer.chunk_size:
+      self._flush_chunk(False)
+
+  def _flush_chunk(self, final):
+    data = "".join(self._buffer)
+    self._buffer = []
+    self._buffered = 0
+    self.crc = zlib.crc32(data, self.crc)
+    self.file_size += len(data)
+    pool = self.zip_writer._pool
+    if self.compress_type == zipfile.ZIP_STORED:
+      self._output(data)
+    elif not pool:
+      self._output(self._compressor.compress(data))
+      if final:
+        self._output(self._compressor.flush())
+    else:
+      self._pending.append(pool.apply_async(
+          _deflate_chunk, (data, self.zip_writer.level, final)))
+      # The chunks are written in order, a few compress meanwhile.
+      limit = 0 if final else 2 * self.zip_writer.workers
+      while self._pending and (len(self._pending) > limit or
+                               self._pending[0].ready()):
+        self._output(self._pending.popleft().get())
+
+  def _output(self, data):
+    self.compress_size += len(data)
+    self.zip_writer._write(data)
+
+  def close(self):
+    if self._closed:
+      return
+    self._flush_chunk(True)
+    self._closed = True
+    if self.file_size > _MAX_SIZE or self.compress_size > _MAX_SIZE:
+      raise zipfile.LargeZipFile("Zip entry {0} would require ZIP64 "
+                                 "extensions.".format(self.name))
+    self.crc &= 0xFFFFFFFF
+    self.zip_writer._write(_DATA_DESCRIPTOR.pack(
+        "PK\x07\x08", self.crc, self.compress_size, self.file_size))
+    self.zip_writer._closed_entry(self)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
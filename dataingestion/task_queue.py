@@ -9,13 +9,20 @@ import Queue, cherrypy
 import threading
 from cherrypy.process.plugins import SimplePlugin
 
+# Put by stop() to wake the thread up.
+_STOP = object()
+
 class BackgroundTaskQueue(SimplePlugin): 
+  """
+  Runs the functions put into it in a background thread, which blocks on the
+  queue while it is empty. With safe_stop, stop() lets the queued functions
+  run first.
+  """
   thread = None
 
-  def __init__(self, bus, qsize=100, qwait=2, safe_stop=True):
+  def __init__(self, bus, qsize=100, safe_stop=True):
     SimplePlugin.__init__(self, bus)
     self.q = Queue.Queue(qsize)
-    self.qwait = qwait
     self.safe_stop = safe_stop
 
   def start(self):
@@ -25,12 +32,15 @@ class BackgroundTaskQueue(SimplePlugin):
       self.thread.start()
 
   def stop(self):
-    if self.safe_stop:
-      self.running = "draining"
-    else:
-      self.running = False
-
     if self.thread:
+      if self.safe_stop:
+        self.q.put(_STOP)
+      else:
+        self.running = False
+        try:
+          self.q.put_nowait(_STOP)
+        except Queue.Full:
+          pass # The thread is busy, it sees running once it is done.
       self.thread.join()
       self.thread = None
     self.running = False
@@ -38,16 +48,14 @@ class BackgroundTaskQueue(SimplePlugin):
   def run(self):
     while self.running:
       try:
+        item = self.q.get()
         try:
-          func, args, kwargs = self.q.get(block=True, timeout=self.qwait)
-        except Queue.Empty:
-          if self.running == "draining":
+          if item is _STOP:
             return
-          continue
-        else:
+          func, args, kwargs = item
           func(*args, **kwargs)
-          if hasattr(self.q, 'task_done'):
-            self.q.task_done()
+        finally:
+          self.q.task_done()
       except:
         self.bus.log("Error in BackgroundTaskQueue %r." % self,
                level=40, traceback=True)
@@ -7,7 +7,10 @@ multipart/form-data is the standard way to upload files over HTTP"""
 
 __all__ = ['gen_boundary', 'encode_and_quote', 'MultipartParam',
         'encode_string', 'encode_file_header', 'get_body_size', 'get_headers',
-        'multipart_encode']
+        'multipart_encode', 'FileSegment', 'BLOCK_SIZE']
+
+# The size of the blocks read from a file when it is not sent with sendfile.
+BLOCK_SIZE = 64 * 1024
 
 try:
     import uuid
@@ -47,6 +50,15 @@ def _strify(s):
         return s.encode("utf-8")
     return str(s)
 
+class FileSegment(object):
+    """``size`` bytes of ``fileobj`` from ``offset``, yielded by
+    iter_segments so that the sender can pass the file to sendfile instead of
+    reading it into memory."""
+    def __init__(self, fileobj, offset, size):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.size = size
+
 class MultipartParam(object):
     """Represents a single parameter in a multipart/form-data request
 
@@ -217,7 +229,21 @@ class MultipartParam(object):
 
         return "%s%s\r\n" % (self.encode_hdr(boundary), value)
 
-    def iter_encode(self, boundary, blocksize=4096):
+    def iter_segments(self, boundary):
+        """Like iter_encode, but the content of a real file (one with a
+        fileno) is yielded as a single FileSegment instead of blocks of
+        data."""
+        fileno = getattr(self.fileobj, 'fileno', None)
+        if self.value is not None or fileno is None:
+            for block in self.iter_encode(boundary):
+                yield block
+            return
+        block = self.encode_hdr(boundary)
+        yield block
+        yield FileSegment(self.fileobj, self.fileobj.tell(), self.filesize)
+        yield "\r\n"
+
+    def iter_encode(self, boundary, blocksize=BLOCK_SIZE):
         """Yields the encoding of this parameter
         If self.fileobj is set, then blocks of ``blocksize`` bytes are read and
         yielded."""
@@ -357,8 +383,28 @@ class multipart_yielder:
         self.i += 1
         return self.next()
 
+    def iter_segments(self):
+        """Yields the strings and FileSegments that make up the encoding
+        of the parameters, see MultipartParam.iter_segments."""
+        for p in self.params:
+            for segment in p.iter_segments(self.boundary):
+                if isinstance(segment, FileSegment):
+                    self.current += segment.size
+                else:
+                    self.current += len(segment)
+                yield segment
+                if self.cb:
+                    self.cb(p, self.current, self.total)
+        block = "--%s--\r\n" % self.boundary
+        self.current += len(block)
+        yield block
+        if self.cb:
+            self.cb(None, self.current, self.total)
+
     def reset(self):
         self.i = 0
+        self.p = None
+        self.param_iter = None
         self.current = 0
         for param in self.params:
             param.reset()
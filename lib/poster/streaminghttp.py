@@ -26,8 +26,26 @@ Example usage:
 ...                       {'Content-Length': str(len(s))})
 """
 
-import httplib, urllib2, socket
+import httplib, urllib2, socket, select, errno
 from httplib import NotConnected
+from poster.encode import FileSegment, BLOCK_SIZE
+
+try:
+    from os import sendfile as _sendfile
+except ImportError:
+    try:
+        # py-sendfile, the Python 2 backport of os.sendfile.
+        from sendfile import sendfile as _sendfile
+    except ImportError:
+        _sendfile = None
+
+try:
+    from ssl import SSLSocket as _SSLSocket
+except ImportError:
+    _SSLSocket = None
+
+# The most bytes passed to one sendfile call.
+SENDFILE_CHUNK = 8 * 1024 * 1024
 
 __all__ = ['StreamingHTTPConnection', 'StreamingHTTPRedirectHandler',
         'StreamingHTTPHandler', 'register_openers']
@@ -35,15 +53,82 @@ __all__ = ['StreamingHTTPConnection', 'StreamingHTTPRedirectHandler',
 if hasattr(httplib, 'HTTPS'):
     __all__.extend(['StreamingHTTPSHandler', 'StreamingHTTPSConnection'])
 
+def _can_sendfile(sock):
+    """sendfile only works on a plain socket, the kernel cannot encrypt."""
+    return (_sendfile is not None and
+            not (_SSLSocket is not None and isinstance(sock, _SSLSocket)))
+
+def _sendfile_chunk(throttle, allowance):
+    """The bytes of the next sendfile call: SENDFILE_CHUNK if the transfer
+    is not throttled, else what ``allowance`` says may be sent now, at least
+    BLOCK_SIZE. A throttle without an allowance gets BLOCK_SIZE calls, small
+    chunks keep the throttled transfer smooth."""
+    if not throttle:
+        return SENDFILE_CHUNK
+    if not allowance:
+        return BLOCK_SIZE
+    allowed = allowance()
+    if allowed is None:
+        return SENDFILE_CHUNK
+    return int(min(max(allowed, BLOCK_SIZE), SENDFILE_CHUNK))
+
+def _send_segment(sock, segment, throttle=None, allowance=None):
+    """Sends a FileSegment with sendfile. A socket with a timeout is
+    non-blocking underneath, so wait for it to be writable on EAGAIN.
+    ``throttle`` is called with the number of bytes after each send,
+    ``allowance`` sizes the sends, see _sendfile_chunk."""
+    infd = segment.fileobj.fileno()
+    outfd = sock.fileno()
+    offset = segment.offset
+    end = segment.offset + segment.size
+    timeout = sock.gettimeout()
+    while offset < end:
+        chunk = _sendfile_chunk(throttle, allowance)
+        try:
+            sent = _sendfile(outfd, infd, offset, min(end - offset, chunk))
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                writable = select.select([], [sock], [], timeout)[1]
+                if not writable:
+                    raise socket.timeout("timed out")
+                continue
+            if e.errno == errno.EINTR:
+                continue
+            raise socket.error(e.errno, e.strerror)
+        if sent == 0:
+            raise socket.error(errno.EIO, "File shorter than its size")
+        offset += sent
+        if throttle:
+            throttle(sent)
+    segment.fileobj.seek(end)
+
 class _StreamingHTTPMixin:
     """Mixin class for HTTP and HTTPS connections that implements a streaming
     send method."""
+
+    # If set, called with the size of each block before it is sent, e.g. to
+    # limit the upload bandwidth.
+    throttle = None
+    # If set, returns the bytes the throttle lets through now without
+    # waiting, None if it does not limit them. The sendfile calls are sized
+    # to it.
+    allowance = None
+
+    def _sendall(self, data):
+        if self.throttle:
+            self.throttle(len(data))
+        self.sock.sendall(data)
+
     def send(self, value):
         """Send ``value`` to the server.
 
         ``value`` can be a string object, a file-like object that supports
         a .read() method, or an iterable object that supports a .next()
         method.
+
+        If ``value`` has an .iter_segments() method (a multipart_yielder)
+        and sendfile is available, the file contents are sent with sendfile
+        instead of being read through Python.
         """
         # Based on python 2.6's httplib.HTTPConnection.send()
         if self.sock is None:
@@ -60,15 +145,26 @@ class _StreamingHTTPMixin:
         if self.debuglevel > 0:
             print "send:", repr(value)
         try:
-            blocksize = 8192
-            if hasattr(value, 'read') :
+            blocksize = BLOCK_SIZE
+            if hasattr(value, 'iter_segments') and _can_sendfile(self.sock):
+                if hasattr(value, 'reset'):
+                    value.reset()
+                if self.debuglevel > 0:
+                    print "sendIng segments with sendfile"
+                for segment in value.iter_segments():
+                    if isinstance(segment, FileSegment):
+                        _send_segment(self.sock, segment, self.throttle,
+                                      self.allowance)
+                    else:
+                        self._sendall(segment)
+            elif hasattr(value, 'read') :
                 if hasattr(value, 'seek'):
                     value.seek(0)
                 if self.debuglevel > 0:
                     print "sendIng a read()able"
                 data = value.read(blocksize)
                 while data:
-                    self.sock.sendall(data)
+                    self._sendall(data)
                     data = value.read(blocksize)
             elif hasattr(value, 'next'):
                 if hasattr(value, 'reset'):
@@ -76,9 +172,9 @@ class _StreamingHTTPMixin:
                 if self.debuglevel > 0:
                     print "sendIng an iterable"
                 for data in value:
-                    self.sock.sendall(data)
+                    self._sendall(data)
             else:
-                self.sock.sendall(value)
+                self._sendall(value)
         except socket.error, v:
             if v[0] == 32:      # Broken pipe
                 self.close()
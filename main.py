@@ -11,6 +11,7 @@ import logging.handlers
 from datetime import datetime
 import argparse
 import shutil
+import multiprocessing
 current_dir = os.path.abspath(os.getcwd())
 site.addsitedir(join(current_dir, "lib"))
 import appdirs
@@ -20,6 +21,7 @@ from cherrypy import engine
 from dataingestion.ui.ingestui import DataIngestionUI
 from dataingestion.services.service_rest import DataIngestionService
 import dataingestion.services.model
+import dataingestion.services.hasher
 from dataingestion.services import user_config
 
 APP_NAME = 'iDigBio Data Ingestion Tool'
@@ -38,11 +40,30 @@ def main(argv):
   config.read(idigbio_conf_path)
   api_endpoint = config.get('iDigBio', 'idigbio.api_endpoint')
   worker_thread_count = config.get('iDigBio', 'idigbio.worker_thread_count')
+  max_worker_thread_count = _get_optional(
+      config, 'idigbio.max_worker_thread_count')
+  hash_thread_count = _get_optional(config, 'idigbio.hash_thread_count')
+  stage_queue_size = _get_optional(config, 'idigbio.stage_queue_size')
+  commit_batch_size = _get_optional(config, 'idigbio.commit_batch_size')
+  commit_interval = _get_optional(config, 'idigbio.commit_interval')
+  hash_pool_size = _get_optional(config, 'idigbio.hash_pool_size')
+  hash_pool_type = _get_optional(config, 'idigbio.hash_pool_type')
+  upload_rate_schedule = _get_optional(config, 'idigbio.upload_rate_schedule')
+  exists_batch_size = _get_optional(config, 'idigbio.exists_batch_size')
+  hash_before_upload = _get_optional(config, 'idigbio.hash_before_upload')
+  stall_timeout = _get_optional(config, 'idigbio.stall_timeout')
   disable_startup_service_check = config.get(
     'iDigBio', 'devmode_disable_startup_service_check')
   
   dataingestion.services.api_client.init(api_endpoint)
-  dataingestion.services.ingestion_manager.init(worker_thread_count)
+  if stall_timeout:
+    dataingestion.services.api_client.set_stall_timeout(stall_timeout)
+  dataingestion.services.ingestion_manager.init(
+      worker_thread_count, hash_thread_count, stage_queue_size,
+      commit_batch_size, commit_interval, max_worker_thread_count,
+      exists_batch_size, hash_before_upload)
+  dataingestion.services.hasher.init(
+      hash_pool_size, hash_pool_type or dataingestion.services.hasher.POOL_THREAD)
   cherrypy.config.update(join(current_dir, 'etc', 'http.conf'))
   
   engine_conf_path = join(current_dir, 'etc', 'engine.conf')
@@ -117,6 +138,16 @@ def main(argv):
   user_config.setup(user_config_path)
   user_config.set_user_config(
       'devmode_disable_startup_service_check', disable_startup_service_check)
+  # A schedule set through /services/config overrides idigbio.conf.
+  try:
+    upload_rate_schedule = user_config.get_user_config(
+        user_config.UPLOAD_RATE_SCHEDULE)
+  except AttributeError:
+    pass
+  try:
+    dataingestion.services.api_client.set_rate_schedule(upload_rate_schedule)
+  except ValueError as e:
+    logger.error("Upload rate schedule ignored: {0}".format(e))
   
   # Set up/start server.
   if hasattr(engine, "signal_handler"):
@@ -146,6 +177,12 @@ def main(argv):
           "Ingestion Tool.")
   engine.block()
 
+def _get_optional(config, option):
+  """Returns the option in the iDigBio section, or None if it is not set."""
+  if config.has_option('iDigBio', option):
+    return config.get('iDigBio', option)
+  return None
+
 def _move_db(data_folder, db_file):
   if exists(db_file):
     dataingestion.services.model.close()  
@@ -166,4 +203,6 @@ def _logout_user_if_configured(user_config_path, data_folder, db_file):
     os.remove(user_config_path)
 
 if __name__ == '__main__':
+  # Needed by the process hashing pool in frozen executables.
+  multiprocessing.freeze_support()
   main(sys.argv)
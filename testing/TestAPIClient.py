@@ -8,6 +8,7 @@
 # This preprocess is to set up the paths to make sure the current module
 # referencing in the files to be tested.
 import sys, os, unittest, tempfile, datetime, urllib2, subprocess
+import hashlib, json
 from threading import Thread
 rootdir = os.path.dirname(os.getcwd())
 sys.path.append(rootdir)
@@ -140,9 +141,82 @@ class TestAPIClient(unittest.TestCase):
     api_client._post_csv(name)
     print "Post csv test done."
 
+  def _testPostImageChunked(self):
+    '''Test _post_image_chunked, and its resume after a failure.'''
+    class _Progress(object):
+      def __init__(self):
+        self.saved = {}
+      def get_chunk_progress(self, path, st):
+        return self.saved.get(path)
+      def save_chunk_progress(self, path, st, upload_id, offset):
+        self.saved[path] = (upload_id, offset)
+      def clear_chunk_progress(self, path):
+        self.saved.pop(path, None)
+
+    md5 = hashlib.md5(open(self._filepath1, "rb").read()).hexdigest()
+    chunk_size = api_client.CHUNK_SIZE
+    api_client.CHUNK_SIZE = 32 * 1024
+    send = api_client._send
+    try:
+      progress = _Progress()
+      resp = json.loads(api_client._post_image_chunked(
+          self._filepath1, "ABC5", progress))
+      self.assertEqual(resp["file_md5"], md5)
+      self.assertEqual(progress.saved, {})
+      print "Post image chunked test1 done."
+
+      # Fail after the second chunk, then resume.
+      sent = []
+      def _failing_send(method, url, *args):
+        if "chunks/chunk" in url:
+          sent.append(url)
+          if len(sent) == 3:
+            raise ClientException("Network down.")
+        return send(method, url, *args)
+      api_client._send = _failing_send
+      self.assertRaises(ClientException, api_client._post_image_chunked,
+                        self._filepath1, "ABC6", progress)
+      self.assertEqual(progress.saved[self._filepath1][1],
+                       2 * api_client.CHUNK_SIZE)
+      digests = []
+      resp = json.loads(api_client._post_image_chunked(
+          self._filepath1, "ABC6", progress, digests.append))
+      self.assertEqual(resp["file_md5"], md5)
+      # The two acknowledged chunks are not sent again, but they are hashed.
+      self.assertEqual(len(sent), 3 + 3)
+      self.assertEqual(digests, [md5])
+      print "Post image chunked test2 done."
+    finally:
+      api_client.CHUNK_SIZE = chunk_size
+      api_client._send = send
+
+  def _testPostImageStreamHash(self):
+    '''Test _post_image hashing the file while it is sent.'''
+    md5 = hashlib.md5(open(self._filepath1, "rb").read()).hexdigest()
+    digests = []
+    resp = json.loads(api_client._post_image(
+        self._filepath1, "ABC8", digests.append))
+    self.assertEqual(digests, [md5])
+    self.assertEqual(resp["file_md5"], md5)
+    print "Post image stream hash test done."
+
+  def _testCheckExisting(self):
+    '''Test _check_existing against the stub server's store.'''
+    md5 = hashlib.md5(open(self._filepath1, "rb").read()).hexdigest()
+    api_client._post_image(self._filepath1, "ABC7")
+    missing = "0" * 32
+    existing = api_client._check_existing([md5, missing])
+    self.assertEqual(existing.keys(), [md5])
+    self.assertEqual(existing[md5]["file_md5"], md5)
+    self.assertEqual(api_client._check_existing([]), {})
+    print "Check existing test done."
+
   def runTest(self):
     self._testAuthenticate()
     self._testPostImage()
+    self._testPostImageChunked()
+    self._testPostImageStreamHash()
+    self._testCheckExisting()
     self._testPostCsv()
 
 if __name__ == '__main__':
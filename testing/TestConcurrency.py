@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# Test functions in concurrency.
+
+import sys, os, unittest, threading
+
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services.concurrency import AIMDController
+
+class TestConcurrency(unittest.TestCase):
+
+#----------------------------------------------------
+# Tests.
+
+  def _testAdditiveIncrease(self):
+    '''The limit grows by one per window of successful requests.'''
+    controller = AIMDController(2, 1, 4)
+    for _junk in xrange(2):
+      controller.record(0.1, 1000)
+    self.assertEqual(controller.get_limit(), 3)
+    for _junk in xrange(3):
+      controller.record(0.1, 1000)
+    self.assertEqual(controller.get_limit(), 4)
+    for _junk in xrange(20):
+      controller.record(0.1, 1000)
+    self.assertEqual(controller.get_limit(), 4)
+
+  def _testMultiplicativeDecrease(self):
+    '''Errors, timeouts and a latency rise halve the limit once per window.'''
+    controller = AIMDController(8, 1, 16)
+    controller.record(1, 0, False, True)
+    controller.record(1, 0, False, True)
+    self.assertEqual(controller.get_limit(), 4)
+    stats = controller.stats()
+    self.assertEqual(stats["timeouts"], 2)
+    self.assertEqual(stats["decreases"], 1)
+
+    controller = AIMDController(2, 1, 16)
+    controller.record(0.1)
+    controller.record(0.1)
+    self.assertEqual(controller.get_limit(), 3)
+    for _junk in xrange(3):
+      controller.record(1.0)
+    self.assertEqual(controller.get_limit(), 1)
+
+  def _testOverride(self):
+    '''A limit set by hand is bounded and kept fixed.'''
+    controller = AIMDController(2, 1, 8)
+    controller.set_limit(100)
+    self.assertEqual(controller.get_limit(), 8)
+    controller.record(1, 0, False)
+    self.assertEqual(controller.get_limit(), 8)
+    controller.set_limit(3, True)
+    controller.record(1, 0, False)
+    self.assertEqual(controller.get_limit(), 1)
+
+  def _testPermits(self):
+    '''No more than limit holders at a time.'''
+    controller = AIMDController(2, 1, 8)
+    controller.set_limit(2)
+    active = []
+    peak = []
+    lock = threading.Lock()
+    def work():
+      controller.acquire()
+      with lock:
+        active.append(1)
+        peak.append(len(active))
+      threading.Event().wait(0.01)
+      with lock:
+        active.pop()
+      controller.release()
+    threads = [threading.Thread(target=work) for _junk in xrange(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(max(peak), 2)
+    self.assertEqual(controller.stats()["active"], 0)
+
+  def runTest(self):
+    self._testAdditiveIncrease()
+    self._testMultiplicativeDecrease()
+    self._testOverride()
+    self._testPermits()
+
+
+if __name__ == '__main__':
+      unittest.main()
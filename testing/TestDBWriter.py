@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# Test functions in db_writer.
+
+import sys, os, unittest, threading
+
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services.db_writer import GroupCommitWriter
+
+class TestDBWriter(unittest.TestCase):
+  def setUp(self):
+    self._applied = []
+    self._committed = []
+    self._batches = []
+
+  def _apply(self, batch):
+    self._batches.append(len(batch))
+    self._applied.extend(batch)
+
+  def _commit(self):
+    self._committed = list(self._applied)
+
+#----------------------------------------------------
+# Tests.
+
+  def _testBatchesByCount(self):
+    '''Intents are committed in batches of at most max_batch.'''
+    writer = GroupCommitWriter(self._apply, self._commit, threading.Lock(),
+                               max_batch=10, max_delay=5)
+    for i in xrange(35):
+      writer.submit(i)
+    writer.start()
+    writer.stop()
+    self.assertEqual(self._committed, range(35))
+    self.assertTrue(max(self._batches) <= 10)
+    stats = writer.stats()
+    self.assertEqual(stats["updates"], 35)
+    self.assertEqual(stats["commits"], len(self._batches))
+    self.assertEqual(stats["max_batch_size"], 10)
+
+  def _testFlushByTime(self):
+    '''A partial batch is committed once max_delay passed.'''
+    writer = GroupCommitWriter(self._apply, self._commit, threading.Lock(),
+                               max_batch=100, max_delay=0.05)
+    writer.start()
+    writer.submit("a")
+    done = threading.Event()
+    for _junk in xrange(100):
+      if self._committed:
+        break
+      done.wait(0.01)
+    self.assertEqual(self._committed, ["a"])
+    writer.stop()
+
+  def _testStopFlushes(self):
+    '''Nothing submitted before stop() is lost.'''
+    writer = GroupCommitWriter(self._apply, self._commit, threading.Lock(),
+                               max_batch=1000, max_delay=60)
+    writer.start()
+    for i in xrange(50):
+      writer.submit(i)
+    writer.stop()
+    self.assertEqual(self._committed, range(50))
+
+  def _testFailedBatch(self):
+    '''A failed batch is rolled back, only its bad intent is dropped.'''
+    rollbacks = []
+    def _apply(batch):
+      self._apply(batch)
+      if "bad" in batch:
+        raise ValueError("bad intent")
+    def _rollback():
+      rollbacks.append(len(self._applied) - len(self._committed))
+      self._applied = list(self._committed)
+    writer = GroupCommitWriter(_apply, self._commit, threading.Lock(),
+                               max_batch=10, max_delay=60,
+                               rollback_func=_rollback)
+    for intent in [0, 1, "bad", 3]:
+      writer.submit(intent)
+    writer.start()
+    writer.stop()
+    self.assertEqual(self._committed, [0, 1, 3])
+    # The batch, then the bad intent on its own.
+    self.assertEqual(rollbacks, [4, 1])
+    self.assertEqual(len(writer.exc_infos), 2)
+    stats = writer.stats()
+    self.assertEqual(stats["failed"], 1)
+    self.assertEqual(stats["updates"], 3)
+
+  def runTest(self):
+    for test in (self._testBatchesByCount, self._testFlushByTime,
+                 self._testStopFlushes, self._testFailedBatch):
+      self.setUp()
+      test()
+
+
+if __name__ == '__main__':
+      unittest.main()
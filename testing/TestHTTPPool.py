@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# Test functions in http_pool.
+
+import sys, os, unittest, threading, time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services.http_pool import (HTTPConnectionPool,
+                                              RequestTimeout, StallTimeout)
+from poster.encode import multipart_encode, BLOCK_SIZE
+from poster import streaminghttp
+
+class _Handler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers["Content-Length"]))
+    if self.path.endswith("slow"):
+      time.sleep(0.5)
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+class _Server(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+class TestHTTPPool(unittest.TestCase):
+  def setUp(self):
+    self._server = _Server(("127.0.0.1", 0), _Handler)
+    self._url = "http://127.0.0.1:%d/upload" % self._server.server_port
+    thread = threading.Thread(target=self._server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def tearDown(self):
+    self._server.shutdown()
+    self._server.server_close()
+
+#----------------------------------------------------
+# Tests.
+
+  def _testReuse(self):
+    '''Sequential requests share one connection.'''
+    pool = HTTPConnectionPool(2)
+    for i in xrange(5):
+      status, _junk, body = pool.request("POST", self._url, "data%d" % i,
+                                         {"Content-Length": "5"}, 3)
+      self.assertEqual(status, 200)
+      self.assertEqual(body, "data%d" % i)
+    stats = pool.stats()
+    self.assertEqual(stats["connects"], 1)
+    self.assertEqual(stats["reuses"], 4)
+    self.assertEqual(stats["dns_misses"], 1)
+    pool.clear()
+
+  def _testDeadConnection(self):
+    '''A connection closed by the server is replaced.'''
+    pool = HTTPConnectionPool(2)
+    pool.request("POST", self._url, "a", {"Content-Length": "1"}, 3)
+    for conns in pool._idle.itervalues():
+      for conn in conns:
+        conn.sock.close()
+        conn.sock = None
+    status, _junk, body = pool.request("POST", self._url, "b",
+                                       {"Content-Length": "1"}, 3)
+    self.assertEqual((status, body), (200, "b"))
+    self.assertEqual(pool.stats()["connects"], 2)
+    pool.clear()
+
+  def _testMultipartBody(self):
+    '''A file body is sent intact, with or without sendfile.'''
+    path = os.path.join(os.getcwd(), "image1.jpg")
+    with open(path, "rb") as f:
+      datagen, headers = multipart_encode({"file": f, "filereference": "A"},
+                                          "testboundary")
+      expected = "".join(datagen)
+      self.assertEqual(len(expected), int(headers["Content-Length"]))
+      pool = HTTPConnectionPool(2)
+      for _junk in xrange(2):
+        status, _junk, body = pool.request("POST", self._url, datagen,
+                                           headers, 3)
+        self.assertEqual((status, body), (200, expected))
+      pool.clear()
+
+  def _testSendfileChunks(self):
+    '''The sendfile calls are as large as the throttle allows.'''
+    if streaminghttp._sendfile is None:
+      return
+    path = os.path.join(os.getcwd(), "sendfile.tmp")
+    with open(path, "wb") as f:
+      f.write("x" * (4 * BLOCK_SIZE))
+    counts = []
+    sendfile = streaminghttp._sendfile
+    def _sendfile(outfd, infd, offset, count):
+      counts.append(count)
+      return sendfile(outfd, infd, offset, count)
+    streaminghttp._sendfile = _sendfile
+    try:
+      for allowance, expected in ((None, 4 * BLOCK_SIZE),
+                                  (lambda: None, 4 * BLOCK_SIZE),
+                                  (lambda: 2.5 * BLOCK_SIZE, 2.5 * BLOCK_SIZE),
+                                  (lambda: 0, BLOCK_SIZE)):
+        pool = HTTPConnectionPool(2, lambda nbytes: None, allowance)
+        if allowance is None: # A throttle without an allowance.
+          expected = BLOCK_SIZE
+        del counts[:]
+        with open(path, "rb") as f:
+          datagen, headers = multipart_encode({"file": f}, "testboundary")
+          status, _junk, _junk = pool.request("POST", self._url, datagen,
+                                              headers, 3)
+        self.assertEqual(status, 200)
+        self.assertEqual(counts[0], expected)
+        pool.clear()
+      # Unthrottled.
+      self.assertEqual(streaminghttp._sendfile_chunk(None, None),
+                       streaminghttp.SENDFILE_CHUNK)
+    finally:
+      streaminghttp._sendfile = sendfile
+      os.remove(path)
+
+  def _testTimeouts(self):
+    '''A slow response is waited for within the total timeout only.'''
+    pool = HTTPConnectionPool(2)
+    url = self._url + "/slow"
+    self.assertRaises(StallTimeout, pool.request, "POST", url, "a",
+                      {"Content-Length": "1"}, 0.2)
+    self.assertRaises(RequestTimeout, pool.request, "POST", url, "a",
+                      {"Content-Length": "1"}, 0.1, 0.3)
+    # The response wait gets what is left of the total timeout.
+    status, _junk, body = pool.request("POST", url, "a",
+                                       {"Content-Length": "1"}, 0.2, 5)
+    self.assertEqual((status, body), (200, "a"))
+    stats = pool.stats()
+    self.assertEqual(stats["stalls"], 1)
+    self.assertEqual(stats["timeouts"], 1)
+    pool.clear()
+
+  def runTest(self):
+    self._testReuse()
+    self._testDeadConnection()
+    self._testMultipartBody()
+    self._testSendfileChunks()
+    self._testTimeouts()
+
+
+if __name__ == '__main__':
+      unittest.main()
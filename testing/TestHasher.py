@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# Test functions in hasher.
+
+import sys, os, unittest, hashlib, threading
+
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services import hasher
+
+class TestHasher(unittest.TestCase):
+  def setUp(self):
+    self._paths = [os.path.join(os.getcwd(), name) for name in
+                   ("image1.jpg", "image2.jpg", "image3.jpg")]
+    self._md5s = []
+    for path in self._paths:
+      with open(path, 'rb') as f:
+        self._md5s.append(hashlib.md5(f.read()).hexdigest())
+
+  def tearDown(self):
+    hasher.close()
+
+#----------------------------------------------------
+# Tests.
+
+  def _testMd5Path(self):
+    '''md5_path gives the same digest with and without memory mapping.'''
+    for path, md5 in zip(self._paths, self._md5s):
+      self.assertEqual(hasher.md5_path(path), md5)
+    threshold = hasher.MMAP_THRESHOLD
+    hasher.MMAP_THRESHOLD = 1
+    try:
+      for path, md5 in zip(self._paths, self._md5s):
+        self.assertEqual(hasher.md5_path(path), md5)
+    finally:
+      hasher.MMAP_THRESHOLD = threshold
+    self.assertRaises(IOError, hasher.md5_path, "Invalid/path/file.jpg")
+
+  def _testMd5Paths(self, pool_type):
+    '''md5_paths returns the digests in order, None for missing files.'''
+    hasher.init(2, pool_type)
+    paths = self._paths * 5 + ["Invalid/path/file.jpg"]
+    md5s = list(hasher.md5_paths(paths))
+    self.assertEqual(md5s, self._md5s * 5 + [None])
+    for path, md5 in zip(self._paths, self._md5s):
+      self.assertEqual(hasher.md5_path(path), md5)
+    hasher.close()
+
+  def _testThreadPoolSize(self):
+    '''With a thread pool, md5_path hashes in the pool workers.'''
+    threads = set()
+    md5_path = hasher._md5_path
+    def _record(path):
+      threads.add(threading.current_thread().name)
+      return md5_path(path)
+    hasher._md5_path = _record
+    hasher.init(1, hasher.POOL_THREAD)
+    try:
+      for path, md5 in zip(self._paths, self._md5s) * 3:
+        self.assertEqual(hasher.md5_path(path), md5)
+    finally:
+      hasher._md5_path = md5_path
+      hasher.close()
+    self.assertEqual(len(threads), 1)
+    self.assertFalse(threading.current_thread().name in threads)
+
+  def runTest(self):
+    self._testMd5Path()
+    self._testMd5Paths(hasher.POOL_THREAD)
+    self._testMd5Paths(hasher.POOL_PROCESS)
+    self._testThreadPoolSize()
+
+
+if __name__ == '__main__':
+      unittest.main()
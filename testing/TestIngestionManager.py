@@ -111,9 +111,161 @@ class TestIngestionManager(unittest.TestCase):
     result = ingestion_manager.get_result()
     self.assertIsNotNone(result)
 
+  def _testProgressCounters(self):
+    '''The counters are updated from several threads and read at once.'''
+    counters = ingestion_manager.ProgressCounters()
+    def _count():
+      for _junk in xrange(1000):
+        counters.add(counters.TOTAL)
+        counters.add(counters.SUCCESSES)
+        counters.add_upload(10, 0.5)
+    threads = [Thread(target=_count) for _junk in xrange(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(counters.snapshot(), [4000, 0, 4000, 0, 40000, 2000.0])
+    self.assertEqual(counters.get(counters.FAILS), 0)
+
   def runTest(self):
+    self._testProgressCounters()
     self._testUploadTask()
 
 
+class _FeedPipeline(object):
+  """
+  Runs the hash and dedupe stages of each row fed, committing as the DB
+  writer would, and crashes once crash_after rows are fed.
+  """
+  def __init__(self, task, batch, crash_after=None):
+    self.task = task
+    self.batch = batch
+    self.crash_after = crash_after
+    self.work_items = []
+    self.fed = 0
+
+  def put(self, item):
+    if self.fed == self.crash_after:
+      raise SystemExit("Crashed while the CSV was fed.")
+    self.fed += 1
+    record = ingestion_manager._hash_single_row(item)
+    items = ingestion_manager._dedupe_records([record], self.task, self.batch)
+    self.work_items.extend(item for item in items if item is not None)
+    model.commit()
+
+class TestResume(unittest.TestCase):
+  """The resume of a batch, without a server."""
+  def setUp(self):
+    self._testDB = os.path.join(os.getcwd(), "idigbio.resume.db")
+    if os.path.exists(self._testDB):
+      os.remove(self._testDB)
+    model.setup(self._testDB)
+    self._csvfile = os.path.join(os.getcwd(), "resume.csv")
+    with open(self._csvfile, "wb") as f:
+      f.write("\"idigbio:OriginalFileName\", \"idigbio:MediaGUID\"\n")
+      for i in (1, 2, 3):
+        f.write("\"{0}\", \"resume{1}\"\n".format(
+            os.path.join(os.getcwd(), "image%d.jpg" % i), i))
+
+  def tearDown(self):
+    model.close()
+    os.remove(self._testDB)
+    os.remove(self._csvfile)
+
+  def _testResumeAfterFeedCrash(self):
+    '''A batch whose CSV feed crashed is fed again, not resumed from jobs.'''
+    batch = model.add_batch(self._csvfile, "accountID", "CC0", "url", "logo")
+    model.commit()
+    pipeline = _FeedPipeline(ingestion_manager.BatchUploadTask(), batch, 2)
+    self.assertRaises(SystemExit, ingestion_manager._feed_csv, pipeline,
+                      pipeline.task, batch, self._csvfile)
+    # The first image was uploaded before the crash.
+    uploaded = pipeline.work_items[0]
+    model.apply_image_updates([(uploaded.id, {"UploadTime": "2031-01-01"})])
+    model.commit()
+
+    oldbatch = model.load_last_batch()
+    self.assertTrue(model.has_jobs(oldbatch.id))
+    batch, get_page = ingestion_manager._resume_batch(oldbatch)
+    self.assertEqual(batch.id, oldbatch.id)
+    self.assertIsNone(get_page)
+
+    task = ingestion_manager.BatchUploadTask()
+    pipeline = _FeedPipeline(task, batch)
+    ingestion_manager._feed_csv(pipeline, task, batch, self._csvfile)
+    # The uploaded image is skipped, the others are uploaded.
+    self.assertEqual([item.path for item in pipeline.work_items],
+                     [os.path.join(os.getcwd(), "image%d.jpg" % i)
+                      for i in (2, 3)])
+    self.assertEqual(task.counters.get(task.counters.SKIPS), 1)
+    self.assertEqual(model.load_last_batch().RecordCount, 3)
+
+    '''Once the CSV was fed completely, the jobs are resumed.'''
+    batch, get_page = ingestion_manager._resume_batch(model.load_last_batch())
+    self.assertEqual(batch.id, oldbatch.id)
+    unfinished = [item.id for item in get_page(0)]
+    for item in pipeline.work_items:
+      self.assertTrue(item.id in unfinished)
+
+  def _testRetryOfCrashedBatch(self):
+    '''A retry does not finish a batch whose CSV was not fed completely.'''
+    batch = model.add_batch(self._csvfile, "accountID", "CC0", "url", "logo")
+    model.commit()
+    pipeline = _FeedPipeline(ingestion_manager.BatchUploadTask(), batch, 1)
+    self.assertRaises(SystemExit, ingestion_manager._feed_csv, pipeline,
+                      pipeline.task, batch, self._csvfile)
+    uploaded = pipeline.work_items[0]
+    model.apply_image_updates([(uploaded.id, {"UploadTime": "2031-01-01"})])
+    model.commit()
+
+    task = ingestion_manager.BatchUploadTask(batch)
+    self.assertEqual(model.count_failed_images(batch.id), 0)
+    self.assertFalse(ingestion_manager._batch_done(task, True))
+    '''Once fed, the batch is done when none of its images failed.'''
+    batch.RecordCount = 3
+    model.commit()
+    self.assertTrue(ingestion_manager._batch_done(task, True))
+
+  def runTest(self):
+    self._testResumeAfterFeedCrash()
+    # A clean database, the images are uploaded in the one of the last test.
+    self.tearDown()
+    self.setUp()
+    self._testRetryOfCrashedBatch()
+
+
+class TestProgress(unittest.TestCase):
+  """The progress readers, without a server."""
+  def setUp(self):
+    self._task = ingestion_manager.ongoing_upload_task
+    self._timeout = ingestion_manager.TASK_START_TIMEOUT
+    ingestion_manager.TASK_START_TIMEOUT = 0.1
+
+  def tearDown(self):
+    ingestion_manager.ongoing_upload_task = self._task
+    ingestion_manager.TASK_START_TIMEOUT = self._timeout
+
+  def _testIdleProgress(self):
+    '''A task that does not start is reported idle, not waited for.'''
+    task = ingestion_manager.BatchUploadTask()
+    ingestion_manager.ongoing_upload_task = task
+    progress, counters = ingestion_manager.get_progress_counters()
+    self.assertEqual(progress[2:], (0, 0, 0, 0, False, False))
+    self.assertEqual(counters["bytes"], 0)
+
+    '''The progress and the counters are from the same snapshot.'''
+    task.increment(ingestion_manager.ProgressCounters.TOTAL)
+    task.count_upload(10, 0.5)
+    task.increment(ingestion_manager.ProgressCounters.SUCCESSES)
+    task.set_status(task.STATUS_FINISHED)
+    progress, counters = ingestion_manager.get_progress_counters()
+    self.assertEqual(progress[2:], (1, 0, 1, 0, False, True))
+    self.assertEqual(counters["total"], 1)
+    self.assertEqual(counters["bytes"], 10)
+
+  def runTest(self):
+    self._testIdleProgress()
+
+
 if __name__ == '__main__':
       unittest.main()
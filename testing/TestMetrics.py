@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# Test functions in metrics.
+
+import sys, os, unittest
+
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services.metrics import Meter, Registry
+
+class TestMetrics(unittest.TestCase):
+
+#----------------------------------------------------
+# Tests.
+
+  def _testCounter(self):
+    '''A counter adds up per label values, the labels are checked.'''
+    registry = Registry()
+    images = registry.counter("images_total", "Images.", ("outcome",))
+    images.inc(outcome="uploaded")
+    images.inc(2, outcome="uploaded")
+    images.inc(outcome="failed")
+    self.assertEqual(images.get(outcome="uploaded"), 3)
+    self.assertRaises(ValueError, images.inc)
+    self.assertRaises(ValueError, images.inc, stage="hash")
+    self.assertRaises(ValueError, registry.counter, "images_total", "Again.")
+    values = registry.to_dict()["images_total"]["values"]
+    self.assertEqual(values, [
+        dict(labels=dict(outcome="failed"), value=1),
+        dict(labels=dict(outcome="uploaded"), value=3)])
+
+  def _testHistogram(self):
+    '''A histogram counts per bucket and estimates the quantiles.'''
+    registry = Registry()
+    latency = registry.histogram("latency_seconds", "Latency.", ("stage",),
+                                 (1.0, 2.0, 4.0))
+    for value in (0.5, 1.0, 1.5, 1.5, 3.0, 10.0):
+      latency.observe(value, stage="upload")
+    value = registry.to_dict()["latency_seconds"]["values"][0]["value"]
+    self.assertEqual(value["count"], 6)
+    self.assertEqual(value["sum"], 17.5)
+    self.assertEqual(value["buckets"],
+                     [(1.0, 2), (2.0, 4), (4.0, 5), ("+Inf", 6)])
+    # The 3rd of 6 values is halfway in the (1, 2] bucket.
+    self.assertEqual(value["p50"], 1.5)
+    self.assertEqual(value["p99"], 4.0)
+
+  def _testGauge(self):
+    '''A gauge reads its values when the metrics are collected.'''
+    registry = Registry()
+    depths = {"hash": 3, "upload": 0}
+    registry.gauge("queue_depth", "Depth.", lambda: depths, ("stage",))
+    registry.gauge("unknown", "None is omitted.", lambda: None)
+    depths["upload"] = 7
+    result = registry.to_dict()
+    self.assertEqual(result["queue_depth"]["values"][1],
+                     dict(labels=dict(stage="upload"), value=7))
+    self.assertEqual(result["unknown"]["values"], [])
+
+  def _testPrometheus(self):
+    '''The text format has the HELP/TYPE lines and the histogram series.'''
+    registry = Registry()
+    registry.counter("bytes_total", "Bytes.").inc(10)
+    registry.counter("retries_total", "Zero until counted.")
+    latency = registry.histogram("db_seconds", "DB\nlatency.", (), (0.5,))
+    latency.observe(0.25)
+    latency.observe(1)
+    registry.gauge("workers", "Workers.", lambda: {'a"b': 2}, ("stage",))
+    self.assertEqual(registry.to_prometheus().splitlines(), [
+        "# HELP bytes_total Bytes.",
+        "# TYPE bytes_total counter",
+        "bytes_total 10",
+        "# HELP retries_total Zero until counted.",
+        "# TYPE retries_total counter",
+        "retries_total 0",
+        "# HELP db_seconds DB\\nlatency.",
+        "# TYPE db_seconds histogram",
+        'db_seconds_bucket{le="0.5"} 1',
+        'db_seconds_bucket{le="+Inf"} 2',
+        "db_seconds_sum 1.25",
+        "db_seconds_count 2",
+        "# HELP workers Workers.",
+        "# TYPE workers gauge",
+        'workers{stage="a\\"b"} 2'])
+
+  def _testMeter(self):
+    '''A meter gives the rate of the events marked.'''
+    meter = Meter(60)
+    meter._starttime -= 10
+    meter.mark(50)
+    rate = meter.rate()
+    self.assertTrue(4 < rate <= 5, rate)
+
+  def runTest(self):
+    self._testCounter()
+    self._testHistogram()
+    self._testGauge()
+    self._testPrometheus()
+    self._testMeter()
+
+
+if __name__ == '__main__':
+      unittest.main()
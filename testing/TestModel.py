@@ -162,6 +162,300 @@ class TestModel(unittest.TestCase):
         record, invalid_filepath, mediaguid, "", "File not found.", "",
         "image/jpeg", "", "{}", self._batch1.id)
 
+  def _testAddRecords(self):
+    '''Test add_records, the bulk version of add_image.'''
+    self.assertIsNotNone(self._batch1)
+    headerline = ["idigbio:OriginalFileName", "idigbio:MediaGUID"]
+    csvrows = [[os.path.join(os.getcwd(), "image2.jpg"), "bulk1"],
+               [os.path.join(os.getcwd(), "image3.jpg"), "bulk2"],
+               ["Invalid/path/file.jpg", "bulk3"]]
+    records = [model.generate_record(row, headerline) for row in csvrows]
+
+    '''New records are inserted and returned in order.'''
+    items = model.add_records(self._batch1, records + [records[0]])
+    self.assertEqual(len(items), 4)
+    self.assertEqual([item.path for item in items[:3]],
+                     [row[0] for row in csvrows])
+    self.assertEqual(items[1].mediaguid, "bulk2")
+    self.assertEqual(items[2].error, "File not found.")
+    self.assertFalse(items[0].error)
+    self.assertEqual(items[0].mmd5, records[0][11])
+    '''A duplicate in the same call is skipped.'''
+    self.assertIsNone(items[3])
+    model.commit()
+
+    '''Uploaded records are skipped, the others are returned again.'''
+    model.apply_image_updates(
+        [(items[0].id, {"UploadTime": str(datetime.datetime.utcnow())})])
+    model.commit()
+    retry = model.add_records(self._batch1, records)
+    self.assertIsNone(retry[0])
+    self.assertEqual([item.id for item in retry[1:]],
+                     [item.id for item in items[1:3]])
+    model.commit()
+
+  def _testStatOnlyRecord(self):
+    '''
+    Test generate_record without hashing the file, and the AllMD5 recorded
+    after the upload.
+    '''
+    self.assertIsNotNone(self._batch1)
+    headerline = ["idigbio:OriginalFileName", "idigbio:MediaGUID"]
+    f = tempfile.NamedTemporaryFile(suffix=".jpg")
+    f.write(open(os.path.join(os.getcwd(), "image1.jpg"), "rb").read())
+    f.flush()
+    record = model.generate_record([f.name, "stat1"], headerline, False)
+    '''The file is not hashed, the AllMD5 is provisional.'''
+    self.assertEqual(record[11], "")
+    md5 = model.hasher.md5_path(f.name)
+    amd5 = model.record_md5("stat1", "", md5)
+    self.assertNotEqual(record[12], amd5)
+
+    item, = model.add_records(self._batch1, [record])
+    self.assertEqual(item.mmd5, "")
+    model.apply_image_updates([(item.id, {"MediaMD5": md5, "AllMD5": amd5})])
+    model.commit()
+    '''The hashed record now matches the uploaded one.'''
+    hashed = model.generate_record([f.name, "stat1"], headerline)
+    self.assertEqual(hashed[12], amd5)
+    self.assertEqual(model.add_records(self._batch1, [hashed])[0].id, item.id)
+    model.commit()
+
+    '''An AllMD5 taken by another record is not applied.'''
+    other, = model.add_records(self._batch1, [
+        model.generate_record([f.name, "stat2"], headerline, False)])
+    model.apply_image_updates([(other.id, {"MediaMD5": md5, "AllMD5": amd5})])
+    model.commit()
+    self.assertEqual(model.add_records(self._batch1, [hashed])[0].id, item.id)
+    model.commit()
+    f.close()
+
+  def _testUploadJobs(self):
+    '''Test the upload jobs recorded for the work items of a batch.'''
+    self.assertIsNotNone(self._batch2)
+    headerline = ["idigbio:OriginalFileName", "idigbio:MediaGUID"]
+    csvrows = [[os.path.join(os.getcwd(), "image1.jpg"), "job1"],
+               [os.path.join(os.getcwd(), "image2.jpg"), "job2"],
+               ["Invalid/path/file.jpg", "job3"]]
+    items = model.add_records(
+        self._batch2, [model.generate_record(row, headerline)
+                       for row in csvrows])
+    self.assertFalse(model.has_jobs(self._batch2.id))
+    model.add_jobs(self._batch2.id, items)
+    model.commit()
+    self.assertTrue(model.has_jobs(self._batch2.id))
+    self.assertEqual(model.get_job_counts(self._batch2.id),
+                     {"pending": 2, "failed": 1})
+
+    '''The intents of a job are applied in order.'''
+    model.apply_updates([
+        model.JobUpdate(items[0].id, {"state": "inflight"}),
+        model.JobUpdate(items[1].id, {"state": "inflight"}),
+        model.JobUpdate(items[0].id, {"state": "done", "attempts": 2}),
+        (items[0].id, {"UploadTime": str(datetime.datetime.utcnow())})])
+    model.commit()
+    self.assertEqual(model.get_job_counts(self._batch2.id),
+                     {"done": 1, "inflight": 1, "failed": 1})
+
+    '''The jobs not done are resumed, in pages.'''
+    unfinished = model.get_unfinished_jobs(self._batch2.id, 0, 1)
+    self.assertEqual([item.id for item in unfinished], [items[1].id])
+    self.assertEqual(unfinished[0], items[1])
+    unfinished = model.get_unfinished_jobs(self._batch2.id, items[1].id)
+    self.assertEqual([item.error for item in unfinished], ["File not found."])
+
+  def _testGetFailedImages(self):
+    '''Test get_failed_images, the images to retry.'''
+    batch = model.add_batch(os.path.join(os.getcwd(), "image1.jpg"),
+                            "accountID", "license", "licenseurl",
+                            "licenselogourl")
+    model.commit()
+    headerline = ["idigbio:OriginalFileName", "idigbio:MediaGUID"]
+    csvrows = [[os.path.join(os.getcwd(), "image1.jpg"), "fail1"],
+               [os.path.join(os.getcwd(), "image2.jpg"), "fail2"],
+               ["Invalid/path/file.jpg", "fail3"]]
+    items = model.add_records(
+        batch, [model.generate_record(row, headerline) for row in csvrows])
+    model.apply_image_updates(
+        [(items[0].id, {"UploadTime": str(datetime.datetime.utcnow())})])
+    model.commit()
+
+    '''Only the images not uploaded are returned, in pages.'''
+    '''The missing file is checked again, its error is not returned.'''
+    self.assertEqual(items[2].error, model.FILE_NOT_FOUND)
+    missing = items[2]._replace(error="")
+    failed = model.get_failed_images(batch.id)
+    self.assertEqual(failed, [items[1], missing])
+    failed = model.get_failed_images(batch.id, items[1].id, 10)
+    self.assertEqual(failed, [missing])
+    '''Or those of all the batches.'''
+    ids = [item.id for item in model.get_failed_images(None, 0, 100000)]
+    self.assertEqual(ids, sorted(ids))
+    self.assertTrue(items[1].id in ids and items[2].id in ids)
+    self.assertFalse(items[0].id in ids)
+    '''The batches to retry, and their fails.'''
+    self.assertTrue(batch.id in model.get_failed_batch_ids())
+    self.assertEqual(model.count_failed_images(batch.id), 2)
+
+    '''The query uses the index.'''
+    plan = model.session.execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM %s WHERE BatchID = %d AND "
+        "UploadTime IS NULL" % (model.__images_tablename__, batch.id)
+        ).fetchall()
+    self.assertTrue("_batch_upload" in str(plan))
+
+  def _testHistoryPages(self):
+    '''Test get_images_page and get_batches_page, the paged history.'''
+    batch = model.add_batch(os.path.join(os.getcwd(), "image1.jpg"),
+                            "accountID", "license", "licenseurl",
+                            "licenselogourl")
+    model.commit()
+    headerline = ["idigbio:OriginalFileName", "idigbio:MediaGUID"]
+    csvrows = [[os.path.join(os.getcwd(), "image2.jpg"), "page1"],
+               [os.path.join(os.getcwd(), "image1.jpg"), "page2"],
+               ["Invalid/path/100%_file.jpg", "page3"]]
+    items = model.add_records(
+        batch, [model.generate_record(row, headerline) for row in csvrows])
+    model.apply_image_updates([(items[1].id, {
+        "UploadTime": str(datetime.datetime.utcnow()), "MediaURL": "url"})])
+    model.commit()
+
+    '''The pages are in the CSV order by default.'''
+    total, matching, rows = model.get_images_page(batch.id, 0, 2)
+    self.assertEqual((total, matching), (3, 3))
+    self.assertEqual([row[0] for row in rows],
+                     [csvrows[0][0], csvrows[1][0]])
+    total, matching, rows = model.get_images_page(batch.id, 2, 2)
+    self.assertEqual([row[0] for row in rows], [csvrows[2][0]])
+    self.assertEqual(rows[0][1], items[2].error)
+
+    '''Sorted by file name, filtered by status and by search.'''
+    rows = model.get_images_page(batch.id, 0, 10, 0, True)[2]
+    self.assertEqual([row[0] for row in rows],
+                     sorted([row[0] for row in csvrows], reverse=True))
+    total, matching, rows = model.get_images_page(
+        batch.id, 0, 10, None, False, "", model.IMAGE_UPLOADED)
+    self.assertEqual((total, matching), (3, 1))
+    self.assertEqual(rows, [(csvrows[1][0], "", "url")])
+    self.assertEqual(model.get_images_page(
+        batch.id, 0, 10, None, False, "", model.IMAGE_NOT_UPLOADED)[1], 2)
+    self.assertEqual(model.get_images_page(
+        batch.id, 0, 10, None, False, "0%_")[1], 1)
+    self.assertEqual(model.get_images_page(
+        batch.id, 0, 10, None, False, "image_")[1], 0)
+    self.assertRaises(model.ModelException, model.get_images_page,
+                      batch.id, 0, 10, 1)
+    self.assertRaises(model.ModelException, model.get_images_page,
+                      batch.id, 0, 10, None, False, "", "unknown")
+
+    '''The page size is bounded.'''
+    self.assertEqual(model._page_bounds(-5, -1), (0, model.MAX_PAGE_SIZE))
+
+    '''The batches are paged too.'''
+    total, matching, rows = model.get_batches_page(0, 10, 0, True)
+    self.assertEqual(rows[0][0], str(batch.id))
+    self.assertEqual(len(rows), total)
+    self.assertEqual(model.get_batches_page(0, 10, None, False, "nomatch")[1],
+                     0)
+
+    '''The query by file name uses the index.'''
+    plan = model.session.execute(
+        "EXPLAIN QUERY PLAN SELECT OriginalFileName FROM %s WHERE "
+        "BatchID = %d ORDER BY OriginalFileName" % (
+            model.__images_tablename__, batch.id)).fetchall()
+    self.assertTrue("_batch_name" in str(plan))
+
+  def _testIterDetails(self):
+    '''Test the iter_ functions, the exports read in chunks.'''
+    class _Lock(object):
+      acquired = 0
+      def acquire(self):
+        self.acquired += 1
+      def release(self):
+        pass
+    batch = model.add_batch(os.path.join(os.getcwd(), "image1.jpg"),
+                            "accountID", "license", "licenseurl",
+                            "licenselogourl")
+    model.commit()
+    headerline = ["idigbio:OriginalFileName", "idigbio:MediaGUID"]
+    csvrows = [[os.path.join(os.getcwd(), "image1.jpg"), "iter%d" % i]
+               for i in xrange(5)]
+    items = model.add_records(
+        batch, [model.generate_record(row, headerline) for row in csvrows])
+    model.apply_image_updates(
+        [(items[3].id, {"UploadTime": str(datetime.datetime.utcnow())})])
+    model.commit()
+
+    '''All the rows, in order, 2 per query.'''
+    lock = _Lock()
+    rows = list(model.iter_batch_details(batch.id, 2, lock))
+    self.assertEqual([row[0] for row in rows],
+                     ["iter%d" % i for i in xrange(5)])
+    self.assertEqual(len(rows[0]), len(model.get_batch_details_fieldnames()))
+    self.assertEqual(rows[0][14], batch.CSVfilePath)
+    self.assertEqual(lock.acquired, 3)
+    self.assertEqual(model.get_batch_details(batch.id), rows)
+    '''The last batch is batch 0.'''
+    self.assertEqual(list(model.iter_batch_details(0)), rows)
+    '''Only the given columns.'''
+    self.assertEqual(
+        list(model.iter_batch_details(batch.id, 3, columns=(
+            model.ImageRecord.OriginalFileName, model.UploadBatch.id))),
+        [(row[1], batch.id) for row in rows])
+
+    '''The uploaded rows of all the batches.'''
+    uploaded = list(model.iter_all_success_details(1))
+    self.assertTrue(rows[3] in uploaded)
+    self.assertFalse(rows[2] in uploaded)
+    '''The rows of the batches whose CSV is not uploaded.'''
+    self.assertTrue(rows[4] in model.get_unuploaded_information())
+    model.set_all_csv_uploaded()
+    self.assertEqual(list(model.iter_unuploaded_information()), [])
+
+  def _testExportWatermark(self):
+    '''Test iter_uploaded_details and the watermarks of the consumers.'''
+    batch = model.add_batch(os.path.join(os.getcwd(), "image1.jpg"),
+                            "accountID", "license", "licenseurl",
+                            "licenselogourl")
+    model.commit()
+    headerline = ["idigbio:OriginalFileName", "idigbio:MediaGUID"]
+    csvrows = [[os.path.join(os.getcwd(), "image1.jpg"), "mark%d" % i]
+               for i in xrange(5)]
+    items = model.add_records(
+        batch, [model.generate_record(row, headerline) for row in csvrows])
+    # Uploaded out of order, 0 and 3 at the same time, 4 not uploaded.
+    times = ["2031-01-02", "2031-01-03", "2031-01-01", "2031-01-02"]
+    model.apply_image_updates(
+        [(item.id, {"UploadTime": time}) for item, time in zip(items, times)])
+    model.commit()
+    keys = [("2031-01-01", items[2].id), ("2031-01-02", items[0].id),
+            ("2031-01-02", items[3].id), ("2031-01-03", items[1].id)]
+
+    '''Ordered by the upload time then the id, 2 per query.'''
+    after = ("2031", 0)
+    uploaded = list(model.iter_uploaded_details(after, None, 2))
+    self.assertEqual([key for key, row in uploaded], keys)
+    self.assertEqual(uploaded[0][1][0], "mark2")
+    self.assertEqual(len(uploaded[0][1]),
+                     len(model.get_batch_details_fieldnames()))
+    '''After a key, the records at the same time are not skipped.'''
+    self.assertEqual(
+        [key for key, row in model.iter_uploaded_details(keys[1], None, 1)],
+        keys[2:])
+    '''Up to until.'''
+    self.assertEqual(
+        [key for key, row in model.iter_uploaded_details(after, "2031-01-02")],
+        keys[:3])
+
+    self.assertEqual(model.get_export_watermark("indexer"), None)
+    model.set_export_watermark("indexer", keys[2], 3)
+    model.commit()
+    self.assertEqual(model.get_export_watermark("indexer"), keys[2])
+    self.assertEqual(model.get_export_watermark("other"), None)
+    model.set_export_watermark("indexer", None, 0)
+    model.commit()
+    self.assertEqual(model.get_export_watermark("indexer"), None)
+
   def _testGetAllBatches(self):
     '''
     Test get_all_batches. Compare the queried batches with the recorded
@@ -224,8 +518,62 @@ class TestModel(unittest.TestCase):
     self.assertIsNone(retdict["ErrorCode"])
     self.assertTrue(retdict["finished"])
 
+  def _testFingerprintCache(self):
+    '''Test the file fingerprint cache.'''
+    path = os.path.join(os.getcwd(), "image1.jpg")
+    st = os.stat(path)
+    self.assertIsNone(model.get_cached_md5(path, st))
+
+    '''The MD5 is cached after the first hashing.'''
+    md5, st2 = model.md5_path_cached(path)
+    self.assertEqual(st2.st_size, st.st_size)
+    model.commit()
+    self.assertEqual(model.get_cached_md5(path, st), md5)
+
+    '''A cached MD5 is reused while the file is unchanged.'''
+    model.cache_md5(path, st, "cachedmd5")
+    model.flush_fingerprints()
+    self.assertEqual(model.md5_path_cached(path)[0], "cachedmd5")
+
+    '''A changed file is not served from the cache.'''
+    changed = os.stat_result((st.st_mode, st.st_ino, st.st_dev, st.st_nlink,
+        st.st_uid, st.st_gid, st.st_size + 1, st.st_atime, st.st_mtime,
+        st.st_ctime))
+    self.assertIsNone(model.get_cached_md5(path, changed))
+
+  def _testChunkProgress(self):
+    '''Test the chunked upload progress store.'''
+    path = os.path.join(os.getcwd(), "image1.jpg")
+    st = os.stat(path)
+    self.assertIsNone(model.get_chunk_progress(path, st))
+    model.save_chunk_progress(path, st, "upload1", 1024)
+    self.assertEqual(model.get_chunk_progress(path, st), ("upload1", 1024))
+
+    '''The progress survives a commit and is dropped for a changed file.'''
+    model.commit()
+    self.assertEqual(model.get_chunk_progress(path, st), ("upload1", 1024))
+    changed = os.stat_result((st.st_mode, st.st_ino, st.st_dev, st.st_nlink,
+        st.st_uid, st.st_gid, st.st_size + 1, st.st_atime, st.st_mtime,
+        st.st_ctime))
+    self.assertIsNone(model.get_chunk_progress(path, changed))
+
+    '''A finished upload is forgotten.'''
+    model.clear_chunk_progress(path)
+    self.assertIsNone(model.get_chunk_progress(path, st))
+    model.commit()
+    self.assertIsNone(model.get_chunk_progress(path, st))
+
   def runTest(self):
+    self._testFingerprintCache()
+    self._testChunkProgress()
     self._testAddBatch()
+    self._testAddRecords()
+    self._testStatOnlyRecord()
+    self._testUploadJobs()
+    self._testGetFailedImages()
+    self._testHistoryPages()
+    self._testIterDetails()
+    self._testExportWatermark()
     self._testAddImage()
     self._testGetAllBatches()
     self._testGetBatchDetails()
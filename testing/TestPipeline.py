@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# Test functions in pipeline.
+
+import sys, os, unittest, threading
+
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services.pipeline import Pipeline, Stage
+from dataingestion.services.metrics import Registry
+
+class TestPipeline(unittest.TestCase):
+  def setUp(self):
+    self._results = []
+    self._lock = threading.Lock()
+
+  def _collect(self, item):
+    with self._lock:
+      self._results.append(item)
+
+#----------------------------------------------------
+# Tests.
+
+  def _testAllItemsFlow(self):
+    '''Every item goes through all the stages; None results are dropped.'''
+    def _double(item):
+      return item * 2
+    def _drop_odd(item):
+      if item % 4 == 0:
+        return item
+      return None
+    pipeline = Pipeline([
+        Stage("double", _double, 4, 2),
+        Stage("filter", _drop_odd, 2, 2),
+        Stage("collect", self._collect, 1, 2)])
+    pipeline.start()
+    for i in xrange(100):
+      pipeline.put(i)
+    pipeline.close()
+    self.assertTrue(pipeline.join(5))
+    self.assertEqual(sorted(self._results), range(0, 200, 4))
+
+  def _testWorkerArgs(self):
+    '''Each worker gets its own args from make_args.'''
+    def _tag(item, tag):
+      return (item, tag)
+    counter = [0]
+    def _make_args():
+      counter[0] += 1
+      return (counter[0],)
+    pipeline = Pipeline([
+        Stage("tag", _tag, 3, 0, _make_args),
+        Stage("collect", self._collect)])
+    pipeline.start()
+    for i in xrange(10):
+      pipeline.put(i)
+    pipeline.close()
+    self.assertTrue(pipeline.join(5))
+    self.assertEqual(counter[0], 3)
+    self.assertEqual(len(self._results), 10)
+    for item, tag in self._results:
+      self.assertTrue(tag in (1, 2, 3))
+
+  def _testErrorsAreKept(self):
+    '''Exceptions are kept by the worker threads and do not stop the stage.'''
+    def _fail_on_three(item):
+      if item == 3:
+        raise ValueError("three")
+      return item
+    pipeline = Pipeline([
+        Stage("fail", _fail_on_three, 2),
+        Stage("collect", self._collect)])
+    pipeline.start()
+    for i in xrange(6):
+      pipeline.put(i)
+    pipeline.close()
+    self.assertTrue(pipeline.join(5))
+    self.assertEqual(sorted(self._results), [0, 1, 2, 4, 5])
+    exc_infos = [info for thread in pipeline.threads()
+                 for info in thread.exc_infos]
+    self.assertEqual(len(exc_infos), 1)
+    self.assertTrue(isinstance(exc_infos[0][1], ValueError))
+
+  def _testAbort(self):
+    '''An aborted pipeline drops the queued items and finishes.'''
+    release = threading.Event()
+    def _wait(item):
+      release.wait(5)
+      return item
+    pipeline = Pipeline([
+        Stage("wait", _wait, 1, 10),
+        Stage("collect", self._collect)])
+    pipeline.start()
+    for i in xrange(5):
+      pipeline.put(i)
+    pipeline.abort()
+    release.set()
+    self.assertTrue(pipeline.join(5))
+    self.assertTrue(len(self._results) <= 1)
+
+  def _testAbortAfterClose(self):
+    '''Aborting a closed pipeline does not put stop marks again.'''
+    pipeline = Pipeline([Stage("collect", self._collect, 4, 1)])
+    pipeline.start()
+    for i in xrange(5):
+      pipeline.put(i)
+    pipeline.close()
+    self.assertTrue(pipeline.join(5))
+    aborted = threading.Thread(target=pipeline.abort)
+    aborted.daemon = True
+    aborted.start()
+    aborted.join(5)
+    self.assertFalse(aborted.isAlive())
+    self.assertEqual(sorted(self._results), range(5))
+
+  def _testBatchStage(self):
+    '''A batch stage gets lists of at most batch_size items.'''
+    sizes = []
+    def _sum_pairs(items):
+      sizes.append(len(items))
+      return [item + 1000 for item in items]
+    pipeline = Pipeline([
+        Stage("batch", _sum_pairs, 2, 50, None, 7),
+        Stage("collect", self._collect)])
+    pipeline.start()
+    for i in xrange(100):
+      pipeline.put(i)
+    pipeline.close()
+    self.assertTrue(pipeline.join(5))
+    self.assertEqual(sorted(self._results), range(1000, 1100))
+    self.assertEqual(sum(sizes), 100)
+    self.assertTrue(max(sizes) <= 7)
+
+  def _testPeakDepth(self):
+    '''The stats report the peak depth of each stage queue.'''
+    release = threading.Event()
+    entered = threading.Event()
+    def _wait(item):
+      entered.set()
+      release.wait(5)
+      return item
+    pipeline = Pipeline([
+        Stage("wait", _wait, 1, 10),
+        Stage("collect", self._collect, 1, 3)])
+    pipeline.start()
+    for i in xrange(6):
+      pipeline.put(i)
+    # One item is taken by the worker, the others wait in the queue.
+    self.assertTrue(entered.wait(5))
+    self.assertTrue(pipeline.stats()[0]["peak_depth"] >= 5)
+    self.assertEqual(pipeline.stats()[0]["active"], 1)
+    release.set()
+    pipeline.close()
+    self.assertTrue(pipeline.join(5))
+    wait, collect = pipeline.stats()
+    self.assertEqual(wait["active"], 0)
+    self.assertEqual(wait["depth"], 0)
+    self.assertEqual(wait["maxsize"], 10)
+    self.assertTrue(collect["peak_depth"] <= 3)
+    self.assertEqual(sorted(self._results), range(6))
+
+  def _testHold(self):
+    '''A held stage does not finish until its items are put back.'''
+    held = []
+    def _retry_once(item, stage):
+      if item not in held:
+        held.append(item)
+        stage.hold()
+        return None
+      return item
+    retry = Stage("retry", _retry_once, 2, 0, lambda: (retry,))
+    pipeline = Pipeline([retry, Stage("collect", self._collect)])
+    pipeline.start()
+    for i in xrange(5):
+      pipeline.put(i)
+    pipeline.close()
+    self.assertFalse(pipeline.join(0.2))
+    for item in held:
+      retry.put(item)
+      retry.unhold()
+    self.assertTrue(pipeline.join(5))
+    self.assertEqual(sorted(self._results), range(5))
+
+  def _testLatency(self):
+    '''Each call of a stage function is observed, labelled by stage.'''
+    registry = Registry()
+    latency = registry.histogram("stage_seconds", "Latency.", ("stage",))
+    pipeline = Pipeline([
+        Stage("batch", lambda items: items, 1, 0, None, 100),
+        Stage("collect", self._collect)], latency)
+    pipeline.start()
+    for i in xrange(5):
+      pipeline.put(i)
+    pipeline.close()
+    self.assertTrue(pipeline.join(5))
+    counts = dict((value["labels"]["stage"], value["value"]["count"])
+                  for value in registry.to_dict()["stage_seconds"]["values"])
+    self.assertEqual(counts["collect"], 5)
+    self.assertTrue(1 <= counts["batch"] <= 5)
+
+  def runTest(self):
+    for test in (self._testAllItemsFlow, self._testWorkerArgs,
+                 self._testErrorsAreKept, self._testAbort,
+                 self._testAbortAfterClose,
+                 self._testBatchStage, self._testPeakDepth, self._testHold,
+                 self._testLatency):
+      self._results = []
+      test()
+
+
+if __name__ == '__main__':
+      unittest.main()
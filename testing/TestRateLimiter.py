@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# Test functions in rate_limiter.
+
+import sys, os, unittest, time
+from datetime import datetime
+
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services import rate_limiter
+from dataingestion.services.rate_limiter import RateLimiter
+
+class TestRateLimiter(unittest.TestCase):
+
+#----------------------------------------------------
+# Tests.
+
+  def _testParse(self):
+    '''Rates and schedules are parsed, invalid ones rejected.'''
+    self.assertEqual(rate_limiter.parse_rate("2M"), 2 * 2 ** 20)
+    self.assertEqual(rate_limiter.parse_rate("512kb/s"), 512 * 2 ** 10)
+    self.assertEqual(rate_limiter.parse_rate("1000"), 1000)
+    self.assertIsNone(rate_limiter.parse_rate("unlimited"))
+    self.assertRaises(ValueError, rate_limiter.parse_rate, "fast")
+    self.assertEqual(rate_limiter.parse_schedule("08:00-18:00=2M, 5K"),
+                     [(480, 1080, 2 * 2 ** 20), (0, 1440, 5 * 2 ** 10)])
+    self.assertEqual(rate_limiter.parse_schedule(""), [])
+    self.assertRaises(ValueError, rate_limiter.parse_schedule, "8-18=2M")
+
+  def _testSchedule(self):
+    '''The rate follows the time of day, ranges may wrap midnight.'''
+    limiter = RateLimiter("08:00-18:00=2M, 22:00-06:00=8M")
+    self.assertEqual(limiter.current_rate(datetime(2013, 1, 1, 9, 30)),
+                     2 * 2 ** 20)
+    self.assertIsNone(limiter.current_rate(datetime(2013, 1, 1, 18, 0)))
+    self.assertEqual(limiter.current_rate(datetime(2013, 1, 1, 23, 0)),
+                     8 * 2 ** 20)
+    self.assertEqual(limiter.current_rate(datetime(2013, 1, 1, 1, 0)),
+                     8 * 2 ** 20)
+
+  def _testThrottle(self):
+    '''Sending beyond the rate is delayed, and the delay is reported.'''
+    limiter = RateLimiter("100K")
+    starttime = time.time()
+    for _junk in xrange(5):
+      limiter.consume(10 * 2 ** 10)
+    self.assertTrue(time.time() - starttime >= 0.4)
+    stats = limiter.stats()
+    self.assertEqual(stats["bytes"], 50 * 2 ** 10)
+    self.assertTrue(stats["throttle_delay"] >= 0.4)
+    self.assertAlmostEqual(limiter.thread_delay(), stats["throttle_delay"])
+    # The bucket is in debt after the throttled sends.
+    self.assertTrue(0 <= limiter.allowance() <= 100 * 2 ** 10)
+
+    limiter.set_schedule("")
+    starttime = time.time()
+    limiter.consume(2 ** 30)
+    self.assertTrue(time.time() - starttime < 0.1)
+    self.assertIsNone(limiter.allowance())
+
+  def runTest(self):
+    self._testParse()
+    self._testSchedule()
+    self._testThrottle()
+
+
+if __name__ == '__main__':
+      unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# Test functions in retry_scheduler.
+
+import sys, os, unittest, threading, time
+
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services.retry_scheduler import (CircuitBreaker,
+                                                    RetryScheduler)
+
+class _Stage(object):
+  """Collects the items put back, and counts the holds."""
+  def __init__(self):
+    self.items = []
+    self.holds = 0
+    self.put_event = threading.Event()
+
+  def put(self, item):
+    self.items.append(item)
+    self.put_event.set()
+
+  def hold(self):
+    self.holds += 1
+
+  def unhold(self):
+    self.holds -= 1
+
+class TestRetryScheduler(unittest.TestCase):
+
+#----------------------------------------------------
+# Tests.
+
+  def _testBackoff(self):
+    '''The delay doubles per retry, with jitter, up to max_delay.'''
+    scheduler = RetryScheduler(_Stage(), 1.0, 16.0)
+    for retry, delay in ((1, 1.0), (2, 2.0), (3, 4.0), (6, 16.0), (9, 16.0)):
+      for _junk in xrange(20):
+        backoff = scheduler.backoff(retry)
+        self.assertTrue(delay / 2 <= backoff <= delay)
+
+  def _testItemsArePutBack(self):
+    '''A scheduled item is put back once its delay has passed.'''
+    stage = _Stage()
+    scheduler = RetryScheduler(stage, 0.05, 0.1)
+    scheduler.start()
+    scheduler.started("a")
+    delay = scheduler.schedule("item a", "a")
+    self.assertTrue(0.025 <= delay <= 0.05)
+    self.assertEqual(stage.holds, 1)
+    self.assertTrue(stage.put_event.wait(5))
+    scheduler.stop()
+    self.assertEqual(stage.items, ["item a"])
+    self.assertEqual(stage.holds, 0)
+    self.assertEqual(scheduler.stats()["retries"], 1)
+
+  def _testRetryLimits(self):
+    '''An item gets max_retries retries, all of them fit in the budget.'''
+    stage = _Stage()
+    scheduler = RetryScheduler(stage, 10, 10, 2, 0.5, 2)
+    for key in ("a", "b", "c", "d"):
+      scheduler.started(key)
+    self.assertTrue(scheduler.schedule("a", "a") is not None)
+    scheduler.started("a") # A retry is not a new request.
+    self.assertTrue(scheduler.schedule("a", "a") is not None)
+    self.assertTrue(scheduler.schedule("a", "a") is None)
+    # 2 + 0.5 * 4 requests.
+    self.assertTrue(scheduler.schedule("b", "b") is not None)
+    self.assertTrue(scheduler.schedule("c", "c") is not None)
+    self.assertTrue(scheduler.schedule("d", "d") is None)
+    stats = scheduler.stats()
+    self.assertEqual(stats["requests"], 4)
+    self.assertEqual(stats["exhausted"], 1)
+    self.assertEqual(stats["over_budget"], 1)
+    self.assertEqual(scheduler.pending(), 4)
+    # The pending retries are dropped.
+    scheduler.start()
+    scheduler.stop()
+    self.assertEqual(stage.items, [])
+    self.assertEqual(stage.holds, 0)
+    self.assertTrue(scheduler.schedule("b", "b") is None)
+
+  def _testBreakerOpens(self):
+    '''The breaker opens after consecutive failures and pauses the callers.'''
+    breaker = CircuitBreaker(3, 0.2)
+    breaker.record(False)
+    breaker.record(False)
+    breaker.record(True)
+    breaker.record(False)
+    breaker.record(False)
+    self.assertEqual(breaker.get_state(), CircuitBreaker.CLOSED)
+    breaker.record(False)
+    self.assertEqual(breaker.get_state(), CircuitBreaker.OPEN)
+    self.assertTrue(breaker.unhealthy_for() >= 0)
+    starttime = time.time()
+    token = breaker.wait()
+    self.assertEqual(token, CircuitBreaker.TRIAL)
+    self.assertTrue(time.time() - starttime >= 0.15)
+    self.assertEqual(breaker.get_state(), CircuitBreaker.HALF_OPEN)
+    # The trial succeeds.
+    breaker.record(True, token)
+    self.assertEqual(breaker.get_state(), CircuitBreaker.CLOSED)
+    self.assertEqual(breaker.unhealthy_for(), 0)
+
+  def _testBreakerTrial(self):
+    '''A half open breaker lets one trial through, a failed trial reopens it.'''
+    breaker = CircuitBreaker(1, 0.05, 1.0)
+    breaker.record(False)
+    token = breaker.wait()
+    self.assertEqual(token, CircuitBreaker.TRIAL)
+    passed = []
+    def _wait():
+      passed.append(breaker.wait())
+    thread = threading.Thread(target=_wait)
+    thread.start()
+    thread.join(0.2)
+    # Held while the trial is in flight.
+    self.assertEqual(passed, [])
+    # The outcomes of the other requests do not end the trial.
+    breaker.record(None)
+    breaker.record(False)
+    thread.join(0.2)
+    self.assertEqual(passed, [])
+    self.assertEqual(breaker.get_state(), CircuitBreaker.HALF_OPEN)
+    breaker.record(False, token)
+    self.assertEqual(breaker.stats()["reset_timeout"], 0.1)
+    thread.join(5)
+    self.assertEqual(passed, [CircuitBreaker.TRIAL])
+    breaker.cancel()
+    self.assertFalse(breaker.wait())
+
+  def runTest(self):
+    self._testBackoff()
+    self._testItemsArePutBack()
+    self._testRetryLimits()
+    self._testBreakerOpens()
+    self._testBreakerTrial()
+
+
+if __name__ == '__main__':
+      unittest.main()
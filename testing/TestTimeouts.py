@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# Test functions in timeouts.
+
+import sys, os, unittest
+
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services.timeouts import AdaptiveTimeout, MIN_THROUGHPUT
+
+class TestTimeouts(unittest.TestCase):
+
+#----------------------------------------------------
+# Tests.
+
+  def _testSizeAware(self):
+    '''The timeout grows with the size at the initial throughput.'''
+    timeouts = AdaptiveTimeout(10, 20, 2 ** 20, 4)
+    self.assertEqual(timeouts.get(0), 10)
+    self.assertEqual(timeouts.get(2 ** 20), 14)
+    self.assertEqual(timeouts.get(500 * 2 ** 20), 2010)
+    self.assertEqual(timeouts.stats()["max_timeout"], 2010)
+
+  def _testMeasuredThroughput(self):
+    '''The measured throughput replaces the initial one; small bodies do not
+    count.'''
+    timeouts = AdaptiveTimeout(10, 20, 2 ** 20, 4)
+    timeouts.record(1000, 10)
+    self.assertEqual(timeouts.stats()["samples"], 0)
+    timeouts.record(8 * 2 ** 20, 2)
+    self.assertEqual(timeouts.stats()["throughput"], 4 * 2 ** 20)
+    self.assertEqual(timeouts.get(4 * 2 ** 20), 14)
+    timeouts.record(8 * 2 ** 20, 4)
+    self.assertTrue(2 * 2 ** 20 < timeouts.stats()["throughput"] < 4 * 2 ** 20)
+
+  def _testTimedOut(self):
+    '''A timeout halves the throughput estimate, down to a floor.'''
+    timeouts = AdaptiveTimeout(10, 20, 2 ** 20, 4)
+    timeouts.timed_out()
+    self.assertEqual(timeouts.stats()["throughput"], 2 ** 19)
+    for _junk in xrange(20):
+      timeouts.timed_out()
+    self.assertEqual(timeouts.stats()["throughput"], MIN_THROUGHPUT)
+    self.assertRaises(ValueError, timeouts.set_stall_timeout, 0)
+    timeouts.set_stall_timeout("30")
+    self.assertEqual(timeouts.stall_timeout, 30)
+
+  def runTest(self):
+    self._testSizeAware()
+    self._testMeasuredThroughput()
+    self._testTimedOut()
+
+
+if __name__ == '__main__':
+      unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 Liu, Yonggang <myidpt@gmail.com>, University of Florida
+#
+# This software may be used and distribted according to the terms of the
+# MIT license: http://www.opensource.org/licenses/mit-license.php
+
+# Test functions in zip_stream.
+
+import sys, os, unittest, zipfile, random
+from cStringIO import StringIO
+
+rootdir = os.path.dirname(os.getcwd())
+sys.path.append(rootdir)
+sys.path.append(os.path.join(rootdir, 'lib'))
+
+from dataingestion.services.zip_stream import ZipStreamWriter
+
+class TestZipStream(unittest.TestCase):
+  def setUp(self):
+    rand = random.Random(1)
+    # Compressible, and several chunks long.
+    self._data = "".join(
+        "{0},{1}\n".format(i, rand.choice("abc") * rand.randint(1, 9))
+        for i in xrange(50000))
+
+  def _write(self, **kwargs):
+    output = StringIO()
+    with ZipStreamWriter(output, chunk_size=64 * 2 ** 10, **kwargs) as zf:
+      with zf.open("image.csv") as entry:
+        for start in xrange(0, len(self._data), 1000):
+          entry.write(self._data[start:start + 1000])
+      with zf.open(u"stub\xe9.csv") as entry:
+        pass
+    return zipfile.ZipFile(StringIO(output.getvalue()))
+
+  def _check(self, zf):
+    self.assertEqual(zf.testzip(), None)
+    self.assertEqual(zf.namelist(), ["image.csv", u"stub\xe9.csv"])
+    self.assertEqual(zf.read("image.csv"), self._data)
+    self.assertEqual(zf.read(u"stub\xe9.csv"), "")
+
+#----------------------------------------------------
+# Tests.
+
+  def _testDeflated(self):
+    '''The entries are compressed and read back by zipfile.'''
+    zf = self._write()
+    self._check(zf)
+    info = zf.getinfo("image.csv")
+    self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+    self.assertTrue(info.compress_size < info.file_size / 2)
+
+  def _testStored(self):
+    '''The entries are stored uncompressed.'''
+    zf = self._write(compress=False)
+    self._check(zf)
+    self.assertEqual(zf.getinfo("image.csv").compress_size, len(self._data))
+
+  def _testWorkers(self):
+    '''The chunks compressed by a pool make one deflate stream.'''
+    zf = self._write(workers=3)
+    self._check(zf)
+    self.assertTrue(zf.getinfo("image.csv").compress_size < len(self._data) / 2)
+
+  def _testOneEntryAtATime(self):
+    '''An entry must be closed before the next one is opened.'''
+    zf = ZipStreamWriter(StringIO())
+    entry = zf.open("a")
+    self.assertRaises(ValueError, zf.open, "b")
+    entry.close()
+    self.assertRaises(ValueError, entry.write, "data")
+    zf.close()
+    self.assertRaises(ValueError, zf.open, "b")
+
+  def runTest(self):
+    self._testDeflated()
+    self._testStored()
+    self._testWorkers()
+    self._testOneEntryAtATime()
+
+
+if __name__ == '__main__':
+      unittest.main()
@@ -2,4 +2,14 @@
 ./TestUserConfig.py
 ./TestModel.py
 ./TestAPIClient.py
+./TestPipeline.py
+./TestHasher.py
+./TestDBWriter.py
+./TestConcurrency.py
+./TestHTTPPool.py
+./TestRateLimiter.py
+./TestRetryScheduler.py
+./TestTimeouts.py
+./TestMetrics.py
+./TestZipStream.py
 ./TestIngestionManager.py
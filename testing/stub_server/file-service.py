@@ -7,11 +7,126 @@ absDir = os.path.join(os.getcwd(), localDir)
 
 import cherrypy
 import json
+import shutil
+import tempfile
+import uuid
 
 import hashlib
 
+# Where the chunked uploads are assembled.
+chunkDir = os.path.join(tempfile.gettempdir(), "idigbio-stub-chunks")
+# The content-addressed store: every uploaded file is kept as <md5>.
+storeDir = os.path.join(tempfile.gettempdir(), "idigbio-stub-store")
+
+def _store_path(h):
+    """Returns the path of the content with MD5 h, None if h is not an
+    MD5 hex digest."""
+    h = str(h).lower()
+    if len(h) != 32 or not all(c in "0123456789abcdef" for c in h):
+        return None
+    return os.path.join(storeDir, h)
+
+def _store(fileobj, h):
+    """Keeps the content of fileobj, whose MD5 is h, in the store."""
+    if not os.path.exists(storeDir):
+        os.makedirs(storeDir)
+    path = _store_path(h)
+    if not os.path.exists(path):
+        fileobj.seek(0)
+        tmp = path + "." + uuid.uuid4().hex
+        with open(tmp, 'wb') as f:
+            shutil.copyfileobj(fileobj, f)
+        os.rename(tmp, path)
+
+def _md5_file(path):
+    m = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(8192)
+            if not data:
+                break
+            m.update(data)
+    return m.hexdigest()
+
+class ChunkedUpload(object):
+    """Receives a large file in chunks, see api_client._post_image_chunked.
+    An upload is a <upload_id>.part file holding the bytes received so far,
+    so its size is the acknowledged offset, and a <upload_id>.json file with
+    the file information."""
+
+    def _paths(self, upload_id):
+        if not upload_id or not all(c in "0123456789abcdef" for c in upload_id):
+            raise cherrypy.HTTPError(404, "No such upload.")
+        part = os.path.join(chunkDir, upload_id + ".part")
+        info = os.path.join(chunkDir, upload_id + ".json")
+        if not os.path.exists(info):
+            raise cherrypy.HTTPError(404, "No such upload.")
+        return part, info
+
+    @cherrypy.tools.json_out()
+    def start(self, filereference, file_name, file_size):
+        if not os.path.exists(chunkDir):
+            os.makedirs(chunkDir)
+        upload_id = uuid.uuid4().hex
+        with open(os.path.join(chunkDir, upload_id + ".json"), 'w') as f:
+            json.dump({"file_reference": filereference,
+                       "file_name": file_name,
+                       "file_size": int(file_size)}, f)
+        open(os.path.join(chunkDir, upload_id + ".part"), 'wb').close()
+        return {"upload_id": upload_id, "offset": 0}
+    start.exposed = True
+
+    @cherrypy.tools.json_out()
+    def status(self, upload_id):
+        part, info = self._paths(upload_id)
+        with open(info) as f:
+            file_size = json.load(f)["file_size"]
+        return {"upload_id": upload_id, "offset": os.path.getsize(part),
+                "file_size": file_size}
+    status.exposed = True
+
+    @cherrypy.tools.json_out()
+    def chunk(self, upload_id, offset, chunk_md5):
+        part, info = self._paths(upload_id)
+        data = cherrypy.request.body.read()
+        current = os.path.getsize(part)
+        if int(offset) != current or hashlib.md5(data).hexdigest() != chunk_md5:
+            # Not taken, tell the client where to continue.
+            cherrypy.response.status = 409
+            return {"upload_id": upload_id, "offset": current}
+        with open(part, 'ab') as f:
+            f.write(data)
+        return {"upload_id": upload_id, "offset": current + len(data)}
+    chunk.exposed = True
+
+    @cherrypy.tools.json_out()
+    def finish(self, upload_id):
+        part, info = self._paths(upload_id)
+        with open(info) as f:
+            fileinfo = json.load(f)
+        size = os.path.getsize(part)
+        if size != fileinfo["file_size"]:
+            cherrypy.response.status = 409
+            return {"upload_id": upload_id, "offset": size}
+        h = _md5_file(part)
+        with open(part, 'rb') as f:
+            _store(f, h)
+        os.remove(part)
+        os.remove(info)
+        return {
+            "file_size": size,
+            "file_name": fileinfo["file_name"],
+            "file_md5": h,
+            "file_reference": fileinfo["file_reference"],
+            "content_type": u"application/octet-stream",
+            "file_url": "127.0.0.1:8080/"+h
+        }
+    finish.exposed = True
+
 class FileDemo(object):
 
+    chunks = ChunkedUpload()
+
     def index(self):
         return """
         <html><body>
@@ -53,6 +168,7 @@ class FileDemo(object):
             m.update(data)
         file.file.seek(0)
         h = m.hexdigest()
+        _store(file.file, h)
         return { 
             "file_size": size,
             "file_name": unicode(file.filename),            
@@ -63,6 +179,23 @@ class FileDemo(object):
         }
     images.exposed = True
 
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    def exists(self):
+        """Takes {"file_md5s": [...]} and returns the ones in the store:
+        {"existing": {md5: {"file_md5", "file_size", "file_url"}}}."""
+        found = {}
+        for h in cherrypy.request.json.get("file_md5s", []):
+            path = _store_path(h)
+            if path and os.path.exists(path):
+                found[h] = {
+                    "file_md5": h,
+                    "file_size": os.path.getsize(path),
+                    "file_url": "127.0.0.1:8080/"+h
+                }
+        return {"existing": found}
+    exists.exposed = True
+
     @cherrypy.tools.json_out()
     def datasets(self, file):
         out = """<html>
@@ -1,15 +1,25 @@
 var batchid = 0
+// The tables are paged, sorted and filtered by the server: each draw gets
+// one page from /services/history.
+var batchHistoryTable = null;
+var imageHistoryTable = null;
 
 initHistoryUI = function() {
   $('#refresh-bh-button').click(function(event) {
-    $.getJSON('/services/history', { table_id: "" }, renderBatchHistory);
+    renderBatchHistory();
   });
 
   $('#history-tab-button').click(function(event) {
-    $.getJSON('/services/history', { table_id: "" }, renderBatchHistory);
+    renderBatchHistory();
   });
 
-  $.getJSON('/services/history', { table_id: "" }, renderBatchHistory);
+  $('#image-history-status').change(function(event) {
+    if (imageHistoryTable) {
+      imageHistoryTable.fnDraw();
+    }
+  });
+
+  renderBatchHistory();
 
  $('#download-all-csv-form').submit(function(event) {
     event.preventDefault();
@@ -62,14 +72,23 @@ postHistZipGen = function(values) {
   $.getJSON("/services/genoutputcsv", {values: values}, callback);
 }
 
-renderBatchHistory = function(data) {
+renderBatchHistory = function() {
   if ($('#batch-history-table-container').hasClass('hide')) {
     $('#batch-history-table-container').removeClass('hide');
     $('#batch-history-table-container').addClass('in');
   }
 
-  var bht = $('#batch-history-table').dataTable({
-    "aaData": data,
+  if (batchHistoryTable) {
+    batchHistoryTable.fnDraw(false); // Stays on the current page.
+    return;
+  }
+
+  var bht = batchHistoryTable = $('#batch-history-table').dataTable({
+    "bServerSide": true,
+    "sAjaxSource": "/services/history",
+    "fnServerParams": function(aoData) {
+      aoData.push({ "name": "table_id", "value": "" });
+    },
     "aoColumns": [
       { "sTitle": "ID", "sWidth": "5%" },
       { "sTitle": "CSV File Path", "sWidth": "25%" },
@@ -90,7 +109,6 @@ renderBatchHistory = function(data) {
     "bSort": true,
     "bInfo": true,
     "bAutoWidth": false,
-    "bDestroy" : true,
     "sPaginationType": "bootstrap"
   });
   
@@ -109,23 +127,39 @@ renderBatchHistory = function(data) {
     }
 
     var aData = bht.fnGetData( this.parentNode );//get data of the clicked row
+    if (aData == null) {
+      return; // E.g. the "No data" row.
+    }
     batchid = aData[0];
-    $.getJSON('/services/history', { table_id: aData[0] }, 
-              renderMediaRecordHistory);
+    renderMediaRecordHistory();
     $('#image-history-table-description').text("Batch ID: " + aData[0]);
   });
 }
 
-renderMediaRecordHistory = function(data) {
+renderMediaRecordHistory = function() {
   if ($('#image-history-table-container').hasClass('hide')) {
     $('#image-history-table-container').removeClass('hide');
     $('#image-history-table-container').addClass('in');
   };
-  $('#image-history-table').dataTable({
-    "aaData": data,
+
+  if (imageHistoryTable) {
+    imageHistoryTable.fnDraw(); // The first page of the selected batch.
+    return;
+  }
+
+  imageHistoryTable = $('#image-history-table').dataTable({
+    "bServerSide": true,
+    "sAjaxSource": "/services/history",
+    "fnServerParams": function(aoData) {
+      aoData.push({ "name": "table_id", "value": batchid });
+      aoData.push({ "name": "status",
+                    "value": $('#image-history-status').val() });
+    },
+    "aaSorting": [], // In the CSV order until a column is clicked.
     "aoColumns": [
       { "sTitle": "OriginalFileName", "sWidth": "42%" },
       { "sTitle": "Online Path or Error Message", "sWidth": "58%",
+        "bSortable": false,
         "fnRender": function(obj) {
           error = obj.aData[1]; // It is given as an array.
           url = obj.aData[2];
@@ -142,14 +176,13 @@ renderMediaRecordHistory = function(data) {
         }
       } // 3 elements.
     ],
-    "sDom": "<'row'<'span5'l><'span6'p>>tr<'row'<'span6'i>>",
+    "sDom": "<'row'<'span5'l><'span6'f>>tr<'row'<'span5'i><'span6'p>>",
     "bPaginate": true,
     "bLengthChange": true,
-    "bFilter": false,
+    "bFilter": true,
     "bSort": true,
     "bInfo": true,
     "bAutoWidth": false,
-    "bDestroy" : true,
     "sPaginationType": "bootstrap"
   });
 }
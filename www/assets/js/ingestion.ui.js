@@ -309,7 +309,7 @@ postCsvUpload = function(action, values) {
     $(".progress-primary").addClass('active');
     $("#progressbar-container").addClass('in');
 
-    setTimeout("updateProgress()", 1000);
+    watchProgress();
   };
 
   // now send the form and wait to hear back
@@ -319,7 +319,14 @@ postCsvUpload = function(action, values) {
       var errMsg = "<strong>Error! </strong>" + data.responseText;
       showAlert(errMsg)
     });
-  } else {
+  } else if (action == "retry") {
+    $.post('/services/retry', callback, 'json')
+    .error(function(data) {
+      var errMsg = "<strong>Error! </strong>" + data.responseText;
+      showAlert(errMsg);
+    });
+  } else if (action == "resume") {
+    // Without values, the last unfinished batch is resumed.
     $.post('/services/ingest', callback, 'json')
     .error(function(data) {
       var errMsg = "<strong>Error! </strong>" + data.responseText;
@@ -340,16 +347,16 @@ showLastBatchInfo = function() {
         + 'Your last upload from directory/CSV file ',
         batch.path, ' which started at ', start_time,
         ' was not entirely successful.</p>'].join("");
-      var extra = '<p><button id="retry-button" type="submit"'
-        + ' class="btn btn-warning">Retry failed uploads</button></p>';
+      var extra = '<p><button id="resume-button" type="submit"'
+        + ' class="btn btn-warning">Resume the upload</button></p>';
       showAlert(errMsg, extra, "alert-warning");
-      $("#retry-button").click(function(event) {
+      $("#resume-button").click(function(event) {
         event.preventDefault();
         $("#upload-alert").alert('close');
         // TODO: Differentiate the CSV task or dir task.
-        postCsvUpload("retry");
-        // Note: retry will reload the batch information, and read the CSV file
-        // again.
+        postCsvUpload("resume");
+        // Note: resume uploads the unfinished images, and reads the CSV file
+        // again if it was not read completely.
       });
     }
   }, "json");
@@ -382,112 +389,149 @@ showAlert = function(message, additionalElement, alertType) {
   $("#alert-extra").html(additionalElement);
 }
 
-updateProgress = function() {
+// The progress is pushed by the server as Server-Sent Events. Browsers
+// without EventSource, or where the stream fails, long-poll instead.
+var progressSource = null;
+
+watchProgress = function() {
+  if (!window.EventSource) {
+    pollProgress();
+    return;
+  }
+  progressSource = new EventSource('/services/progressstream?now=' + $.now());
+  progressSource.onmessage = function(event) {
+    if (renderProgress($.parseJSON(event.data))) {
+      progressSource.close();
+      progressSource = null;
+    }
+  };
+  progressSource.onerror = function() {
+    if (progressSource) {
+      progressSource.close();
+      progressSource = null;
+      pollProgress();
+    }
+  };
+}
+
+pollProgress = function(task, version) {
   // dummy query string is added not to allow IE retrieve results
   // from its browser cache.
   // added by Kyuho in July 23rd 2013
   var url = '/services/ingestionprogress?&now=' + $.now();
+  if (task !== undefined) {
+    // Returns once the progress differs from this version.
+    url += '&task=' + task + '&version=' + version;
+  }
 
   $.getJSON(url, function(progressObj) {
-    var progress = progressObj.total == 0 ? 100 :
-      Math.floor((progressObj.successes + progressObj.fails +
-        progressObj.skips) / progressObj.total * 100);
-
-    var csvfileuploaded = "";
-    if (progress == 100) {
-      if (progressObj.successes == 0) {
-        csvfileuploaded = "No CSV file is generated.";
-      } else if (progressObj.csvuploaded) {
-        csvfileuploaded = "CSV file is uploaded.";
-      } else if (progressObj.finished){
-        csvfileuploaded = "CSV file upload failed.";
-      }
+    if (!renderProgress(progressObj)) {
+      pollProgress(progressObj.task, progressObj.version);
+    }
+  });
+}
+
+// Shows the progress. Returns true once no more progress is expected.
+renderProgress = function(progressObj) {
+  var progress = progressObj.total == 0 ? 100 :
+    Math.floor((progressObj.successes + progressObj.fails +
+      progressObj.skips) / progressObj.total * 100);
+
+  var csvfileuploaded = "";
+  if (progress == 100) {
+    if (progressObj.successes == 0) {
+      csvfileuploaded = "No CSV file is generated.";
+    } else if (progressObj.csvuploaded) {
+      csvfileuploaded = "CSV file is uploaded.";
+    } else if (progressObj.finished){
+      csvfileuploaded = "CSV file upload failed.";
     }
+  }
 
-    $("#progresstext").text(
-      ["Progress: (Successful:" + progressObj.successes,
-       ", Skipped: " + progressObj.skips,
-       ", Failed: " + progressObj.fails,
-       ", Total to upload: " + progressObj.total,
-       ". " + csvfileuploaded,
-       ")"].join(""));
+  $("#progresstext").text(
+    ["Progress: (Successful:" + progressObj.successes,
+     ", Skipped: " + progressObj.skips,
+     ", Failed: " + progressObj.fails,
+     ", Total to upload: " + progressObj.total,
+     ". " + csvfileuploaded,
+     ")"].join(""));
 
-    $("#upload-progressbar").width(progress + '%');
+  $("#upload-progressbar").width(progress + '%');
 
-    if (progressObj.fatal_server_error) {
-      var errMsg = ["<p><strong>Warning!</strong> ",
+  if (progressObj.fatal_server_error) {
+    var errMsg = ["<p><strong>Warning!</strong> ",
 		    "<p>FATAL SERVER ERROR</p> ",
 		    "<p>Server under maintenance. Try Later</p>", ].join("");
-      showAlert(errMsg, extra, "alert-warning");
-    } else if (progressObj.input_csv_error) {
-      var errMsg = ["<p><strong>Input CSV FILE ERROR</strong> ",
-                    "<p>Your input CSV file is weird</p> ",
-                    "<p>THis error occurs when your CSV file has different number",
-                    " of columns among rows or any field contains double quatation",
-                    " mark(\")</p>", ].join("");
-      showAlert(errMsg, extra, "alert-warning");
-    } else if (progressObj.finished) {
-      $(".progress-primary").toggleClass('active');
-
-      $('#csv-license-dropdown').attr('disabled', false);
-      $("#csv-license-dropdown").removeClass('disabled');
-
-      $('#csv-path').attr('disabled', false);
-      $("#csv-path").removeClass('disabled');
-
-      $("#csv-upload-button").attr('disabled', false);
-      $("#csv-upload-button").removeClass('disabled');
-
-      if (progressObj.successes == 0) {
-        $("#result-gen-container").addClass('in');
-        $("#result-gen-container").addClass('hide');
-      }
-      else {
-        $("#result-gen-container").removeClass('in');
-        $("#result-gen-container").removeClass('hide');
-      }
+    showAlert(errMsg, extra, "alert-warning");
+    return true;
+  } else if (progressObj.input_csv_error) {
+    var errMsg = ["<p><strong>Input CSV FILE ERROR</strong> ",
+                  "<p>Your input CSV file is weird</p> ",
+                  "<p>THis error occurs when your CSV file has different number",
+                  " of columns among rows or any field contains double quatation",
+                  " mark(\")</p>", ].join("");
+    showAlert(errMsg, extra, "alert-warning");
+    return true;
+  } else if (progressObj.finished) {
+    $(".progress-primary").toggleClass('active');
+
+    $('#csv-license-dropdown').attr('disabled', false);
+    $("#csv-license-dropdown").removeClass('disabled');
+
+    $('#csv-path').attr('disabled', false);
+    $("#csv-path").removeClass('disabled');
+
+    $("#csv-upload-button").attr('disabled', false);
+    $("#csv-upload-button").removeClass('disabled');
+
+    if (progressObj.successes == 0) {
+      $("#result-gen-container").addClass('in');
+      $("#result-gen-container").addClass('hide');
+    }
+    else {
+      $("#result-gen-container").removeClass('in');
+      $("#result-gen-container").removeClass('hide');
+    }
 
-      if (progressObj.fails > 0 || progressObj.total == 0) {
-        if (progressObj.fails > 0) {
-          var errMsg = ["<p><strong>Warning!</strong> ",
-            "This upload was not entirely successful. ",
-            "You can retry it at a later time."].join("");
-          if (progress < 100) {
-            errMsg += [' Upload aborted before all images are tried ',
-              'due to continuing erroneous network conditions.'].join('');
-          }
-          var extra = ['<p><button id="retry-button" type="submit"',
-            'class="btn btn-warning">Retry failed uploads</button></p>'].join("");
-        } else {
+    if (progressObj.fails > 0 || progressObj.total == 0) {
+      if (progressObj.fails > 0) {
+        var errMsg = ["<p><strong>Warning!</strong> ",
+          "This upload was not entirely successful. ",
+          "You can retry it at a later time."].join("");
+        if (progress < 100) {
+          errMsg += [' Upload aborted before all images are tried ',
+            'due to continuing erroneous network conditions.'].join('');
+        }
+        var extra = ['<p><button id="retry-button" type="submit"',
+          'class="btn btn-warning">Retry failed uploads</button></p>'].join("");
+      } else {
 
-          var errMsg = ["<p><strong>Warning!</strong> ",
-            "Nothing is uploaded. Maybe the CSV is empty or the network is down? ",
-            "Please check the folder and network connection and ",
-            "retry it by clicking the 'Upload' button."].join("");
+        var errMsg = ["<p><strong>Warning!</strong> ",
+          "Nothing is uploaded. Maybe the CSV is empty or the network is down? ",
+          "Please check the folder and network connection and ",
+          "retry it by clicking the 'Upload' button."].join("");
 
-        }
-        showAlert(errMsg, extra, "alert-warning");
-        $("#retry-button").click(function(event) {
-          event.preventDefault();
-          $("#upload-alert").alert('close');
-          // TODO: Differentiate the CSV task or dir task.
-          postCsvUpload("retry");
-        });
       }
+      showAlert(errMsg, extra, "alert-warning");
+      $("#retry-button").click(function(event) {
+        event.preventDefault();
+        $("#upload-alert").alert('close');
+        // TODO: Differentiate the CSV task or dir task.
+        postCsvUpload("retry");
+      });
+    }
 
-      if(progressObj.fails == 0 && progressObj.total > 0 ) {
-        showAlert("All images are successfully uploaded!", "", "alert-success");
-      }
+    if(progressObj.fails == 0 && progressObj.total > 0 ) {
+      showAlert("All images are successfully uploaded!", "", "alert-success");
+    }
 
-      if (progressObj.total > 0) {
-        // If we haven't tried one file, no need to get results.
-        $.getJSON('/services/ingestionresult', renderResult);
-      }
-    } else {
-      // Calls itself again after 1000ms.
-      setTimeout("updateProgress ()", 1000);
+    if (progressObj.total > 0) {
+      // If we haven't tried one file, no need to get results.
+      $.getJSON('/services/ingestionresult', renderResult);
     }
-  });
+    return true;
+  }
+  return false;
 }
 
 renderResult = function(data) {